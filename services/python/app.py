@@ -1,7 +1,6 @@
 from fastapi import FastAPI
 import models as models
-from database import engine
-from routers import users, logins, campaigns, groups, contacts, pixels, views
+from routers import users, logins, campaigns, groups, contacts, pixels, views, stats
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.background import BackgroundTasks
 from database import get_db
@@ -11,7 +10,16 @@ import utils
 import time
 import datetime
 import json
+import os
 import database
+from alembic import command
+from alembic.config import Config
+import journal
+import pixel_filter
+import campaign_activity
+import open_classifier
+import view_shards
+import open_rollups
 
 
 # Create fast api instance
@@ -37,8 +45,23 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Create tables
-models.Base.metadata.create_all(bind=engine)
+SCHEMA_UPGRADE_ON_STARTUP = os.getenv("SCHEMA_UPGRADE_ON_STARTUP", "1") == "1"
+
+def upgrade_schema():
+    """
+    Create or upgrade the tables to the latest migration of migrations/versions,
+    a database created by create_all before the migrations is upgraded from the baseline
+    """
+    config = Config(os.path.join(os.path.dirname(os.path.abspath(__file__)), "alembic.ini"))
+    config.attributes["embedded"] = True
+    command.upgrade(config, "head")
+
+# Create or upgrade tables, run "alembic upgrade head" once instead when starting several workers
+if SCHEMA_UPGRADE_ON_STARTUP:
+    upgrade_schema()
+    # The hit tables of the view shards are created from the models, not migrated
+    if view_shards.view_shards.enabled:
+        view_shards.view_shards.create_tables()
 
 # Include routers
 app.include_router(logins.router)
@@ -48,6 +71,7 @@ app.include_router(campaigns.router)
 app.include_router(contacts.router)
 app.include_router(pixels.router)
 app.include_router(views.router)
+app.include_router(stats.router)
 
 
 
@@ -140,6 +164,8 @@ async def startup_event():
                 scheduled_datetime = datetime.datetime.strptime(contact["scheduled_datetime"], "%Y-%m-%d %H:%M:%S")
             )
             db.add(new_contact)
+            if open_rollups.OPEN_ROLLUPS_ENABLED:
+                open_rollups.count_contacts(db, [(new_contact.campaign_id, new_contact.group_id, new_contact.scheduled_datetime)])
             db.commit()
             db.refresh(new_contact)
         
@@ -153,4 +179,47 @@ async def startup_event():
             db.commit()
             db.refresh(new_pixel)
     except Exception as e:
-        print(f"Error in insert: {e}")
\ No newline at end of file
+        print(f"Error in insert: {e}")
+
+@app.on_event("startup")
+async def start_journal():
+    """
+    Start the fsync and replay threads of the local hit journal
+    """
+    if journal.JOURNAL_ENABLED:
+        journal.hit_journal.start()
+
+@app.on_event("startup")
+async def start_pixel_filter():
+    """
+    Build the known pixels filter in background and keep it in sync
+    """
+    if pixel_filter.PIXEL_FILTER_ENABLED:
+        pixel_filter.known_pixels.start()
+
+@app.on_event("startup")
+async def start_campaign_activity():
+    """
+    Load the campaign windows in background and keep them in sync
+    """
+    if campaign_activity.CAMPAIGN_ACTIVITY_ENABLED:
+        campaign_activity.campaign_windows.start()
+
+@app.on_event("startup")
+async def start_open_classifier():
+    """
+    Load the machine open rules, reload them when the file changes and flush the machine open counters
+    """
+    if open_classifier.MACHINE_OPEN_MODE != "off":
+        open_classifier.open_classifier.start()
+        open_classifier.machine_opens.start()
+
+@app.on_event("shutdown")
+async def stop_journal():
+    if journal.JOURNAL_ENABLED:
+        journal.hit_journal.stop()
+
+@app.on_event("shutdown")
+async def stop_machine_opens():
+    if open_classifier.MACHINE_OPEN_MODE != "off":
+        open_classifier.machine_opens.stop()
@@ -0,0 +1,93 @@
+"""
+Benchmark of VARCHAR(255) against BINARY(16) uuid storage for the views table on MySQL.
+
+Fills two scratch tables shaped like views, one per storage, with the same
+rows spread over --pixels pixel uuids, then reports their data and index size
+and the latency of the per-pixel lookup of the stats endpoints.
+
+Run from services/python inside the compose network:
+    docker compose exec python_service python benchmarks/binary_uuid.py --rows 10000000
+"""
+import argparse
+import datetime
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+import database
+
+STORAGES = {
+    "string": ("VARCHAR(255)", lambda value: str(value)),
+    "binary": ("BINARY(16)", lambda value: value.bytes),
+}
+
+
+def fill(conn, table, column_type, convert, pixel_uuids, rows, batch):
+    conn.execute(text(f"DROP TABLE IF EXISTS `{table}`"))
+    conn.execute(text(
+        f"CREATE TABLE `{table}` (id INT AUTO_INCREMENT PRIMARY KEY, pixel_uuid {column_type} NOT NULL, "
+        "view_datetime DATETIME NOT NULL, INDEX ix_pixel_uuid (pixel_uuid))"
+    ))
+    values = [convert(pixel_uuid) for pixel_uuid in pixel_uuids]
+    start_datetime = datetime.datetime(2024, 1, 1)
+    # Same pseudo random rows for both tables
+    rng = random.Random(0)
+    start = time.perf_counter()
+    for offset in range(0, rows, batch):
+        conn.execute(text(f"INSERT INTO `{table}` (pixel_uuid, view_datetime) VALUES (:pixel_uuid, :view_datetime)"), [
+            {"pixel_uuid": rng.choice(values), "view_datetime": start_datetime + datetime.timedelta(seconds=offset + i)}
+            for i in range(min(batch, rows - offset))
+        ])
+        conn.commit()
+    elapsed = time.perf_counter() - start
+    conn.execute(text(f"ANALYZE TABLE `{table}`"))
+    print(f"{table}: {rows} rows inserted in {elapsed:.0f}s ({rows / elapsed:.0f} rows/sec)")
+    return values
+
+
+def table_size(conn, table):
+    return conn.execute(text(
+        "SELECT DATA_LENGTH, INDEX_LENGTH FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table"
+    ), {"table": table}).one()
+
+
+def lookup_latency(conn, table, values, lookups):
+    rng = random.Random(1)
+    timings = []
+    for _ in range(lookups):
+        start = time.perf_counter()
+        conn.execute(text(f"SELECT COUNT(*), MAX(view_datetime) FROM `{table}` WHERE pixel_uuid = :pixel_uuid"), {"pixel_uuid": rng.choice(values)}).one()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000000)
+    parser.add_argument("--pixels", type=int, default=1000000, help="distinct pixel uuids of the rows")
+    parser.add_argument("--batch", type=int, default=10000, help="rows per INSERT")
+    parser.add_argument("--lookups", type=int, default=10000)
+    parser.add_argument("--keep", action="store_true", help="keep the scratch tables")
+    args = parser.parse_args()
+
+    pixel_uuids = [uuid.uuid4() for _ in range(args.pixels)]
+    with database.engine.connect() as conn:
+        for storage, (column_type, convert) in STORAGES.items():
+            table = f"bench_views_{storage}"
+            values = fill(conn, table, column_type, convert, pixel_uuids, args.rows, args.batch)
+            data_length, index_length = table_size(conn, table)
+            p50, p99 = lookup_latency(conn, table, values, args.lookups)
+            print(f"{storage:>7}: data {data_length / 2**20:8.1f} MiB, index {index_length / 2**20:8.1f} MiB, lookup p50 {p50 * 1000:.3f}ms p99 {p99 * 1000:.3f}ms")
+            if not args.keep:
+                conn.execute(text(f"DROP TABLE `{table}`"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Benchmark of the pixel dedupe round trip against Redis under concurrent load.
+
+Compares the legacy flow (a new client per helper, GET then SET) with the
+pooled single round trip script used by routers/pixels.get, without and with
+the in-process L1 tier.
+
+Run from services/python inside the compose network:
+    docker compose exec python_service python benchmarks/redis_dedupe.py --threads 32 --hits 20000
+"""
+import argparse
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import redis
+import utils
+
+
+def legacy_hit(key, value):
+    r = redis.Redis(host=utils.REDIS_HOST, port=utils.REDIS_PORT, password=os.getenv("REDIS_PASSWORD"))
+    if r.get(key):
+        return False
+    r = redis.Redis(host=utils.REDIS_HOST, port=utils.REDIS_PORT, password=os.getenv("REDIS_PASSWORD"))
+    r.set(key, value, ex=utils.PIXEL_DEDUPE_SECONDS)
+    return True
+
+
+def pooled_hit(key, value):
+    return utils.mark_pixel_seen(key, value)
+
+
+def run(name, hit, keys, threads):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        first_hits = sum(executor.map(lambda key: hit(key, "127.0.0.1"), keys))
+    elapsed = time.perf_counter() - start
+    print(f"{name:>10}: {len(keys) / elapsed:10.0f} hits/sec, {first_hits} first hits out of {len(keys)} ({elapsed:.2f}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--hits", type=int, default=20000)
+    parser.add_argument("--pixels", type=int, default=1000, help="distinct pixel uuids hit")
+    args = parser.parse_args()
+
+    pixel_l1 = utils.pixel_l1
+    for name, hit, l1 in (("legacy", legacy_hit, None), ("pooled", pooled_hit, None), ("l1+pooled", pooled_hit, pixel_l1)):
+        utils.pixel_l1 = l1
+        prefix = f"bench:{uuid.uuid4()}:"
+        keys = [f"{prefix}{i % args.pixels}" for i in range(args.hits)]
+        run(name, hit, keys, args.threads)
+        utils.redis_client.delete(*{key for key in keys})
+
+    print(f"pool: {utils.get_redis_pool_stats()}")
+    print(f"dedupe: {utils.get_dedupe_stats()}")
+
+
+if __name__ == "__main__":
+    main()
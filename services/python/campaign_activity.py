@@ -0,0 +1,159 @@
+"""
+In-process map of the activity window of every campaign.
+
+Hits on pixels of deleted campaigns, or outside the start and end of their
+campaign, are served but not recorded. The map is loaded at startup, patched
+by routers/campaigns when a campaign is created, updated or deleted, spread to
+the other workers through a Redis channel and reloaded every
+CAMPAIGN_ACTIVITY_REFRESH_SECONDS. Campaigns not in the map yet are considered
+active, so a stale map never loses a hit of a new campaign.
+"""
+import datetime
+import os
+import threading
+import time
+import redis
+import database
+import models
+import utils
+
+CAMPAIGN_ACTIVITY_ENABLED = os.getenv("CAMPAIGN_ACTIVITY_ENABLED", "1") == "1"
+CAMPAIGN_ACTIVITY_REFRESH_SECONDS = int(os.getenv("CAMPAIGN_ACTIVITY_REFRESH_SECONDS", 300))
+CAMPAIGN_ACTIVITY_CHANNEL = os.getenv("CAMPAIGN_ACTIVITY_CHANNEL", "pixeltracking:campaigns")
+
+
+def in_window(window, now: datetime.datetime) -> bool:
+    """
+    :param window: tuple of the (start, end, deleted) of a campaign
+    :return: False if the campaign is deleted or now is out of its window
+    """
+    start, end, deleted = window
+    return not deleted and start <= now <= end
+
+
+class CampaignActivity:
+    """
+    Map of campaign id to its (start, end, deleted) window, with its refresh and sync threads
+    """
+
+    def __init__(self):
+        self.windows = {}
+        self.stats = utils.StatsCounter("active", "inactive", "unknown", "reloads", "synced")
+        self.last_reload = None
+        self._lock = threading.Lock()
+        self._patched_while_reloading = None
+
+    def is_active(self, campaign_id: int, now: datetime.datetime = None) -> bool:
+        """
+        :return: False if the campaign is deleted or out of its window
+        """
+        window = self.windows.get(campaign_id)
+        if window is None:
+            self.stats.incr("unknown")
+            return True
+        if not in_window(window, now or datetime.datetime.utcnow()):
+            # Each one is a pixel hit that is not written
+            self.stats.incr("inactive")
+            return False
+        self.stats.incr("active")
+        return True
+
+    def set(self, campaign):
+        """
+        Patch the window of a campaign
+        :param campaign: models.Campaigns
+        """
+        window = (campaign.start_datetime, campaign.end_datetime, campaign.deleted_datetime is not None)
+        with self._lock:
+            if self._patched_while_reloading is not None:
+                self._patched_while_reloading[campaign.id] = window
+            self.windows[campaign.id] = window
+
+    def publish(self, campaign):
+        """
+        Patch a campaign changed by this worker and announce it to the other workers
+        :param campaign: models.Campaigns, committed
+        """
+        self.set(campaign)
+        try:
+            utils.get_redis_connection().publish(CAMPAIGN_ACTIVITY_CHANNEL, campaign.id)
+        except redis.RedisError as e:
+            # The other workers catch up on their next reload
+            print(f"Error in campaign activity publish: {e}")
+
+    def refresh(self, campaign_id: int):
+        db = database.SessionLocal()
+        try:
+            campaign = db.query(models.Campaigns).filter(models.Campaigns.id == campaign_id).first()
+        finally:
+            db.close()
+        if campaign:
+            self.set(campaign)
+
+    def reload(self):
+        """
+        Load the window of every campaign and swap the map in
+        """
+        with self._lock:
+            self._patched_while_reloading = {}
+
+        db = database.SessionLocal()
+        try:
+            rows = db.query(
+                models.Campaigns.id,
+                models.Campaigns.start_datetime,
+                models.Campaigns.end_datetime,
+                models.Campaigns.deleted_datetime
+            ).all()
+        except Exception:
+            with self._lock:
+                self._patched_while_reloading = None
+            raise
+        finally:
+            db.close()
+
+        windows = {row.id: (row.start_datetime, row.end_datetime, row.deleted_datetime is not None) for row in rows}
+        with self._lock:
+            # Campaigns changed while the table was read
+            windows.update(self._patched_while_reloading)
+            self._patched_while_reloading = None
+            self.windows = windows
+        self.last_reload = time.time()
+        self.stats.incr("reloads")
+
+    def _reload_loop(self):
+        while True:
+            try:
+                self.reload()
+                time.sleep(CAMPAIGN_ACTIVITY_REFRESH_SECONDS)
+            except Exception as e:
+                print(f"Error in campaign activity reload: {e}")
+                time.sleep(min(CAMPAIGN_ACTIVITY_REFRESH_SECONDS, 30))
+
+    def _sync_loop(self):
+        while True:
+            try:
+                pubsub = utils.get_blocking_redis_connection().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CAMPAIGN_ACTIVITY_CHANNEL)
+                for message in pubsub.listen():
+                    self.refresh(int(message["data"]))
+                    self.stats.incr("synced")
+            except Exception as e:
+                print(f"Error in campaign activity sync: {e}")
+                time.sleep(5)
+
+    def start(self):
+        for target in (self._reload_loop, self._sync_loop):
+            threading.Thread(target=target, daemon=True).start()
+
+    def get_stats(self) -> dict:
+        stats = self.stats.snapshot()
+        return dict(
+            stats,
+            campaigns=len(self.windows),
+            last_reload=self.last_reload,
+            writes_saved=stats["inactive"]
+        )
+
+
+campaign_windows = CampaignActivity()
@@ -0,0 +1,165 @@
+"""
+Copy of the groups, contacts and pixels of a campaign into another one, without reading them in Python.
+
+The active groups are copied with one INSERT ... SELECT. Contacts are then
+walked by uuid in chunks of CAMPAIGN_CLONE_CHUNK: each chunk of contacts and
+their pixels is copied with two INSERT ... SELECT and committed, their
+scheduled_datetime shifted by the offset between the two campaign starts.
+
+The new contact and pixel uuids are computed by the database, as the md5 of
+the new campaign id and of the copied uuid shaped as a version 3 uuid. A pixel
+therefore finds the uuid of its new contact without any lookup, and a clone
+never collides with its source nor with another clone. Pixels keep their
+ordinal, which stays dense within the new campaign, whose ordinal counter then
+starts from the one of the source.
+
+A copy failing part way is not undone, its committed chunks stay: the new
+campaign is marked deleted, for campaign_purge.py to remove, and the progress
+ends with an error record instead of the totals.
+"""
+import datetime
+import hashlib
+import os
+from typing import Dict, Iterator
+from sqlalchemy import case, func, insert, literal, select, text, type_coerce, String
+import campaign_activity
+import database
+import models
+import open_rollups
+import pixel_filter
+
+CAMPAIGN_CLONE_CHUNK = int(os.getenv("CAMPAIGN_CLONE_CHUNK", 1000))
+
+
+def _register_sqlite_functions(db):
+    # MySQL builtins missing from SQLite
+    connection = db.connection().connection.driver_connection
+    connection.create_function("md5", 1, lambda value: hashlib.md5(value.encode()).hexdigest(), deterministic=True)
+    connection.create_function("unhex", 1, lambda value: bytes.fromhex(value), deterministic=True)
+
+
+def derived_uuid(column, campaign_id: int):
+    """
+    SQL expression of the uuid derived from a contact or pixel uuid column for a campaign
+    """
+    binary = models.UUID_STORAGE == "binary"
+    digest = func.md5(literal(f"{campaign_id}:", String) + (func.hex(column) if binary else column))
+    separator = "" if binary else "-"
+
+    def part(start, length):
+        return func.substr(digest, start, length, type_=String)
+
+    # Version 3, RFC 4122 variant
+    expression = (
+        part(1, 8) + separator + part(9, 4) + f"{separator}3" + part(14, 3)
+        + f"{separator}8" + part(18, 3) + separator + part(21, 12)
+    )
+    return type_coerce(func.unhex(expression) if binary else expression, models.Pixels.uuid.type)
+
+
+def _shifted(db, column, shift: datetime.timedelta):
+    seconds = int(shift.total_seconds())
+    if db.get_bind().dialect.name == "mysql":
+        return func.timestampadd(text("SECOND"), seconds, column)
+    return func.datetime(column, f"{seconds:+d} seconds")
+
+
+def clone_campaign(source_id: int, campaign_id: int, shift: datetime.timedelta, chunk: int = CAMPAIGN_CLONE_CHUNK) -> Iterator[Dict]:
+    """
+    Copy the active groups of a campaign, their contacts and the pixels of the contacts into an empty campaign
+    :param source_id: int campaign copied
+    :param campaign_id: int campaign receiving the copy
+    :param shift: datetime.timedelta added to the scheduled_datetime of the contacts
+    :return: iterator of the progress after the groups and after each chunk of contacts, then of the totals or of the error
+    """
+    campaigns = models.Campaigns
+    groups = models.Groups
+    contacts = models.Contacts
+    pixels = models.Pixels
+
+    db = database.SessionLocal()
+    try:
+        try:
+            if db.get_bind().dialect.name == "sqlite":
+                _register_sqlite_functions(db)
+
+            # Ids are assigned in the order of the selected rows, pairing the two ordered lists maps the groups
+            source_groups = [row.id for row in db.query(groups.id).filter(groups.campaign_id == source_id, groups.deleted_datetime == None).order_by(groups.id)]
+            db.execute(insert(groups).from_select(
+                ["campaign_id", "user_id", "campaign_group_id", "group_name", "group_description", "created_datetime"],
+                select(literal(campaign_id), groups.user_id, groups.campaign_group_id, groups.group_name, groups.group_description, literal(datetime.datetime.utcnow()))
+                .where(groups.campaign_id == source_id, groups.deleted_datetime == None).order_by(groups.id)
+            ))
+            new_groups = [row.id for row in db.query(groups.id).filter(groups.campaign_id == campaign_id).order_by(groups.id)]
+            if len(new_groups) != len(source_groups):
+                raise RuntimeError(f"{len(source_groups)} groups to copy, {len(new_groups)} copied")
+            db.commit()
+            group_ids = dict(zip(source_groups, new_groups))
+
+            of_source = [contacts.campaign_id == source_id, contacts.group_id.in_(source_groups)]
+            total = db.query(func.count()).select_from(contacts).filter(*of_source).scalar() if source_groups else 0
+            yield {"groups": len(group_ids), "total_contacts": total}
+
+            copied_contacts = 0
+            copied_pixels = 0
+            last_uuid = None
+            while group_ids:
+                after = [] if last_uuid is None else [contacts.uuid > last_uuid]
+                # Last contact of the chunk, read from the index
+                boundary = db.execute(
+                    select(contacts.uuid).where(*of_source, *after).order_by(contacts.uuid).offset(chunk - 1).limit(1)
+                ).scalar()
+                within = of_source + after + ([contacts.uuid <= boundary] if boundary is not None else [])
+
+                copied_contacts += db.execute(insert(contacts).from_select(
+                    ["uuid", "campaign_id", "group_id", "scheduled_datetime"],
+                    select(
+                        derived_uuid(contacts.uuid, campaign_id),
+                        literal(campaign_id),
+                        case(group_ids, value=contacts.group_id),
+                        _shifted(db, contacts.scheduled_datetime, shift)
+                    ).where(*within)
+                )).rowcount
+                copied_pixels += db.execute(insert(pixels).from_select(
+                    ["uuid", "contact_uuid", "contact_pixel_number", "ordinal"],
+                    select(
+                        derived_uuid(pixels.uuid, campaign_id),
+                        derived_uuid(pixels.contact_uuid, campaign_id),
+                        pixels.contact_pixel_number,
+                        pixels.ordinal
+                    ).join(contacts, pixels.contact_uuid == contacts.uuid).where(*within)
+                )).rowcount
+                if open_rollups.OPEN_ROLLUPS_ENABLED:
+                    open_rollups.count_contacts_select(db, campaign_id, group_ids, _shifted(db, contacts.scheduled_datetime, shift), within)
+                db.commit()
+
+                if pixel_filter.PIXEL_FILTER_ENABLED:
+                    pixel_filter.known_pixels.register(db.execute(
+                        select(derived_uuid(pixels.uuid, campaign_id)).join(contacts, pixels.contact_uuid == contacts.uuid).where(*within)
+                    ).scalars().all())
+
+                yield {"contacts": copied_contacts, "pixels": copied_pixels, "total_contacts": total}
+                if boundary is None:
+                    break
+                last_uuid = boundary
+
+            # The copied ordinals are below the counter of the source
+            next_ordinal = db.query(campaigns.next_pixel_ordinal).filter(campaigns.id == source_id).scalar()
+            db.query(campaigns).filter(campaigns.id == campaign_id, campaigns.next_pixel_ordinal < next_ordinal).update(
+                {campaigns.next_pixel_ordinal: next_ordinal}, synchronize_session=False
+            )
+            db.commit()
+        except Exception as e:
+            # The copied rows stay under the new campaign, deleted so that campaign_purge.py removes them
+            db.rollback()
+            print(f"Error in clone of campaign {source_id} into {campaign_id}: {e}")
+            campaign = db.query(campaigns).filter(campaigns.id == campaign_id).first()
+            campaign.deleted_datetime = datetime.datetime.utcnow()
+            db.commit()
+            campaign_activity.campaign_windows.publish(campaign)
+            yield {"campaign_id": campaign_id, "error": f"Clone failed, the campaign is deleted: {e}"}
+            return
+    finally:
+        db.close()
+
+    yield {"campaign_id": campaign_id, "groups": len(group_ids), "contacts": copied_contacts, "pixels": copied_pixels}
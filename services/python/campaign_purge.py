@@ -0,0 +1,202 @@
+"""
+Purge of the subtree of deleted campaigns and groups: groups, contacts, pixels and their hits.
+
+Deleting a campaign or a group through the API only sets its deleted_datetime.
+Run this job, e.g. daily from cron, to remove what is under them:
+    python campaign_purge.py --deleted-days 30 --archive
+    python campaign_purge.py --campaign 12
+
+The subtree is removed children first, chunk by chunk of primary keys: the
+views, opens counters and compacted views of a chunk of pixels (on their view
+shard), then the pixels, the contacts with their first opens, the open rate
+rollups, the groups and the campaign itself.
+Each chunk is one short transaction, so no lock is held for longer than a
+chunk and an interrupted run simply resumes with the rows left. With
+--archive every row is first copied to the *_archive table of its table in
+the same transaction as its delete. First opens and rollups are derived data,
+they are never archived.
+
+Chunks start at PURGE_CHUNK rows. A chunk taking more than PURGE_STATEMENT_BUDGET
+seconds halves the chunk size, one taking less than half of it grows the size
+by a quarter, up to PURGE_MAX_CHUNK. PURGE_PAUSE seconds are slept between
+two chunks, to leave room to the hot path.
+"""
+import argparse
+import datetime
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+from sqlalchemy import literal, select
+import database
+import models
+import view_shards
+
+PURGE_CHUNK = int(os.getenv("PURGE_CHUNK", 1000))
+PURGE_MAX_CHUNK = int(os.getenv("PURGE_MAX_CHUNK", 20000))
+PURGE_STATEMENT_BUDGET = float(os.getenv("PURGE_STATEMENT_BUDGET", 0.5))
+PURGE_PAUSE = float(os.getenv("PURGE_PAUSE", 0.1))
+
+
+class ChunkBudget:
+    """
+    Size of the next chunk, adapted to keep the transaction of a chunk within a time budget
+    :param size: int first chunk size
+    :param budget: float seconds per chunk
+    :param max_size: int largest chunk size
+    :param pause: float seconds slept after each chunk
+    """
+
+    def __init__(self, size: int = PURGE_CHUNK, budget: float = PURGE_STATEMENT_BUDGET, max_size: int = PURGE_MAX_CHUNK, pause: float = PURGE_PAUSE):
+        self.size = size
+        self.budget = budget
+        self.max_size = max_size
+        self.pause = pause
+
+    @contextmanager
+    def timed(self):
+        start = time.monotonic()
+        yield
+        elapsed = time.monotonic() - start
+        if elapsed > self.budget:
+            self.size = max(1, self.size // 2)
+        elif elapsed < self.budget / 2:
+            self.size = min(self.max_size, self.size + max(1, self.size // 4))
+        time.sleep(self.pause)
+
+
+def move_rows(db, model, condition, archive: bool) -> int:
+    """
+    Delete the rows of a model matching a condition, after copying them to its archive table
+    :return: number of rows deleted
+    """
+    table = model.__table__
+    if archive:
+        archive_table = models.archive_tables[model]
+        db.execute(archive_table.insert().from_select(
+            [column.name for column in archive_table.columns],
+            select(*table.columns, literal(datetime.datetime.utcnow())).where(condition)
+        ))
+    deleted = db.execute(table.delete().where(condition)).rowcount
+    db.commit()
+    return deleted
+
+
+def purge_hits(db, pixel_uuids: List[str], archive: bool, budget: ChunkBudget, counts: Dict[str, int]):
+    """
+    Remove the views, opens counters and compacted views of pixels, on the database holding them
+    """
+    views = models.Views
+    while True:
+        size = budget.size
+        with budget.timed():
+            ids = db.execute(select(views.id).where(views.pixel_uuid.in_(pixel_uuids)).limit(size)).scalars().all()
+            if ids:
+                counts["views"] += move_rows(db, views, views.id.in_(ids), archive)
+        if len(ids) < size:
+            break
+
+    for model in [models.PixelOpens, models.MachineOpens, models.ViewsMonthly]:
+        with budget.timed():
+            counts[model.__tablename__] += move_rows(db, model, model.pixel_uuid.in_(pixel_uuids), archive)
+
+
+def purge_contacts(db, condition, archive: bool, budget: ChunkBudget, counts: Dict[str, int]):
+    """
+    Remove the contacts matching a condition with their pixels and hits, chunk by chunk of contacts
+    """
+    contacts = models.Contacts
+    pixels = models.Pixels
+    while True:
+        # Purged contacts are gone, the first ones left make the next chunk
+        contact_uuids = db.execute(select(contacts.uuid).where(condition).order_by(contacts.uuid).limit(budget.size)).scalars().all()
+        if not contact_uuids:
+            break
+        pixel_uuids = db.execute(select(pixels.uuid).where(pixels.contact_uuid.in_(contact_uuids))).scalars().all()
+        db.rollback()
+
+        for i in range(0, len(pixel_uuids), budget.size):
+            chunk = pixel_uuids[i:i + budget.size]
+            for shard, shard_pixels in view_shards.view_shards.by_shard(chunk).items():
+                with view_shards.view_shards.session(db, shard) as hit_db:
+                    purge_hits(hit_db, shard_pixels, archive, budget, counts)
+            with budget.timed():
+                counts["pixels"] += move_rows(db, pixels, pixels.uuid.in_(chunk), archive)
+        with budget.timed():
+            counts["contact_opens"] += move_rows(db, models.ContactOpens, models.ContactOpens.contact_uuid.in_(contact_uuids), False)
+            counts["contacts"] += move_rows(db, contacts, contacts.uuid.in_(contact_uuids), archive)
+
+
+def purge(campaign_ids: List[int], group_ids: List[int], archive: bool = False, budget: ChunkBudget = None) -> Dict[str, int]:
+    """
+    Remove deleted campaigns and groups with everything under them
+    :param campaign_ids: list of deleted campaign ids
+    :param group_ids: list of deleted group ids, of campaigns kept
+    :param archive: bool copy the rows to the archive tables before deleting them
+    :return: dict of the rows removed per table
+    """
+    budget = budget or ChunkBudget()
+    counts = {name: 0 for name in ["views", "pixel_opens", "machine_opens", "views_monthly", "pixels", "contact_opens", "contacts", "open_rollups", "groups", "campaigns"]}
+
+    db = database.SessionLocal()
+    try:
+        for group_id in group_ids:
+            purge_contacts(db, models.Contacts.group_id == group_id, archive, budget, counts)
+            counts["open_rollups"] += move_rows(db, models.OpenRollups, models.OpenRollups.group_id == group_id, False)
+            counts["groups"] += move_rows(db, models.Groups, models.Groups.id == group_id, archive)
+        for campaign_id in campaign_ids:
+            purge_contacts(db, models.Contacts.campaign_id == campaign_id, archive, budget, counts)
+            counts["open_rollups"] += move_rows(db, models.OpenRollups, models.OpenRollups.campaign_id == campaign_id, False)
+            counts["groups"] += move_rows(db, models.Groups, models.Groups.campaign_id == campaign_id, archive)
+            counts["campaigns"] += move_rows(db, models.Campaigns, models.Campaigns.id == campaign_id, archive)
+    finally:
+        db.close()
+    return counts
+
+
+def deleted_before(cutoff: datetime.datetime):
+    """
+    :return: tuple of the ids of the campaigns deleted before cutoff and of the groups deleted before cutoff in the other campaigns
+    """
+    db = database.SessionLocal()
+    try:
+        campaign_ids = [row.id for row in db.query(models.Campaigns.id).filter(models.Campaigns.deleted_datetime < cutoff)]
+        group_ids = [row.id for row in db.query(models.Groups.id).filter(
+            models.Groups.deleted_datetime < cutoff, models.Groups.campaign_id.notin_(campaign_ids)
+        )]
+    finally:
+        db.close()
+    return campaign_ids, group_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--campaign", type=int, nargs="+", help="ids of deleted campaigns to purge")
+    target.add_argument("--group", type=int, nargs="+", help="ids of deleted groups to purge")
+    target.add_argument("--deleted-days", type=int, help="purge the campaigns and groups deleted more than this many days ago")
+    parser.add_argument("--archive", action="store_true", help="copy the rows to the archive tables before deleting them")
+    parser.add_argument("--chunk", type=int, default=PURGE_CHUNK, help="rows per chunk to start with")
+    parser.add_argument("--budget", type=float, default=PURGE_STATEMENT_BUDGET, help="seconds per chunk transaction")
+    parser.add_argument("--pause", type=float, default=PURGE_PAUSE, help="seconds slept between two chunks")
+    args = parser.parse_args()
+
+    if args.deleted_days is not None:
+        campaign_ids, group_ids = deleted_before(datetime.datetime.now() - datetime.timedelta(days=args.deleted_days))
+    else:
+        campaign_ids, group_ids = args.campaign or [], args.group or []
+        db = database.SessionLocal()
+        try:
+            # Only what the API deleted is purged
+            active = db.query(models.Campaigns.id).filter(models.Campaigns.id.in_(campaign_ids), models.Campaigns.deleted_datetime == None).all()
+            active += db.query(models.Groups.id).filter(models.Groups.id.in_(group_ids), models.Groups.deleted_datetime == None).all()
+        finally:
+            db.close()
+        if active:
+            parser.error(f"Not deleted: {', '.join(str(row.id) for row in active)}")
+
+    print(purge(campaign_ids, group_ids, args.archive, ChunkBudget(args.chunk, args.budget, max(args.chunk, PURGE_MAX_CHUNK), args.pause)))
+
+
+if __name__ == "__main__":
+    main()
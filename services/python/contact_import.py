@@ -0,0 +1,199 @@
+"""
+Bulk contact import of an uploaded CSV or NDJSON file.
+
+The upload is spooled to disk by the multipart parser, its rows are read one
+by one and imported in batches of IMPORT_BATCH_SIZE: every row is validated
+with schemas.AddContact, the campaigns and groups of a batch are checked with
+one query each (and cached for the following batches), the uuids already taken
+with one IN query, then the valid rows are inserted with a single executemany
+and committed. Only one batch and the first IMPORT_MAX_ERRORS errors are held
+in memory, whatever the size of the file.
+"""
+import csv
+import io
+import json
+import os
+from typing import BinaryIO, Dict, Iterator, List, Tuple
+from pydantic import ValidationError
+from sqlalchemy import insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+import models
+import open_rollups
+import schemas
+import utils
+
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", 1000))
+IMPORT_MAX_ERRORS = int(os.getenv("IMPORT_MAX_ERRORS", 1000))
+CONTACT_FIELDS = ["uuid", "campaign_id", "group_id", "scheduled_datetime"]
+
+
+def read_rows(file: BinaryIO, fmt: str) -> Iterator[Tuple[int, object]]:
+    """
+    Decode the rows of an upload one at a time
+    :param file: binary file object
+    :param fmt: string "csv", with a header line, or "ndjson"
+    :return: iterator of (line number, row dict or ValueError of a malformed line)
+    """
+    text = io.TextIOWrapper(file, encoding="utf-8", errors="replace", newline="")
+    if fmt == "ndjson":
+        for line_no, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_no, ValueError(f"Malformed line: {e}")
+                continue
+            yield line_no, row if isinstance(row, dict) else ValueError("Malformed line: not a JSON object.")
+        return
+
+    reader = csv.reader(text)
+    header = [column.strip() for column in next(reader, [])]
+    missing = [field for field in CONTACT_FIELDS if field not in header]
+    if missing:
+        yield 1, ValueError(f"Missing columns {', '.join(missing)}.")
+        return
+    for values in reader:
+        if not any(value.strip() for value in values):
+            continue
+        if len(values) != len(header):
+            yield reader.line_num, ValueError(f"Malformed line: expected {len(header)} columns, got {len(values)}.")
+            continue
+        yield reader.line_num, dict(zip(header, values))
+
+
+class ContactImporter:
+    """
+    Validates and inserts batches of contacts, keeping the campaign and group checks across batches
+    :param db: Session
+    """
+
+    def __init__(self, db: Session):
+        self.db = db
+        self.campaigns = {}
+        self.groups = {}
+        self.inserted = 0
+        self.rejected = 0
+        self.errors = []
+
+    def _load_parents(self, contacts: List[schemas.AddContact]):
+        campaign_ids = {contact.campaign_id for contact in contacts} - self.campaigns.keys()
+        if campaign_ids:
+            found = {
+                row.id: row.deleted_datetime is not None
+                for row in self.db.query(models.Campaigns.id, models.Campaigns.deleted_datetime).filter(models.Campaigns.id.in_(campaign_ids))
+            }
+            for campaign_id in campaign_ids:
+                self.campaigns[campaign_id] = found.get(campaign_id)
+
+        group_ids = {contact.group_id for contact in contacts} - self.groups.keys()
+        if group_ids:
+            found = {
+                row.id: (row.campaign_id, row.deleted_datetime is not None)
+                for row in self.db.query(models.Groups.id, models.Groups.campaign_id, models.Groups.deleted_datetime).filter(models.Groups.id.in_(group_ids))
+            }
+            for group_id in group_ids:
+                self.groups[group_id] = found.get(group_id)
+
+    def _parent_error(self, contact: schemas.AddContact):
+        group = self.groups[contact.group_id]
+        if group is None:
+            return f"Group with id {contact.group_id} not found."
+        group_campaign_id, group_deleted = group
+        if group_deleted:
+            return "Group is not active."
+        if group_campaign_id != contact.campaign_id:
+            return f"Group with id {contact.group_id} is not in campaign {contact.campaign_id}."
+        campaign_deleted = self.campaigns[contact.campaign_id]
+        if campaign_deleted is None:
+            return f"Campaign with id {contact.campaign_id} not found."
+        if campaign_deleted:
+            return "Campaign is not active"
+        return None
+
+    def import_batch(self, rows: List[Tuple[int, object]]) -> List[Dict]:
+        """
+        Import a batch of decoded rows
+        :param rows: list of (line number, row dict or ValueError of a malformed line)
+        :return: list of per row errors
+        """
+        errors = []
+        valid = []
+        for line_no, row in rows:
+            if isinstance(row, ValueError):
+                errors.append({"line": line_no, "error": str(row)})
+                continue
+            try:
+                valid.append((line_no, schemas.AddContact(**row)))
+            except ValidationError as e:
+                error = e.errors()[0]
+                errors.append({"line": line_no, "uuid": row.get("uuid"), "error": f"{'.'.join(map(str, error['loc']))}: {error['msg']}"})
+
+        # Binary uuid columns cannot be queried with anything else than a uuid
+        contacts = [contact for _, contact in valid if utils.is_storable_uuid(contact.uuid)]
+        existing = set()
+        if contacts:
+            self._load_parents(contacts)
+            existing = {
+                row.uuid for row in self.db.query(models.Contacts.uuid).filter(models.Contacts.uuid.in_([contact.uuid for contact in contacts]))
+            }
+
+        new_contacts = []
+        seen = set()
+        for line_no, contact in valid:
+            if not utils.is_storable_uuid(contact.uuid):
+                error = f"Contact uuid {contact.uuid} is not a UUID."
+            else:
+                error = self._parent_error(contact)
+            if not error and (contact.uuid in existing or contact.uuid in seen):
+                error = f"Contact with uuid {contact.uuid} already exists."
+            if error:
+                errors.append({"line": line_no, "uuid": contact.uuid, "error": error})
+                continue
+            seen.add(contact.uuid)
+            new_contacts.append((line_no, contact.model_dump()))
+
+        if new_contacts:
+            try:
+                self.db.execute(insert(models.Contacts), [contact for _, contact in new_contacts])
+                if open_rollups.OPEN_ROLLUPS_ENABLED:
+                    open_rollups.count_contacts(self.db, [
+                        (contact["campaign_id"], contact["group_id"], contact["scheduled_datetime"]) for _, contact in new_contacts
+                    ])
+                self.db.commit()
+            except SQLAlchemyError as e:
+                # Most likely a uuid inserted concurrently, the batch is rejected as a whole
+                self.db.rollback()
+                print(f"Error in contact import: {e}")
+                errors.extend({"line": line_no, "uuid": contact["uuid"], "error": "Batch rejected by the database."} for line_no, contact in new_contacts)
+                new_contacts = []
+
+        errors.sort(key=lambda error: error["line"])
+        self.inserted += len(new_contacts)
+        self.rejected += len(errors)
+        self.errors.extend(errors[:IMPORT_MAX_ERRORS - len(self.errors)])
+        return errors
+
+    def import_file(self, file: BinaryIO, fmt: str) -> Dict:
+        """
+        Import every row of an upload, batch by batch
+        :param file: binary file object
+        :param fmt: string "csv" or "ndjson"
+        :return: dict of inserted and rejected counts and the first per row errors
+        """
+        batch = []
+        for row in read_rows(file, fmt):
+            batch.append(row)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                self.import_batch(batch)
+                batch = []
+        if batch:
+            self.import_batch(batch)
+
+        return {
+            "inserted": self.inserted,
+            "rejected": self.rejected,
+            "errors": self.errors,
+            "errors_truncated": self.rejected > len(self.errors)
+        }
@@ -0,0 +1,263 @@
+"""
+Local append-only journal of pixel hits that could not be recorded.
+
+When Redis or MySQL fail on the hot path the hit is appended to a segment file
+of this worker and the pixel is served anyway. Appends are flushed and fsynced
+in batches, a background replayer bulk-loads sealed segments into Views once
+the database answers again and deletes them. The total size of the segments
+is bounded by JOURNAL_MAX_BYTES, hits over the budget are counted as dropped.
+
+Each line keeps the client ip and user agent of the hit. The replay applies
+the machine open classifier and a PIXEL_DEDUPE_SECONDS window per pixel, as
+the pixel endpoint would have, against the Views already recorded and the
+other journaled hits of the batch.
+
+Segments are named hits-<pid>-<seq>.open while written, .log once sealed and
+.replaying-<pid> while claimed by a replayer, so several uvicorn workers can
+share the directory.
+"""
+import datetime
+import glob
+import os
+import threading
+import database
+import open_classifier
+import tracking
+import utils
+
+JOURNAL_ENABLED = os.getenv("JOURNAL_ENABLED", "1") == "1"
+JOURNAL_DIR = os.getenv("JOURNAL_DIR", "journal")
+JOURNAL_MAX_BYTES = int(os.getenv("JOURNAL_MAX_BYTES", 256*1024*1024))
+JOURNAL_SEGMENT_BYTES = int(os.getenv("JOURNAL_SEGMENT_BYTES", 4*1024*1024))
+JOURNAL_FSYNC_BATCH = int(os.getenv("JOURNAL_FSYNC_BATCH", 256))
+JOURNAL_FSYNC_MS = int(os.getenv("JOURNAL_FSYNC_MS", 200))
+JOURNAL_REPLAY_SECONDS = float(os.getenv("JOURNAL_REPLAY_SECONDS", 5))
+JOURNAL_REPLAY_BATCH = int(os.getenv("JOURNAL_REPLAY_BATCH", 1000))
+
+# Characters of a user agent that would split a journal line
+LINE_SEPARATORS = str.maketrans("\t\r\n", "   ")
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class HitJournal:
+    """
+    Disk-backed, append-only, fsync-batched journal of pixel hits
+    :param directory: string directory of the segment files
+    :param max_bytes: int disk budget of all the segments
+    """
+
+    def __init__(self, directory: str = JOURNAL_DIR, max_bytes: int = JOURNAL_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats = utils.StatsCounter("appended", "dropped", "fsyncs", "replayed", "deduped", "replay_errors")
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self._file = None
+        self._path = None
+        self._seq = 0
+        self._unsynced = 0
+        self._disk_bytes = None
+
+    # Writer side
+
+    def _segment_path(self, suffix: str) -> str:
+        return os.path.join(self.directory, f"hits-{os.getpid()}-{self._seq}.{suffix}")
+
+    def _scan_disk_bytes(self) -> int:
+        os.makedirs(self.directory, exist_ok=True)
+        return sum(os.path.getsize(path) for path in glob.glob(os.path.join(self.directory, "hits-*")))
+
+    def _sync(self):
+        if self._file and self._unsynced:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+            self.stats.incr("fsyncs")
+
+    def _seal(self):
+        if not self._file:
+            return
+        self._sync()
+        self._file.close()
+        os.rename(self._path, self._path[:-len(".open")] + ".log")
+        self._file = None
+        self._path = None
+
+    def append(self, pixel_uuid: str, view_datetime: datetime.datetime = None, client_host: str = "", user_agent: str = "") -> bool:
+        """
+        Journal a pixel hit
+        :param pixel_uuid: string pixel uuid
+        :param view_datetime: datetime of the hit, defaults to now
+        :param client_host: string client ip, for the machine open classifier on replay
+        :param user_agent: string User-Agent header of the hit
+        :return: False if the hit was dropped because the disk budget is exhausted or the disk failed
+        """
+        view_datetime = view_datetime or datetime.datetime.utcnow()
+        # Random event id so that a partially replayed segment is not counted twice
+        user_agent = user_agent.translate(LINE_SEPARATORS)
+        line = f"{pixel_uuid}\t{view_datetime.isoformat()}\t{os.urandom(8).hex()}\t{client_host}\t{user_agent}\n".encode(errors="replace")
+
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_disk_bytes()
+            if self._disk_bytes + len(line) > self.max_bytes:
+                self.stats.incr("dropped")
+                return False
+
+            try:
+                if self._file and self._file.tell() >= JOURNAL_SEGMENT_BYTES:
+                    self._seal()
+                if not self._file:
+                    self._seq += 1
+                    self._path = self._segment_path("open")
+                    self._file = open(self._path, "ab")
+
+                self._file.write(line)
+                self._disk_bytes += len(line)
+                self._unsynced += 1
+                if self._unsynced >= JOURNAL_FSYNC_BATCH:
+                    self._sync()
+            except OSError as e:
+                # Disk full or unwritable, the pixel is served all the same
+                print(f"Error in journal append: {e}")
+                self.stats.incr("dropped")
+                return False
+
+        self.stats.incr("appended")
+        return True
+
+    # Replayer side
+
+    def _claim_segments(self):
+        """
+        Claim sealed segments, orphans of dead workers and our own leftovers
+        """
+        pid = os.getpid()
+        claimable = glob.glob(os.path.join(self.directory, "hits-*.log"))
+        for path in glob.glob(os.path.join(self.directory, "hits-*.open")) + glob.glob(os.path.join(self.directory, "hits-*.replaying-*")):
+            if path == self._path:
+                continue
+            owner = int(path.rsplit("-", 1)[1]) if ".replaying-" in path else int(os.path.basename(path).split("-")[1])
+            if owner == pid or not _pid_alive(owner):
+                claimable.append(path)
+
+        claimed = []
+        for path in sorted(claimable):
+            target = path.rsplit(".", 1)[0] + f".replaying-{pid}"
+            try:
+                if path != target:
+                    os.rename(path, target)
+            except FileNotFoundError:
+                # Claimed by another worker in the meantime
+                continue
+            claimed.append(target)
+        return claimed
+
+    def _replay_segment(self, path: str):
+        classify = open_classifier.MACHINE_OPEN_MODE != "off"
+        hits = []
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    fields = line.decode().rstrip("\n").split("\t")
+                    # Lines journaled before the client was kept have no host nor user agent
+                    pixel_uuid, view_datetime, event_id, client_host, user_agent = fields if len(fields) == 5 else fields + ["", ""]
+                    view_datetime = datetime.datetime.fromisoformat(view_datetime)
+                except ValueError:
+                    # Torn last line of a crashed worker
+                    continue
+                machine_label = open_classifier.open_classifier.classify(client_host, user_agent) if classify and client_host else None
+                hits.append((pixel_uuid, view_datetime, "j:" + event_id, machine_label))
+
+        # The dedupe of the pixel endpoint was down with Redis, refetches and prefetches are dropped here
+        hits.sort(key=lambda hit: hit[1])
+        window = datetime.timedelta(seconds=utils.PIXEL_DEDUPE_SECONDS)
+        for start in range(0, len(hits), JOURNAL_REPLAY_BATCH):
+            batch = hits[start:start + JOURNAL_REPLAY_BATCH]
+            db = database.SessionLocal()
+            try:
+                kept = tracking.dedupe_hits(db, batch, window)
+                tracking.record_views(db, [hit[:3] for hit in kept], {event_id: label for _, _, event_id, label in kept if label})
+            finally:
+                db.close()
+            self.stats.incr("deduped", len(batch) - len(kept))
+
+        size = os.path.getsize(path)
+        os.remove(path)
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes -= size
+        self.stats.incr("replayed", len(hits))
+
+    def replay(self) -> int:
+        """
+        Seal the current segment and load every claimable segment into Views
+        :return: number of segments replayed
+        """
+        with self._lock:
+            self._seal()
+
+        replayed = 0
+        for path in self._claim_segments():
+            try:
+                self._replay_segment(path)
+                replayed += 1
+            except Exception as e:
+                # Backends still down, give the segment back for the next round
+                self.stats.incr("replay_errors")
+                print(f"Error in journal replay of {path}: {e}")
+                os.rename(path, path.rsplit(".", 1)[0] + ".log")
+                raise
+        return replayed
+
+    def _flush_loop(self):
+        while not self._stop.wait(JOURNAL_FSYNC_MS / 1000):
+            with self._lock:
+                self._sync()
+
+    def _replay_loop(self):
+        backoff = JOURNAL_REPLAY_SECONDS
+        while not self._stop.wait(backoff):
+            try:
+                self.replay()
+                backoff = JOURNAL_REPLAY_SECONDS
+            except Exception:
+                backoff = min(backoff * 2, 60)
+
+    def start(self):
+        with self._lock:
+            self._disk_bytes = self._scan_disk_bytes()
+        for target in (self._flush_loop, self._replay_loop):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        with self._lock:
+            self._seal()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            disk_bytes = self._disk_bytes or 0
+        pending_segments = len(glob.glob(os.path.join(self.directory, "hits-*")))
+        return dict(
+            self.stats.snapshot(),
+            disk_bytes=disk_bytes,
+            max_bytes=self.max_bytes,
+            budget_used=round(disk_bytes / self.max_bytes, 4),
+            pending_segments=pending_segments
+        )
+
+
+hit_journal = HitJournal()
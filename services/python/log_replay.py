@@ -0,0 +1,264 @@
+"""
+Replay of pixel hits found in reverse proxy or CDN access logs into Views.
+
+For the opens served while the API was down or bypassed. Files in nginx
+"combined" format, plain or gzip'd, are parsed in parallel, one process per
+file:
+    python log_replay.py /var/log/nginx/access.log.2.gz /var/log/nginx/access.log.1 --workers 4
+
+The rules of the pixel endpoint apply: signed pixel urls are verified,
+machine opens are classified and recorded as Views rows tagged with their
+label, and a hit is only recorded when its pixel has no other hit of the same
+kind, replayed or already in Views, within PIXEL_DEDUPE_SECONDS. Hits are
+written with tracking.record_views in batches, each with an event id made of
+the file fingerprint and the line offset, so replaying a file twice records
+nothing new. The offset reached in each file is saved after every batch in
+LOG_REPLAY_STATE_DIR and an interrupted replay resumes from it. Files are
+fingerprinted by their first FINGERPRINT_BYTES, a file still shorter than
+that is left for a later replay, since those bytes may still change.
+
+The API runs a replay as a job in a thread of its worker, see start_job. Its
+status is saved next to the offsets, so any worker sharing
+LOG_REPLAY_STATE_DIR can report it.
+"""
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import threading
+from typing import Dict, List, Optional
+import database
+import open_classifier
+import tracking
+import utils
+
+LOG_REPLAY_DIR = os.getenv("LOG_REPLAY_DIR", "/var/log/nginx")
+LOG_REPLAY_STATE_DIR = os.getenv("LOG_REPLAY_STATE_DIR", "log_replay_state")
+LOG_REPLAY_BATCH = int(os.getenv("LOG_REPLAY_BATCH", 5000))
+LOG_REPLAY_WORKERS = int(os.getenv("LOG_REPLAY_WORKERS", os.cpu_count() or 1))
+
+# $remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent "$http_referer" "$http_user_agent"
+COMBINED_LINE = re.compile(
+    rb'^(?P<host>\S+) \S+ \S+ \[(?P<time>[^\]]+)\] "(?:GET|HEAD) (?P<path>/pixel/[^ "?]+)[^ "]* [^"]*" (?P<status>\d{3}) \S+ "[^"]*" "(?P<agent>[^"]*)"'
+)
+LOG_TIME_FORMAT = "%d/%b/%Y:%H:%M:%S %z"
+FINGERPRINT_BYTES = 4096
+
+
+def _open(path: str):
+    with open(path, "rb") as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+    return gzip.open(path, "rb") if compressed else open(path, "rb")
+
+
+def file_fingerprint(path: str) -> Optional[str]:
+    """
+    Identify a log file by its first uncompressed bytes, which survive rotation and compression
+    :return: string fingerprint, None while the file is shorter than FINGERPRINT_BYTES
+    """
+    with _open(path) as f:
+        prefix = f.read(FINGERPRINT_BYTES)
+    if len(prefix) < FINGERPRINT_BYTES:
+        return None
+    return hashlib.sha1(prefix).hexdigest()[:16]
+
+
+def parse_line(line: bytes):
+    """
+    Extract a pixel hit from an access log line
+    :return: tuple of (pixel uuid or signed token, utc datetime, client ip, user agent), None for any other line
+    """
+    match = COMBINED_LINE.match(line)
+    if not match or not match.group("status").startswith((b"2", b"3")):
+        return None
+    try:
+        view_datetime = datetime.datetime.strptime(match.group("time").decode(), LOG_TIME_FORMAT)
+    except ValueError:
+        return None
+    pixel, _ = utils.split_pixel_format(match.group("path")[len(b"/pixel/"):].decode(errors="replace"))
+    view_datetime = view_datetime.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return pixel, view_datetime, match.group("host").decode(errors="replace"), match.group("agent").decode(errors="replace")
+
+
+class ReplayState:
+    """
+    Offset reached in a log file, saved next to the other files of LOG_REPLAY_STATE_DIR
+    """
+
+    def __init__(self, fingerprint: str, state_dir: str = LOG_REPLAY_STATE_DIR):
+        os.makedirs(state_dir, exist_ok=True)
+        self.path = os.path.join(state_dir, f"{fingerprint}.json")
+        self.offset = 0
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.offset = json.load(f)["offset"]
+
+    def save(self, log_path: str, offset: int):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"file": log_path, "offset": offset}, f)
+        os.replace(tmp_path, self.path)
+        self.offset = offset
+
+
+def replay_file(path: str, batch_size: int = LOG_REPLAY_BATCH, state_dir: str = LOG_REPLAY_STATE_DIR) -> Dict:
+    """
+    Replay the pixel hits of one log file from its saved offset
+    :param path: string log file path, plain or gzip'd
+    :return: dict of counters of the file
+    """
+    stats = {"file": path, "lines": 0, "hits": 0, "machine": 0, "invalid": 0, "deduped": 0, "inserted": 0, "duplicated": 0, "unknown": 0, "inactive": 0}
+    fingerprint = file_fingerprint(path)
+    if fingerprint is None:
+        # Still being written, its fingerprint would change with the next lines
+        stats["deferred"] = True
+        return stats
+    state = ReplayState(fingerprint, state_dir)
+    stats["resumed_at"] = state.offset
+    window = datetime.timedelta(seconds=utils.PIXEL_DEDUPE_SECONDS)
+    classify = open_classifier.MACHINE_OPEN_MODE != "off"
+
+    db = database.SessionLocal()
+    try:
+        with _open(path) as f:
+            # Forward seek, a gzip'd file is decompressed up to the offset
+            f.seek(state.offset)
+            offset = state.offset
+            hits = []
+            for line in f:
+                line_offset = offset
+                offset += len(line)
+                stats["lines"] += 1
+                hit = parse_line(line)
+                if hit:
+                    pixel, view_datetime, client_host, user_agent = hit
+                    stats["hits"] += 1
+                    if utils.is_signed_pixel(pixel):
+                        ref = utils.verify_signed_pixel(pixel)
+                        if not ref:
+                            stats["invalid"] += 1
+                            continue
+                        pixel = ref.pixel_uuid
+                    machine_label = open_classifier.open_classifier.classify(client_host, user_agent) if classify else None
+                    if machine_label:
+                        stats["machine"] += 1
+                    hits.append((pixel, view_datetime, f"l:{fingerprint}:{line_offset}", machine_label))
+
+                if len(hits) >= batch_size:
+                    _write_batch(db, hits, window, stats)
+                    hits = []
+                    state.save(path, offset)
+
+            if hits:
+                _write_batch(db, hits, window, stats)
+            state.save(path, offset)
+    finally:
+        db.close()
+    return stats
+
+
+def _write_batch(db, hits: List, window: datetime.timedelta, stats: Dict):
+    hits.sort(key=lambda hit: hit[1])
+    kept = tracking.dedupe_hits(db, hits, window)
+    stats["deduped"] += len(hits) - len(kept)
+    result = tracking.record_views(db, [hit[:3] for hit in kept], {event_id: label for _, _, event_id, label in kept if label})
+    for name, count in result.items():
+        stats[name] += count
+
+
+def _init_worker():
+    if open_classifier.MACHINE_OPEN_MODE != "off":
+        try:
+            open_classifier.open_classifier.load()
+        except (OSError, ValueError) as e:
+            print(f"Error in machine open rules load: {e}")
+
+
+def _replay_file_safe(args) -> Dict:
+    path, batch_size, state_dir = args
+    try:
+        return replay_file(path, batch_size, state_dir)
+    except Exception as e:
+        print(f"Error in log replay of {path}: {e}")
+        return {"file": path, "error": str(e)}
+
+
+def replay_files(paths: List[str], workers: int = LOG_REPLAY_WORKERS, batch_size: int = LOG_REPLAY_BATCH, state_dir: str = LOG_REPLAY_STATE_DIR) -> List[Dict]:
+    """
+    Replay log files in parallel, one process per file
+    :return: list of the counters of each file
+    """
+    workers = max(1, min(workers, len(paths)))
+    jobs = [(path, batch_size, state_dir) for path in paths]
+    if workers == 1:
+        _init_worker()
+        return [_replay_file_safe(job) for job in jobs]
+    # Spawned, the API process forking with its background threads running is not safe
+    with multiprocessing.get_context("spawn").Pool(workers, initializer=_init_worker) as pool:
+        return pool.map(_replay_file_safe, jobs, chunksize=1)
+
+
+def _job_path(job_id: str, state_dir: str) -> str:
+    return os.path.join(state_dir, f"job-{job_id}.json")
+
+
+def _save_job(job: Dict, state_dir: str):
+    path = _job_path(job["job_id"], state_dir)
+    with open(path + ".tmp", "w") as f:
+        json.dump(job, f)
+    os.replace(path + ".tmp", path)
+
+
+def start_job(paths: List[str], workers: int = LOG_REPLAY_WORKERS, state_dir: str = LOG_REPLAY_STATE_DIR) -> str:
+    """
+    Replay log files in a background thread
+    :return: string id of the job, for get_job
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    job = {"job_id": os.urandom(8).hex(), "status": "running", "paths": paths, "started_datetime": datetime.datetime.utcnow().isoformat()}
+    _save_job(job, state_dir)
+
+    def run():
+        try:
+            job.update(status="done", files=replay_files(paths, workers, state_dir=state_dir))
+        except Exception as e:
+            print(f"Error in log replay job {job['job_id']}: {e}")
+            job.update(status="failed", error=str(e))
+        job["finished_datetime"] = datetime.datetime.utcnow().isoformat()
+        _save_job(job, state_dir)
+
+    threading.Thread(target=run, daemon=True).start()
+    return job["job_id"]
+
+
+def get_job(job_id: str, state_dir: str = LOG_REPLAY_STATE_DIR) -> Optional[Dict]:
+    """
+    :return: dict of the status of a job, with the counters of each file once done, None if unknown
+    """
+    if not re.fullmatch(r"[0-9a-f]{16}", job_id):
+        return None
+    try:
+        with open(_job_path(job_id, state_dir)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="access log files, plain or gzip'd")
+    parser.add_argument("--workers", type=int, default=LOG_REPLAY_WORKERS, help="files parsed in parallel")
+    parser.add_argument("--batch", type=int, default=LOG_REPLAY_BATCH, help="hits per bulk insert")
+    parser.add_argument("--state-dir", default=LOG_REPLAY_STATE_DIR, help="directory of the saved offsets")
+    args = parser.parse_args()
+
+    for stats in replay_files(args.paths, args.workers, args.batch, args.state_dir):
+        print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+"""
+Convert the uuid columns of an existing MySQL database to BINARY(16), for UUID_STORAGE=binary.
+
+    python migrate_binary_uuid.py --check     # count the values that are not uuids
+    python migrate_binary_uuid.py             # convert, then restart the API with UUID_STORAGE=binary
+
+Stop the API and the writers first. The foreign keys between the converted
+columns are saved to the uuid_migration_foreign_keys table, then dropped.
+Every column gets a BINARY(16) twin filled with UNHEX(REPLACE(uuid, '-', ''))
+in chunks of --chunk rows, walking the primary key. Each table then swaps the
+twin in with a single ALTER that also rebuilds its primary key and indexes,
+and the saved foreign keys are added back. Tables already converted and rows
+already filled are skipped, and the foreign keys dropped by an interrupted run
+are still saved, so such a run can be started again.
+
+With VIEW_SHARD_URLS set, the hit tables and their archives live on the
+shards of view_shards.py: the same conversion then runs on every shard for
+SHARD_UUID_COLUMNS, after the main database. Stop rebalance_views.py too, its
+progress in shard_moves is converted with them.
+"""
+import argparse
+import time
+from sqlalchemy import text
+import database
+import view_shards
+
+# (table, column) in dependency order, referenced columns first
+UUID_COLUMNS = [
+    ("contacts", "uuid"),
+    ("pixels", "uuid"),
+    ("pixels", "contact_uuid"),
+    ("views", "pixel_uuid"),
+    ("pixel_opens", "pixel_uuid"),
+    ("machine_opens", "pixel_uuid"),
+    ("views_monthly", "pixel_uuid"),
+    ("view_compactions", "last_pixel_uuid"),
+    ("contact_opens", "contact_uuid"),
+    # Archive tables of campaign_purge.py, without foreign keys
+    ("contacts_archive", "uuid"),
+    ("pixels_archive", "uuid"),
+    ("pixels_archive", "contact_uuid"),
+    ("views_archive", "pixel_uuid"),
+    ("pixel_opens_archive", "pixel_uuid"),
+    ("machine_opens_archive", "pixel_uuid"),
+    ("views_monthly_archive", "pixel_uuid"),
+]
+# Columns of the tables of view_shards.py, on every shard when sharded
+SHARD_UUID_COLUMNS = [
+    (table, column) for table, column in UUID_COLUMNS
+    if table.removesuffix("_archive") in {model.__tablename__ for model in view_shards.SHARDED_MODELS}
+] + [(view_shards.shard_moves.name, "last_pixel_uuid")]
+# Foreign keys dropped for the conversion, until they are added back
+SAVED_FOREIGN_KEYS = "uuid_migration_foreign_keys"
+UUID_REGEXP = "^[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}$"
+
+
+def table_exists(conn, table: str) -> bool:
+    return conn.execute(text(
+        "SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table"
+    ), {"table": table}).scalar() > 0
+
+
+def column_type(conn, table: str, column: str):
+    return conn.execute(text(
+        "SELECT DATA_TYPE FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND COLUMN_NAME = :column"
+    ), {"table": table, "column": column}).scalar()
+
+
+def is_nullable(conn, table: str, column: str) -> bool:
+    return conn.execute(text(
+        "SELECT IS_NULLABLE FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND COLUMN_NAME = :column"
+    ), {"table": table, "column": column}).scalar() == "YES"
+
+
+def foreign_keys(conn, columns):
+    """
+    :return: list of (table, constraint, column, referenced table, referenced column) touching one of the uuid columns
+    """
+    rows = conn.execute(text(
+        "SELECT TABLE_NAME, CONSTRAINT_NAME, COLUMN_NAME, REFERENCED_TABLE_NAME, REFERENCED_COLUMN_NAME "
+        "FROM information_schema.KEY_COLUMN_USAGE WHERE TABLE_SCHEMA = DATABASE() AND REFERENCED_TABLE_NAME IS NOT NULL"
+    )).all()
+    return [tuple(row) for row in rows if (row[0], row[2]) in columns or (row[3], row[4]) in columns]
+
+
+def indexes(conn, table: str):
+    """
+    :return: dict of index name to (unique, ordered columns)
+    """
+    result = {}
+    for name, non_unique, column in conn.execute(text(
+        "SELECT INDEX_NAME, NON_UNIQUE, COLUMN_NAME FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table ORDER BY INDEX_NAME, SEQ_IN_INDEX"
+    ), {"table": table}):
+        result.setdefault(name, (not non_unique, []))[1].append(column)
+    return result
+
+
+def check(conn, columns) -> int:
+    invalid = 0
+    for table, column in columns:
+        if column_type(conn, table, column) == "binary":
+            continue
+        count = conn.execute(text(f"SELECT COUNT(*) FROM `{table}` WHERE `{column}` NOT REGEXP :regexp"), {"regexp": UUID_REGEXP}).scalar()
+        print(f"{table}.{column}: {count} values are not uuids")
+        invalid += count
+    return invalid
+
+
+def save_foreign_keys(conn, fks):
+    """
+    Record foreign keys before dropping them, a run interrupted afterwards finds them there
+    """
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS `{SAVED_FOREIGN_KEYS}` ("
+        "table_name VARCHAR(64) NOT NULL, constraint_name VARCHAR(64) NOT NULL, column_name VARCHAR(64) NOT NULL, "
+        "referenced_table VARCHAR(64) NOT NULL, referenced_column VARCHAR(64) NOT NULL, PRIMARY KEY (table_name, constraint_name))"
+    ))
+    for table, constraint, column, referenced_table, referenced_column in fks:
+        conn.execute(text(
+            f"INSERT IGNORE INTO `{SAVED_FOREIGN_KEYS}` VALUES (:table, :constraint, :column, :referenced_table, :referenced_column)"
+        ), {"table": table, "constraint": constraint, "column": column, "referenced_table": referenced_table, "referenced_column": referenced_column})
+    conn.commit()
+
+
+def restore_foreign_keys(conn, columns):
+    """
+    Add back every saved foreign key still missing, then forget them
+    """
+    existing = {(table, constraint) for table, constraint, _, _, _ in foreign_keys(conn, columns)}
+    saved = conn.execute(text(
+        f"SELECT table_name, constraint_name, column_name, referenced_table, referenced_column FROM `{SAVED_FOREIGN_KEYS}`"
+    )).all()
+    for table, constraint, column, referenced_table, referenced_column in saved:
+        if (table, constraint) not in existing:
+            print(f"Adding foreign key {table}.{constraint}")
+            conn.execute(text(
+                f"ALTER TABLE `{table}` ADD CONSTRAINT `{constraint}` FOREIGN KEY (`{column}`) REFERENCES `{referenced_table}` (`{referenced_column}`)"
+            ))
+    conn.execute(text(f"DROP TABLE `{SAVED_FOREIGN_KEYS}`"))
+    conn.commit()
+
+
+def fill_twin(conn, table: str, column: str, chunk: int):
+    """
+    Fill the twin of a column chunk by chunk of primary keys, each chunk a range of the primary key index
+    """
+    twin = f"{column}_bin"
+    if column_type(conn, table, twin) is None:
+        conn.execute(text(f"ALTER TABLE `{table}` ADD COLUMN `{twin}` BINARY(16) NULL"))
+    primary_key = indexes(conn, table)["PRIMARY"][1]
+    key = ", ".join(f"`{name}`" for name in primary_key)
+
+    def row(prefix):
+        return "(" + ", ".join(f":{prefix}{i}" for i in range(len(primary_key))) + ")"
+
+    filled = 0
+    last = None
+    while True:
+        start = time.perf_counter()
+        params = {}
+        after = []
+        if last is not None:
+            after.append(f"({key}) > {row('k')}")
+            params.update({f"k{i}": value for i, value in enumerate(last)})
+        # Last key of the chunk, read from the primary key index
+        boundary = conn.execute(text(
+            f"SELECT {key} FROM `{table}` {'WHERE ' + after[0] if after else ''} ORDER BY {key} LIMIT 1 OFFSET {chunk - 1}"
+        ), params).first()
+        within = list(after)
+        if boundary is not None:
+            within.append(f"({key}) <= {row('b')}")
+            params.update({f"b{i}": value for i, value in enumerate(boundary)})
+        # Rows filled by an interrupted run are not written again
+        within.append(f"`{twin}` IS NULL")
+        updated = conn.execute(text(
+            f"UPDATE `{table}` SET `{twin}` = UNHEX(REPLACE(`{column}`, '-', '')) WHERE {' AND '.join(within)}"
+        ), params).rowcount
+        conn.commit()
+        filled += updated
+        if updated:
+            print(f"{table}.{column}: {filled} rows converted ({updated / (time.perf_counter() - start):.0f} rows/sec)")
+        if boundary is None:
+            return
+        last = tuple(boundary)
+
+
+def swap_twins(conn, table: str, columns):
+    """
+    Replace the columns by their twins and rebuild the keys using them in one ALTER
+    """
+    table_indexes = indexes(conn, table)
+    clauses = []
+    rebuilt = {name: definition for name, definition in table_indexes.items() if set(definition[1]) & set(columns)}
+    for name in rebuilt:
+        clauses.append("DROP PRIMARY KEY" if name == "PRIMARY" else f"DROP INDEX `{name}`")
+    for column in columns:
+        null = "NULL" if is_nullable(conn, table, column) else "NOT NULL"
+        clauses.append(f"DROP COLUMN `{column}`")
+        clauses.append(f"CHANGE COLUMN `{column}_bin` `{column}` BINARY(16) {null}")
+    for name, (unique, index_columns) in rebuilt.items():
+        column_list = ", ".join(f"`{column}`" for column in index_columns)
+        if name == "PRIMARY":
+            clauses.append(f"ADD PRIMARY KEY ({column_list})")
+        else:
+            clauses.append(f"ADD {'UNIQUE ' if unique else ''}INDEX `{name}` ({column_list})")
+    conn.execute(text(f"ALTER TABLE `{table}` " + ", ".join(clauses)))
+
+
+def convert(conn, columns, chunk: int):
+    """
+    Convert the uuid columns of one database, its foreign keys dropped meanwhile
+    :param columns: list of (table, column), those of missing tables are skipped
+    """
+    fks = foreign_keys(conn, columns)
+    save_foreign_keys(conn, fks)
+    for table, constraint, _, _, _ in fks:
+        print(f"Dropping foreign key {table}.{constraint}")
+        conn.execute(text(f"ALTER TABLE `{table}` DROP FOREIGN KEY `{constraint}`"))
+
+    pending = [(table, column) for table, column in columns if column_type(conn, table, column) != "binary"]
+    for table, column in pending:
+        fill_twin(conn, table, column, chunk)
+
+    for table in dict.fromkeys(table for table, _ in pending):
+        print(f"Swapping the binary columns of {table}")
+        swap_twins(conn, table, [column for pending_table, column in pending if pending_table == table])
+
+    restore_foreign_keys(conn, columns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--check", action="store_true", help="only count the values that are not uuids")
+    parser.add_argument("--chunk", type=int, default=50000, help="rows converted per UPDATE")
+    args = parser.parse_args()
+
+    # The main database, then every shard
+    targets = [("main database", database.engine, UUID_COLUMNS)]
+    targets += [(f"shard {name}", engine, SHARD_UUID_COLUMNS) for name, engine in view_shards.view_shards.engines.items()]
+    connections = [(name, engine.connect()) for name, engine, _ in targets]
+    try:
+        columns = {}
+        invalid = 0
+        for (name, conn), (_, _, candidates) in zip(connections, targets):
+            columns[name] = [(table, column) for table, column in candidates if table_exists(conn, table)]
+            print(f"Checking the {name}")
+            invalid += check(conn, columns[name])
+        if invalid:
+            print("Fix or delete the rows above before converting, their uuid cannot be stored in BINARY(16)")
+            return
+        if args.check:
+            return
+
+        for name, conn in connections:
+            print(f"Converting the {name}")
+            convert(conn, columns[name], args.chunk)
+    finally:
+        for _, conn in connections:
+            conn.close()
+
+    print("Done, restart the API with UUID_STORAGE=binary")
+
+
+if __name__ == "__main__":
+    main()
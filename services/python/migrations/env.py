@@ -0,0 +1,46 @@
+"""
+Alembic environment, migrating the database of database.py to the metadata of models.py.
+"""
+from logging.config import fileConfig
+from alembic import context
+import database
+import models
+
+config = context.config
+
+# The API runs the migrations at startup with its own logging
+if config.config_file_name is not None and not config.attributes.get("embedded"):
+    fileConfig(config.config_file_name)
+
+target_metadata = models.Base.metadata
+
+
+def run_migrations_offline():
+    """
+    Emit the SQL of the migrations without connecting, with alembic upgrade head --sql
+    """
+    context.configure(
+        dialect_name=database.engine.dialect.name,
+        target_metadata=target_metadata,
+        literal_binds=True
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    with database.engine.connect() as connection:
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            # ALTER of constraints is emulated by a table copy on SQLite
+            render_as_batch=connection.dialect.name == "sqlite"
+        )
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,130 @@
+"""Baseline schema, as created by models.Base.metadata.create_all before the migrations
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 15:00:00
+
+Databases created by create_all already have these tables, the revision
+leaves them as they are and the next revisions add what the models gained
+since, whichever version of the models created them.
+"""
+import os
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0001'
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# A new database in UUID_STORAGE=binary mode is created with binary uuid columns
+UUID_TYPE = sa.BINARY(16) if os.getenv("UUID_STORAGE", "string") == "binary" else sa.String(255)
+
+
+def upgrade() -> None:
+    if 'users' in sa.inspect(op.get_bind()).get_table_names():
+        return
+
+    op.create_table(
+        'users',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('uuid', sa.String(255), nullable=False),
+        sa.Column('name', sa.String(255), nullable=False),
+        sa.Column('surname', sa.String(255), nullable=False),
+        sa.Column('account_name', sa.String(255), nullable=False),
+        sa.Column('salt', sa.String(255), nullable=False),
+        sa.Column('password', sa.String(255), nullable=False),
+        sa.Column('email', sa.String(255), nullable=False),
+        sa.Column('grant_id', sa.Integer(), nullable=False),
+        sa.Column('created_datetime', sa.DateTime(), nullable=False),
+        sa.Column('deleted_datetime', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('account_name'),
+        sa.UniqueConstraint('email')
+    )
+    op.create_index('ix_users_id', 'users', ['id'])
+
+    op.create_table(
+        'logins',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('login_datetime', sa.DateTime(), nullable=False),
+        sa.Column('login_status', sa.Integer(), nullable=False),
+        sa.Column('token', sa.String(255), nullable=True),
+        sa.Column('token_expiry', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_logins_id', 'logins', ['id'])
+
+    op.create_table(
+        'campaigns',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('campaign_name', sa.String(255), nullable=False),
+        sa.Column('campaign_description', sa.Text(), nullable=False),
+        sa.Column('created_datetime', sa.DateTime(), nullable=False),
+        sa.Column('deleted_datetime', sa.DateTime(), nullable=True),
+        sa.Column('start_datetime', sa.DateTime(), nullable=False),
+        sa.Column('end_datetime', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_campaigns_id', 'campaigns', ['id'])
+
+    op.create_table(
+        'groups',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('campaign_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('campaign_group_id', sa.Integer(), nullable=False),
+        sa.Column('group_name', sa.String(255), nullable=False),
+        sa.Column('group_description', sa.Text(), nullable=True),
+        sa.Column('created_datetime', sa.DateTime(), nullable=False),
+        sa.Column('deleted_datetime', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['campaign_id'], ['campaigns.id']),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_groups_id', 'groups', ['id'])
+
+    op.create_table(
+        'contacts',
+        sa.Column('uuid', UUID_TYPE, autoincrement=False, nullable=False),
+        sa.Column('campaign_id', sa.Integer(), nullable=False),
+        sa.Column('group_id', sa.Integer(), nullable=False),
+        sa.Column('scheduled_datetime', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['campaign_id'], ['campaigns.id']),
+        sa.ForeignKeyConstraint(['group_id'], ['groups.id']),
+        sa.PrimaryKeyConstraint('uuid')
+    )
+    op.create_index('ix_contacts_uuid', 'contacts', ['uuid'])
+
+    op.create_table(
+        'pixels',
+        sa.Column('uuid', UUID_TYPE, autoincrement=False, nullable=False),
+        sa.Column('contact_uuid', UUID_TYPE, nullable=False),
+        sa.Column('contact_pixel_number', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['contact_uuid'], ['contacts.uuid']),
+        sa.PrimaryKeyConstraint('uuid')
+    )
+    op.create_index('ix_pixels_uuid', 'pixels', ['uuid'])
+
+    op.create_table(
+        'views',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('view_datetime', sa.DateTime(), nullable=False),
+        sa.Column('pixel_uuid', UUID_TYPE, nullable=False),
+        sa.ForeignKeyConstraint(['pixel_uuid'], ['pixels.uuid']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_views_id', 'views', ['id'])
+
+
+def downgrade() -> None:
+    for table in ('views', 'pixels', 'contacts', 'groups', 'campaigns', 'logins', 'users'):
+        op.drop_table(table)
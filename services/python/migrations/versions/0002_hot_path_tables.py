@@ -0,0 +1,71 @@
+"""Columns and tables of the pixel hot path: ordinals, event ids, machine labels, open summaries
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 15:00:00
+
+Databases created by create_all after some of these were added already have
+them, every column and table is only created when missing.
+"""
+import os
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0002'
+down_revision: Union[str, None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+UUID_TYPE = sa.BINARY(16) if os.getenv("UUID_STORAGE", "string") == "binary" else sa.String(255)
+
+
+def upgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    tables = inspector.get_table_names()
+
+    if 'ordinal' not in {column['name'] for column in inspector.get_columns('pixels')}:
+        op.add_column('pixels', sa.Column('ordinal', sa.Integer(), nullable=True))
+
+    views_columns = {column['name'] for column in inspector.get_columns('views')}
+    with op.batch_alter_table('views') as batch:
+        if 'event_id' not in views_columns:
+            batch.add_column(sa.Column('event_id', sa.String(64), nullable=True))
+            batch.create_unique_constraint('event_id', ['event_id'])
+        if 'machine_label' not in views_columns:
+            batch.add_column(sa.Column('machine_label', sa.String(32), nullable=True))
+
+    if 'pixel_opens' not in tables:
+        op.create_table(
+            'pixel_opens',
+            sa.Column('pixel_uuid', UUID_TYPE, autoincrement=False, nullable=False),
+            sa.Column('first_open', sa.DateTime(), nullable=False),
+            sa.Column('last_open', sa.DateTime(), nullable=False),
+            sa.Column('open_count', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['pixel_uuid'], ['pixels.uuid']),
+            sa.PrimaryKeyConstraint('pixel_uuid')
+        )
+
+    if 'machine_opens' not in tables:
+        op.create_table(
+            'machine_opens',
+            sa.Column('pixel_uuid', UUID_TYPE, autoincrement=False, nullable=False),
+            sa.Column('label', sa.String(32), autoincrement=False, nullable=False),
+            sa.Column('last_open', sa.DateTime(), nullable=False),
+            sa.Column('open_count', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['pixel_uuid'], ['pixels.uuid']),
+            sa.PrimaryKeyConstraint('pixel_uuid', 'label')
+        )
+
+
+def downgrade() -> None:
+    op.drop_table('machine_opens')
+    op.drop_table('pixel_opens')
+    with op.batch_alter_table('views') as batch:
+        batch.drop_column('machine_label')
+        batch.drop_constraint('event_id', type_='unique')
+        batch.drop_column('event_id')
+    op.drop_column('pixels', 'ordinal')
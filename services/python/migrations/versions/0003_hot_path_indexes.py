@@ -0,0 +1,56 @@
+"""Indexes of the columns filtered on by the endpoints, unique pixel number per contact
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 15:00:00
+
+On MySQL the foreign keys of views.pixel_uuid, pixels.contact_uuid and
+contacts.group_id / campaign_id had an index created implicitly with the key,
+InnoDB drops it when the explicit index that can replace it is added.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0003'
+down_revision: Union[str, None] = '0002'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (index name, table, columns) of the indexes that take over a foreign key index on MySQL
+FOREIGN_KEY_INDEXES = [
+    ('ix_views_pixel_uuid', 'views', ['pixel_uuid']),
+    ('ix_contacts_group_id', 'contacts', ['group_id']),
+    ('ix_contacts_campaign_id', 'contacts', ['campaign_id']),
+]
+
+
+def upgrade() -> None:
+    duplicates = op.get_bind().execute(sa.text(
+        "SELECT COUNT(*) FROM (SELECT contact_uuid FROM pixels GROUP BY contact_uuid, contact_pixel_number HAVING COUNT(*) > 1) AS duplicated"
+    )).scalar()
+    if duplicates:
+        raise RuntimeError(f"{duplicates} (contact_uuid, contact_pixel_number) pairs have more than one pixel, delete the extra pixels before upgrading")
+
+    for name, table, columns in FOREIGN_KEY_INDEXES:
+        op.create_index(name, table, columns)
+    op.create_index('ix_campaigns_campaign_name', 'campaigns', ['campaign_name'])
+    with op.batch_alter_table('pixels') as batch:
+        batch.create_unique_constraint('uq_pixels_contact_pixel_number', ['contact_uuid', 'contact_pixel_number'])
+
+
+def downgrade() -> None:
+    mysql = op.get_bind().dialect.name == 'mysql'
+    # InnoDB refuses to drop the only index of a foreign key, the implicit one is put back first
+    if mysql:
+        op.create_index('contact_uuid', 'pixels', ['contact_uuid'])
+    with op.batch_alter_table('pixels') as batch:
+        batch.drop_constraint('uq_pixels_contact_pixel_number', type_='unique')
+    op.drop_index('ix_campaigns_campaign_name', 'campaigns')
+    for name, table, columns in FOREIGN_KEY_INDEXES:
+        if mysql:
+            op.create_index(columns[0], table, columns)
+        op.drop_index(name, table)
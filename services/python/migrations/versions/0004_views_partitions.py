@@ -0,0 +1,98 @@
+"""Monthly partitions of views, compacted views and compaction progress tables
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 16:00:00
+
+On MySQL views is partitioned by RANGE COLUMNS(view_datetime), one partition
+per month from the oldest view to three months ahead, plus a catch-all
+partition split by view_retention.py as months go by. Every unique key of a
+partitioned table must hold the partitioning column, so the primary key
+becomes (id, view_datetime) and the event_id unique key (event_id,
+view_datetime), an event id always comes with the same view datetime. InnoDB
+does not support foreign keys on partitioned tables, the one of pixel_uuid is
+dropped. The conversion copies the table once and blocks the writes to views
+meanwhile, run it with the API in VIEW_WRITE_MODE=stream so the hits queue in
+the Redis stream until it is done.
+"""
+import datetime
+import os
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0004'
+down_revision: Union[str, None] = '0003'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+UUID_TYPE = sa.BINARY(16) if os.getenv("UUID_STORAGE", "string") == "binary" else sa.String(255)
+PARTITIONS_AHEAD = 3
+
+
+def _add_months(month: datetime.datetime, count: int) -> datetime.datetime:
+    index = month.year * 12 + month.month - 1 + count
+    return datetime.datetime(index // 12, index % 12 + 1, 1)
+
+
+def upgrade() -> None:
+    op.create_table(
+        'views_monthly',
+        sa.Column('month', sa.Date(), autoincrement=False, nullable=False),
+        sa.Column('pixel_uuid', UUID_TYPE, autoincrement=False, nullable=False),
+        sa.Column('machine_label', sa.String(32), autoincrement=False, nullable=False),
+        sa.Column('view_count', sa.Integer(), nullable=False),
+        sa.Column('first_view', sa.DateTime(), nullable=False),
+        sa.Column('last_view', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('month', 'pixel_uuid', 'machine_label')
+    )
+    op.create_table(
+        'view_compactions',
+        sa.Column('range_end', sa.DateTime(), autoincrement=False, nullable=False),
+        sa.Column('range_start', sa.DateTime(), nullable=True),
+        sa.Column('max_view_id', sa.Integer(), nullable=False),
+        sa.Column('last_pixel_uuid', UUID_TYPE, nullable=True),
+        sa.Column('compacted_rows', sa.Integer(), nullable=False),
+        sa.Column('aggregated_datetime', sa.DateTime(), nullable=True),
+        sa.Column('completed_datetime', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('range_end')
+    )
+
+    bind = op.get_bind()
+    if bind.dialect.name != 'mysql':
+        return
+
+    inspector = sa.inspect(bind)
+    for foreign_key in inspector.get_foreign_keys('views'):
+        op.drop_constraint(foreign_key['name'], 'views', type_='foreignkey')
+    event_id_index = next(index['name'] for index in inspector.get_indexes('views') if index['column_names'] == ['event_id'])
+
+    oldest = bind.execute(sa.text("SELECT MIN(view_datetime) FROM views")).scalar() or datetime.datetime.utcnow()
+    month = datetime.datetime(oldest.year, oldest.month, 1)
+    now = datetime.datetime.utcnow()
+    last = _add_months(datetime.datetime(now.year, now.month, 1), PARTITIONS_AHEAD)
+    partitions = []
+    while month <= last:
+        partitions.append(f"PARTITION p{month:%Y%m} VALUES LESS THAN ('{_add_months(month, 1):%Y-%m-%d}')")
+        month = _add_months(month, 1)
+    partitions.append("PARTITION pmax VALUES LESS THAN (MAXVALUE)")
+
+    op.execute(
+        f"ALTER TABLE views DROP PRIMARY KEY, ADD PRIMARY KEY (id, view_datetime), "
+        f"DROP INDEX `{event_id_index}`, ADD UNIQUE INDEX uq_views_event_id (event_id, view_datetime) "
+        f"PARTITION BY RANGE COLUMNS(view_datetime) ({', '.join(partitions)})"
+    )
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name == 'mysql':
+        op.execute(
+            "ALTER TABLE views DROP PRIMARY KEY, ADD PRIMARY KEY (id), "
+            "DROP INDEX uq_views_event_id, ADD UNIQUE INDEX event_id (event_id) REMOVE PARTITIONING"
+        )
+        op.create_foreign_key(None, 'views', 'pixels', ['pixel_uuid'], ['uuid'])
+    op.drop_table('view_compactions')
+    op.drop_table('views_monthly')
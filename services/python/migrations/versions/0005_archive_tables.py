@@ -0,0 +1,115 @@
+"""Archive tables of the campaign subtrees purged by campaign_purge.py
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 18:00:00
+
+Each archive table has the columns and primary key of its table plus
+archived_datetime, without foreign keys nor secondary indexes, so archiving a
+row never depends on its parents being archived first.
+"""
+import os
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0005'
+down_revision: Union[str, None] = '0004'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+UUID_TYPE = sa.BINARY(16) if os.getenv("UUID_STORAGE", "string") == "binary" else sa.String(255)
+
+
+def upgrade() -> None:
+    op.create_table(
+        'campaigns_archive',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('campaign_name', sa.String(255), nullable=False),
+        sa.Column('campaign_description', sa.Text(), nullable=False),
+        sa.Column('created_datetime', sa.DateTime(), nullable=False),
+        sa.Column('deleted_datetime', sa.DateTime(), nullable=True),
+        sa.Column('start_datetime', sa.DateTime(), nullable=False),
+        sa.Column('end_datetime', sa.DateTime(), nullable=False),
+        sa.Column('archived_datetime', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'groups_archive',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('campaign_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('campaign_group_id', sa.Integer(), nullable=False),
+        sa.Column('group_name', sa.String(255), nullable=False),
+        sa.Column('group_description', sa.Text(), nullable=True),
+        sa.Column('created_datetime', sa.DateTime(), nullable=False),
+        sa.Column('deleted_datetime', sa.DateTime(), nullable=True),
+        sa.Column('archived_datetime', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'contacts_archive',
+        sa.Column('uuid', UUID_TYPE, autoincrement=False, nullable=False),
+        sa.Column('campaign_id', sa.Integer(), nullable=False),
+        sa.Column('group_id', sa.Integer(), nullable=False),
+        sa.Column('scheduled_datetime', sa.DateTime(), nullable=False),
+        sa.Column('archived_datetime', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('uuid')
+    )
+    op.create_table(
+        'pixels_archive',
+        sa.Column('uuid', UUID_TYPE, autoincrement=False, nullable=False),
+        sa.Column('contact_uuid', UUID_TYPE, nullable=False),
+        sa.Column('contact_pixel_number', sa.Integer(), nullable=False),
+        sa.Column('ordinal', sa.Integer(), nullable=True),
+        sa.Column('archived_datetime', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('uuid')
+    )
+    op.create_table(
+        'views_archive',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('view_datetime', sa.DateTime(), nullable=False),
+        sa.Column('pixel_uuid', UUID_TYPE, nullable=False),
+        sa.Column('event_id', sa.String(64), nullable=True),
+        sa.Column('machine_label', sa.String(32), nullable=True),
+        sa.Column('archived_datetime', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'pixel_opens_archive',
+        sa.Column('pixel_uuid', UUID_TYPE, autoincrement=False, nullable=False),
+        sa.Column('first_open', sa.DateTime(), nullable=False),
+        sa.Column('last_open', sa.DateTime(), nullable=False),
+        sa.Column('open_count', sa.Integer(), nullable=False),
+        sa.Column('archived_datetime', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('pixel_uuid')
+    )
+    op.create_table(
+        'machine_opens_archive',
+        sa.Column('pixel_uuid', UUID_TYPE, autoincrement=False, nullable=False),
+        sa.Column('label', sa.String(32), autoincrement=False, nullable=False),
+        sa.Column('last_open', sa.DateTime(), nullable=False),
+        sa.Column('open_count', sa.Integer(), nullable=False),
+        sa.Column('archived_datetime', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('pixel_uuid', 'label')
+    )
+    op.create_table(
+        'views_monthly_archive',
+        sa.Column('month', sa.Date(), autoincrement=False, nullable=False),
+        sa.Column('pixel_uuid', UUID_TYPE, autoincrement=False, nullable=False),
+        sa.Column('machine_label', sa.String(32), autoincrement=False, nullable=False),
+        sa.Column('view_count', sa.Integer(), nullable=False),
+        sa.Column('first_view', sa.DateTime(), nullable=False),
+        sa.Column('last_view', sa.DateTime(), nullable=False),
+        sa.Column('archived_datetime', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('month', 'pixel_uuid', 'machine_label')
+    )
+
+
+def downgrade() -> None:
+    for table in ['views_monthly_archive', 'machine_opens_archive', 'pixel_opens_archive', 'views_archive', 'pixels_archive', 'contacts_archive', 'groups_archive', 'campaigns_archive']:
+        op.drop_table(table)
@@ -0,0 +1,47 @@
+"""Open rate rollups per campaign, group and hour, first open of each contact
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 20:00:00
+
+The tables are created empty, fill them from the existing views and contacts
+with python open_rollups.py --all --repair.
+"""
+import os
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0006'
+down_revision: Union[str, None] = '0005'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+UUID_TYPE = sa.BINARY(16) if os.getenv("UUID_STORAGE", "string") == "binary" else sa.String(255)
+
+
+def upgrade() -> None:
+    op.create_table(
+        'open_rollups',
+        sa.Column('campaign_id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('group_id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('hour', sa.DateTime(), autoincrement=False, nullable=False),
+        sa.Column('opens', sa.Integer(), nullable=False),
+        sa.Column('opened_contacts', sa.Integer(), nullable=False),
+        sa.Column('sent_contacts', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('campaign_id', 'group_id', 'hour')
+    )
+    op.create_table(
+        'contact_opens',
+        sa.Column('contact_uuid', UUID_TYPE, autoincrement=False, nullable=False),
+        sa.Column('first_open', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('contact_uuid')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('contact_opens')
+    op.drop_table('open_rollups')
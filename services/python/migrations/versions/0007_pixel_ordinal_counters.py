@@ -0,0 +1,35 @@
+"""Counter of the next pixel ordinal of each campaign
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 21:00:00
+
+The counters start after the highest ordinal of the pixels of each campaign,
+ordinals are then reserved by advancing them instead of reading that maximum.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0007'
+down_revision: Union[str, None] = '0006'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('campaigns', sa.Column('next_pixel_ordinal', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('campaigns_archive', sa.Column('next_pixel_ordinal', sa.Integer(), nullable=False, server_default='0'))
+    op.execute(
+        "UPDATE campaigns SET next_pixel_ordinal = COALESCE(("
+        "SELECT MAX(pixels.ordinal) + 1 FROM pixels JOIN contacts ON pixels.contact_uuid = contacts.uuid "
+        "WHERE contacts.campaign_id = campaigns.id), 0)"
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('campaigns_archive', 'next_pixel_ordinal')
+    op.drop_column('campaigns', 'next_pixel_ordinal')
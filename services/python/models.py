@@ -1,8 +1,36 @@
-from sqlalchemy import Column, Integer, String, Float, Date, DateTime, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, Float, Date, DateTime, ForeignKey, Text, BINARY, UniqueConstraint, Table
+from sqlalchemy.types import TypeDecorator
 import datetime
+import os
+import uuid
 from database import Base
 from sqlalchemy.orm import relationship
 
+# "string" stores the contact and pixel uuids as VARCHAR(255), "binary" as BINARY(16),
+# an existing database is converted with migrate_binary_uuid.py
+UUID_STORAGE = os.getenv("UUID_STORAGE", "string")
+
+class BinaryUUID(TypeDecorator):
+    """
+    UUID stored in 16 bytes, bound and returned as its canonical string
+    """
+    impl = BINARY(16)
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        # Raises ValueError for anything else than a UUID
+        return uuid.UUID(str(value)).bytes
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return str(uuid.UUID(bytes=bytes(value)))
+
+def uuid_type():
+    return BinaryUUID() if UUID_STORAGE == "binary" else String(255)
+
 class Users(Base):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True, index=True, autoincrement=True, nullable=False)
@@ -36,12 +64,14 @@ class Campaigns(Base):
     __tablename__ = 'campaigns'
     id = Column(Integer, primary_key=True, index=True, autoincrement=True, nullable=False)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
-    campaign_name = Column(String(255), nullable=False)
+    campaign_name = Column(String(255), nullable=False, index=True)
     campaign_description = Column(Text, nullable=False, default=None)
     created_datetime = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
     deleted_datetime = Column(DateTime, nullable=True, default=None)
     start_datetime = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
     end_datetime = Column(DateTime, nullable=False, default=(datetime.datetime.utcnow() + datetime.timedelta(days=30)))
+    # Next ordinal given to a pixel of the campaign, see utils.allocate_pixel_ordinals
+    next_pixel_ordinal = Column(Integer, nullable=False, default=0)
 
     groups = relationship("Groups", back_populates="campaigns")
     contacts = relationship("Contacts", back_populates="campaigns")
@@ -64,9 +94,9 @@ class Groups(Base):
 
 class Contacts(Base):
     __tablename__ = 'contacts'
-    uuid = Column(String(255), primary_key=True, index=True, autoincrement=False, nullable=False)
-    campaign_id = Column(Integer, ForeignKey('campaigns.id'), nullable=False)
-    group_id = Column(Integer, ForeignKey('groups.id'), nullable=False)
+    uuid = Column(uuid_type(), primary_key=True, index=True, autoincrement=False, nullable=False)
+    campaign_id = Column(Integer, ForeignKey('campaigns.id'), nullable=False, index=True)
+    group_id = Column(Integer, ForeignKey('groups.id'), nullable=False, index=True)
     scheduled_datetime = Column(DateTime, nullable=False)
 
     groups = relationship("Groups", back_populates="contacts")
@@ -75,17 +105,100 @@ class Contacts(Base):
 
 class Pixels(Base):
     __tablename__ = 'pixels'
-    uuid = Column(String(255), primary_key=True, index=True, autoincrement=False, nullable=False)
-    contact_uuid = Column(String(255), ForeignKey('contacts.uuid'), nullable=False)
+    __table_args__ = (UniqueConstraint('contact_uuid', 'contact_pixel_number', name='uq_pixels_contact_pixel_number'),)
+    uuid = Column(uuid_type(), primary_key=True, index=True, autoincrement=False, nullable=False)
+    contact_uuid = Column(uuid_type(), ForeignKey('contacts.uuid'), nullable=False)
     contact_pixel_number = Column(Integer, nullable=False)
+    # Dense position of the pixel in its campaign, indexes the dedupe bitmaps
+    ordinal = Column(Integer, nullable=True, default=None)
 
     contacts = relationship("Contacts", back_populates="pixels")
     views = relationship("Views", back_populates="pixels")
+    opens = relationship("PixelOpens", back_populates="pixels", uselist=False)
+    machine_opens = relationship("MachineOpens", back_populates="pixels")
 
 class Views(Base):
+    # On MySQL the table is partitioned by month of view_datetime (migration 0004), its primary
+    # key and event_id unique key then also hold view_datetime and pixel_uuid has no foreign key
     __tablename__ = 'views'
     id = Column(Integer, primary_key=True, index=True, autoincrement=True, nullable=False)
     view_datetime = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
-    pixel_uuid = Column(String(255), ForeignKey('pixels.uuid'), nullable=False)
+    pixel_uuid = Column(uuid_type(), ForeignKey('pixels.uuid'), nullable=False, index=True)
+    event_id = Column(String(64), nullable=True, unique=True, default=None)
+    # Label of the proxy, prefetcher or scanner of a machine open, None for a human open
+    machine_label = Column(String(32), nullable=True, default=None)
 
     pixels = relationship("Pixels", back_populates="views")
+
+class PixelOpens(Base):
+    __tablename__ = 'pixel_opens'
+    pixel_uuid = Column(uuid_type(), ForeignKey('pixels.uuid'), primary_key=True, autoincrement=False, nullable=False)
+    first_open = Column(DateTime, nullable=False)
+    last_open = Column(DateTime, nullable=False)
+    open_count = Column(Integer, nullable=False, default=0)
+
+    pixels = relationship("Pixels", back_populates="opens")
+
+class MachineOpens(Base):
+    __tablename__ = 'machine_opens'
+    pixel_uuid = Column(uuid_type(), ForeignKey('pixels.uuid'), primary_key=True, autoincrement=False, nullable=False)
+    label = Column(String(32), primary_key=True, autoincrement=False, nullable=False)
+    last_open = Column(DateTime, nullable=False)
+    open_count = Column(Integer, nullable=False, default=0)
+
+    pixels = relationship("Pixels", back_populates="machine_opens")
+
+class ViewsMonthly(Base):
+    # Views compacted by view_retention.py once their month is past the retention
+    __tablename__ = 'views_monthly'
+    month = Column(Date, primary_key=True, autoincrement=False, nullable=False)
+    pixel_uuid = Column(uuid_type(), primary_key=True, autoincrement=False, nullable=False)
+    # Empty for human opens
+    machine_label = Column(String(32), primary_key=True, autoincrement=False, nullable=False, default="")
+    view_count = Column(Integer, nullable=False, default=0)
+    first_view = Column(DateTime, nullable=False)
+    last_view = Column(DateTime, nullable=False)
+
+class ViewCompactions(Base):
+    # Progress of the compaction of the views from range_start to range_end, resumed after an interruption
+    __tablename__ = 'view_compactions'
+    range_end = Column(DateTime, primary_key=True, autoincrement=False, nullable=False)
+    # None for the first range, which takes every older view
+    range_start = Column(DateTime, nullable=True, default=None)
+    # Views written in the range after the compaction started are left raw
+    max_view_id = Column(Integer, nullable=False, default=0)
+    last_pixel_uuid = Column(uuid_type(), nullable=True, default=None)
+    compacted_rows = Column(Integer, nullable=False, default=0)
+    # Set once every view of the range is in views_monthly, then once the raw views are dropped
+    aggregated_datetime = Column(DateTime, nullable=True, default=None)
+    completed_datetime = Column(DateTime, nullable=True, default=None)
+
+class OpenRollups(Base):
+    # Human opens, first opened contacts and scheduled contacts per campaign, group and hour,
+    # maintained by open_rollups.py as hits are recorded and contacts written
+    __tablename__ = 'open_rollups'
+    campaign_id = Column(Integer, primary_key=True, autoincrement=False, nullable=False)
+    group_id = Column(Integer, primary_key=True, autoincrement=False, nullable=False)
+    hour = Column(DateTime, primary_key=True, autoincrement=False, nullable=False)
+    opens = Column(Integer, nullable=False, default=0)
+    opened_contacts = Column(Integer, nullable=False, default=0)
+    sent_contacts = Column(Integer, nullable=False, default=0)
+
+class ContactOpens(Base):
+    # First human open of each opened contact, which counts it once in open_rollups.opened_contacts
+    __tablename__ = 'contact_opens'
+    contact_uuid = Column(uuid_type(), primary_key=True, autoincrement=False, nullable=False)
+    first_open = Column(DateTime, nullable=False)
+
+def archive_table(model):
+    """
+    Table receiving the rows of a model archived by campaign_purge.py, with its columns and primary key only
+    """
+    columns = [
+        Column(column.name, column.type, primary_key=column.primary_key, autoincrement=False, nullable=column.nullable)
+        for column in model.__table__.columns
+    ]
+    return Table(f"{model.__tablename__}_archive", Base.metadata, *columns, Column("archived_datetime", DateTime, nullable=False))
+
+# Archive of each table of a campaign subtree, created by migration 0005
+archive_tables = {model: archive_table(model) for model in [Campaigns, Groups, Contacts, Pixels, Views, PixelOpens, MachineOpens, ViewsMonthly]}
@@ -0,0 +1,294 @@
+"""
+Classifier of machine opens: image proxies, privacy prefetchers and security scanners.
+
+The client ip is matched against a binary radix trie of CIDR ranges and the
+User-Agent against a single precompiled regex, both built from the JSON rules
+file MACHINE_OPEN_RULES:
+
+    {"rules": [{"label": "google_image_proxy", "cidrs": ["66.102.0.0/20"], "user_agents": ["GoogleImageProxy"]}]}
+
+The file is watched and reloaded at runtime, a new classifier is built aside
+and swapped in, so hits never see a half loaded rule set.
+
+Classification is opt-in: the default MACHINE_OPEN_MODE=off counts every open
+as a human one, as before the classifier existed, since Gmail opens only show
+up through its image proxy. With MACHINE_OPEN_MODE=tag machine opens are
+deduplicated apart from human opens and recorded as Views rows carrying their
+label, with count they only increment the per pixel and label counters of the
+machine_opens table, which are aggregated in memory and flushed every
+MACHINE_OPEN_FLUSH_SECONDS.
+"""
+import datetime
+import ipaddress
+import json
+import os
+import re
+import socket
+import threading
+import time
+from sqlalchemy import func
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+import database
+import models
+import utils
+import view_shards
+
+# "off", "tag" or "count"
+MACHINE_OPEN_MODE = os.getenv("MACHINE_OPEN_MODE", "off")
+MACHINE_OPEN_RULES = os.getenv("MACHINE_OPEN_RULES", "machine_opens.json")
+MACHINE_OPEN_RELOAD_SECONDS = int(os.getenv("MACHINE_OPEN_RELOAD_SECONDS", 10))
+MACHINE_OPEN_FLUSH_SECONDS = int(os.getenv("MACHINE_OPEN_FLUSH_SECONDS", 10))
+
+IPV4_MAPPED_PREFIX = b"\x00" * 10 + b"\xff\xff"
+
+
+class CidrTrie:
+    """
+    Binary radix trie of CIDR ranges, a lookup returns the label of the longest matching prefix
+    """
+
+    def __init__(self):
+        # A node is [child for bit 0, child for bit 1, label]
+        self.roots = {4: [None, None, None], 6: [None, None, None]}
+        self.count = 0
+
+    def insert(self, cidr: str, label: str):
+        network = ipaddress.ip_network(cidr, strict=False)
+        node = self.roots[network.version]
+        bits = network.max_prefixlen
+        value = int(network.network_address)
+        for i in range(network.prefixlen):
+            bit = (value >> (bits - 1 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        node[2] = label
+        self.count += 1
+
+    def lookup(self, host: str):
+        # inet_pton is an order of magnitude faster than ipaddress on the hot path
+        try:
+            packed = socket.inet_pton(socket.AF_INET, host)
+            version, bits = 4, 32
+        except OSError:
+            try:
+                packed = socket.inet_pton(socket.AF_INET6, host)
+                version, bits = 6, 128
+            except OSError:
+                return None
+            if packed[:12] == IPV4_MAPPED_PREFIX:
+                packed, version, bits = packed[12:], 4, 32
+
+        node = self.roots[version]
+        label = node[2]
+        value = int.from_bytes(packed, "big")
+        for shift in range(bits - 1, -1, -1):
+            node = node[(value >> shift) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                label = node[2]
+        return label
+
+
+class UserAgentMatcher:
+    """
+    All the User-Agent patterns compiled in a single alternation of named groups
+    """
+
+    def __init__(self, patterns):
+        """
+        :param patterns: list of (label, regex)
+        """
+        self.labels = {}
+        groups = []
+        for i, (label, pattern) in enumerate(patterns):
+            self.labels[f"r{i}"] = label
+            groups.append(f"(?P<r{i}>{pattern})")
+        self.regex = re.compile("|".join(groups), re.IGNORECASE) if groups else None
+
+    def match(self, user_agent: str):
+        if self.regex is None or not user_agent:
+            return None
+        m = self.regex.search(user_agent)
+        return self.labels[m.lastgroup] if m else None
+
+
+class OpenClassifier:
+    """
+    Rules of the machine opens, reloaded when the rules file changes
+    """
+
+    def __init__(self, path: str = MACHINE_OPEN_RULES):
+        self.path = path
+        self.rules = (CidrTrie(), UserAgentMatcher([]))
+        self.stats = utils.StatsCounter("human", "machine", "reloads", "reload_errors")
+        self.labels = utils.StatsCounter()
+        self.mtime = None
+
+    def classify(self, client_host: str, user_agent: str):
+        """
+        :return: string label of a machine open, None for a human open
+        """
+        cidrs, user_agents = self.rules
+        label = cidrs.lookup(client_host) or user_agents.match(user_agent)
+        if label:
+            self.stats.incr("machine")
+            self.labels.incr(label)
+        else:
+            self.stats.incr("human")
+        return label
+
+    def load(self, path: str = None):
+        """
+        Build the trie and the matcher of a rules file and swap them in
+        :raise OSError, ValueError: if the file cannot be read or has an invalid rule
+        """
+        path = path or self.path
+        with open(path) as f:
+            config = json.load(f)
+
+        cidrs = CidrTrie()
+        patterns = []
+        for rule in config.get("rules", []):
+            for cidr in rule.get("cidrs", []):
+                cidrs.insert(cidr, rule["label"])
+            for pattern in rule.get("user_agents", []):
+                patterns.append((rule["label"], pattern))
+        try:
+            user_agents = UserAgentMatcher(patterns)
+        except re.error as e:
+            raise ValueError(f"Invalid user agent pattern: {e}")
+
+        self.rules = (cidrs, user_agents)
+        self.path = path
+        self.stats.incr("reloads")
+
+    def _watch_loop(self):
+        while True:
+            try:
+                mtime = os.path.getmtime(self.path)
+                if mtime != self.mtime:
+                    self.load()
+                    self.mtime = mtime
+            except Exception as e:
+                # Keep the previous rules until the file is fixed
+                self.stats.incr("reload_errors")
+                print(f"Error in machine open rules reload: {e}")
+            time.sleep(MACHINE_OPEN_RELOAD_SECONDS)
+
+    def start(self):
+        threading.Thread(target=self._watch_loop, daemon=True).start()
+
+    def get_stats(self) -> dict:
+        cidrs, user_agents = self.rules
+        return dict(
+            self.stats.snapshot(),
+            mode=MACHINE_OPEN_MODE,
+            rules_file=self.path,
+            cidrs=cidrs.count,
+            user_agent_patterns=len(user_agents.labels),
+            labels=self.labels.snapshot()
+        )
+
+
+class MachineOpenCounter:
+    """
+    In-memory counts of the machine opens per pixel and label, flushed in one upsert
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.stats = utils.StatsCounter("flushes", "flushed", "unknown", "flush_errors")
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def add(self, pixel_uuid: str, label: str, view_datetime: datetime.datetime = None):
+        view_datetime = view_datetime or datetime.datetime.utcnow()
+        with self._lock:
+            count, _ = self.counts.get((pixel_uuid, label), (0, None))
+            self.counts[(pixel_uuid, label)] = (count + 1, view_datetime)
+
+    def _upsert(self, db, rows):
+        table = models.MachineOpens
+        if db.get_bind().dialect.name == "mysql":
+            stmt = mysql_insert(table).values(rows)
+            stmt = stmt.on_duplicate_key_update(
+                last_open=func.greatest(table.last_open, stmt.inserted.last_open),
+                open_count=table.open_count + stmt.inserted.open_count
+            )
+        else:
+            stmt = sqlite_insert(table).values(rows)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.pixel_uuid, table.label],
+                set_={
+                    "last_open": func.max(table.last_open, stmt.excluded.last_open),
+                    "open_count": table.open_count + stmt.excluded.open_count
+                }
+            )
+        db.execute(stmt)
+
+    def flush(self) -> int:
+        """
+        Write the pending counts of the known pixels
+        :return: number of counter rows written
+        """
+        with self._lock:
+            counts, self.counts = self.counts, {}
+        if not counts:
+            return 0
+
+        db = database.SessionLocal()
+        try:
+            pixel_uuids = list({pixel_uuid for pixel_uuid, _ in counts if utils.is_storable_uuid(pixel_uuid)})
+            known = {row.uuid for row in db.query(models.Pixels.uuid).filter(models.Pixels.uuid.in_(pixel_uuids))}
+            rows = [
+                {"pixel_uuid": pixel_uuid, "label": label, "last_open": last_open, "open_count": count}
+                for (pixel_uuid, label), (count, last_open) in counts.items() if pixel_uuid in known
+            ]
+            for shard, shard_rows in view_shards.view_shards.by_shard(rows, key=lambda row: row["pixel_uuid"]).items():
+                with view_shards.view_shards.session(db, shard) as hit_db:
+                    self._upsert(hit_db, shard_rows)
+                    hit_db.commit()
+        except Exception:
+            # Put the counts back for the next flush
+            with self._lock:
+                for key, (count, last_open) in counts.items():
+                    pending, pending_last_open = self.counts.get(key, (0, last_open))
+                    self.counts[key] = (pending + count, max(pending_last_open, last_open))
+            raise
+        finally:
+            db.close()
+
+        self.stats.incr("flushes")
+        self.stats.incr("flushed", len(rows))
+        self.stats.incr("unknown", len(counts) - len(rows))
+        return len(rows)
+
+    def _flush_loop(self):
+        while not self._stop.wait(MACHINE_OPEN_FLUSH_SECONDS):
+            try:
+                self.flush()
+            except Exception as e:
+                self.stats.incr("flush_errors")
+                print(f"Error in machine opens flush: {e}")
+
+    def start(self):
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Error in machine opens flush: {e}")
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            pending = len(self.counts)
+        return dict(self.stats.snapshot(), pending=pending)
+
+
+open_classifier = OpenClassifier()
+machine_opens = MachineOpenCounter()
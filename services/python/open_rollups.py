@@ -0,0 +1,377 @@
+"""
+Open rate rollups per campaign, group and hour, and their consistency check.
+
+open_rollups holds, for each (campaign_id, group_id, hour):
+    opens            human opens recorded in the hour
+    opened_contacts  contacts whose first human open is in the hour
+    sent_contacts    contacts scheduled in the hour
+so the open rates of a campaign, of its groups and of any range of hours are
+sums over its buckets, whatever the number of views. contact_opens keeps the
+first open of each contact, a contact is counted once over all the hours.
+
+The rows are updated incrementally, on the main database: by the hit paths of
+tracking.py once the hits are written, and by the contact writes in the same
+transaction as the contacts. A failed update of the hit paths is only logged,
+the check below finds and fixes the buckets it left behind:
+    python open_rollups.py --campaign 12
+    python open_rollups.py --all --repair
+
+The check recomputes the buckets of a campaign from the contacts and the raw
+views on their shards, walking the contacts by uuid in chunks of
+OPEN_ROLLUP_CHECK_CHUNK, and compares them with the stored ones. The hours of
+the views compacted by view_retention.py only keep their opens as stored,
+their first opens are taken from views_monthly. --repair overwrites the
+mismatched buckets and first opens with the recomputed values, and fills the
+tables of a database upgraded to migration 0006. Hits recorded while a repair
+runs may be missed by it, run the check again afterwards.
+"""
+import argparse
+import datetime
+import os
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+import database
+import models
+import utils
+import view_shards
+
+OPEN_ROLLUPS_ENABLED = os.getenv("OPEN_ROLLUPS_ENABLED", "1") == "1"
+OPEN_ROLLUP_CHECK_CHUNK = int(os.getenv("OPEN_ROLLUP_CHECK_CHUNK", 1000))
+# Mismatched buckets listed in a check report
+OPEN_ROLLUP_REPORT_LIMIT = 20
+
+# (campaign_id, group_id, hour) to [opens, opened_contacts, sent_contacts]
+Deltas = Dict[Tuple[int, int, datetime.datetime], List[int]]
+
+
+def hour_start(value: datetime.datetime) -> datetime.datetime:
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def _hour_of(db, column):
+    if db.get_bind().dialect.name == "mysql":
+        return func.date_format(column, "%Y-%m-%d %H:00:00")
+    return func.strftime("%Y-%m-%d %H:00:00", column)
+
+
+def _parse_hour(value: str) -> datetime.datetime:
+    return datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+
+
+def _deltas() -> Deltas:
+    return defaultdict(lambda: [0, 0, 0])
+
+
+def add(db: Session, deltas: Deltas):
+    """
+    Add deltas to the rollup buckets in one INSERT ... ON DUPLICATE KEY UPDATE, without committing
+    :param deltas: dict of (campaign_id, group_id, hour) to [opens, opened_contacts, sent_contacts]
+    """
+    rows = [
+        {"campaign_id": campaign_id, "group_id": group_id, "hour": hour, "opens": opens, "opened_contacts": opened_contacts, "sent_contacts": sent_contacts}
+        for (campaign_id, group_id, hour), (opens, opened_contacts, sent_contacts) in deltas.items()
+        if opens or opened_contacts or sent_contacts
+    ]
+    if not rows:
+        return
+
+    table = models.OpenRollups
+    if db.get_bind().dialect.name == "mysql":
+        stmt = mysql_insert(table).values(rows)
+        stmt = stmt.on_duplicate_key_update(
+            opens=table.opens + stmt.inserted.opens,
+            opened_contacts=table.opened_contacts + stmt.inserted.opened_contacts,
+            sent_contacts=table.sent_contacts + stmt.inserted.sent_contacts
+        )
+    else:
+        stmt = sqlite_insert(table).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.campaign_id, table.group_id, table.hour],
+            set_={
+                "opens": table.opens + stmt.excluded.opens,
+                "opened_contacts": table.opened_contacts + stmt.excluded.opened_contacts,
+                "sent_contacts": table.sent_contacts + stmt.excluded.sent_contacts
+            }
+        )
+    db.execute(stmt)
+
+
+def _insert_first_open(db: Session, contact_uuid: str, first_open: datetime.datetime) -> bool:
+    """
+    :return: True if the row was inserted, False if the contact already had a first open
+    """
+    table = models.ContactOpens
+    row = {"contact_uuid": contact_uuid, "first_open": first_open}
+    if db.get_bind().dialect.name == "mysql":
+        stmt = mysql_insert(table).values(row).prefix_with("IGNORE")
+    else:
+        stmt = sqlite_insert(table).values(row).on_conflict_do_nothing(index_elements=[table.contact_uuid])
+    return db.execute(stmt).rowcount == 1
+
+
+def _claim_first_open(db: Session, contact_uuid: str, first_open: datetime.datetime, previous: Optional[datetime.datetime]) -> Tuple[bool, Optional[datetime.datetime]]:
+    """
+    Make an open the first open of its contact if it is, the database deciding between concurrent writers
+    :param previous: datetime first open read for the contact, None if it had none
+    :return: tuple of whether the open became the first open and of the first open it replaced
+    """
+    table = models.ContactOpens
+    while True:
+        if previous is None:
+            if _insert_first_open(db, contact_uuid, first_open):
+                return True, None
+        elif previous <= first_open:
+            return False, None
+        # Swapped only if no other writer moved it since it was read
+        elif db.execute(table.__table__.update().where(
+            table.contact_uuid == contact_uuid, table.first_open == previous, table.first_open > first_open
+        ).values(first_open=first_open)).rowcount == 1:
+            return True, previous
+        previous = db.execute(select(table.first_open).where(table.contact_uuid == contact_uuid)).scalar()
+
+
+def record_opens(db: Session, opens: Iterable[Tuple[utils.PixelRef, datetime.datetime]]):
+    """
+    Count recorded human opens in the rollups, and the first open of their contacts, then commit.
+    A failure is logged and left to the check.
+    :param db: Session of the main database
+    :param opens: iterable of (utils.PixelRef of the pixel, view datetime)
+    """
+    deltas = _deltas()
+    first_opens = {}
+    for ref, view_datetime in opens:
+        deltas[(ref.campaign_id, ref.group_id, hour_start(view_datetime))][0] += 1
+        if ref.contact_uuid not in first_opens or view_datetime < first_opens[ref.contact_uuid][1]:
+            first_opens[ref.contact_uuid] = (ref, view_datetime)
+    if not first_opens:
+        return
+
+    try:
+        known = dict(db.execute(
+            select(models.ContactOpens.contact_uuid, models.ContactOpens.first_open).where(models.ContactOpens.contact_uuid.in_(list(first_opens)))
+        ).all())
+        for contact_uuid, (ref, first_open) in first_opens.items():
+            # First open of the contact, or an earlier one replayed late
+            claimed, replaced = _claim_first_open(db, contact_uuid, first_open, known.get(contact_uuid))
+            if claimed:
+                deltas[(ref.campaign_id, ref.group_id, hour_start(first_open))][1] += 1
+            if replaced is not None:
+                deltas[(ref.campaign_id, ref.group_id, hour_start(replaced))][1] -= 1
+        add(db, deltas)
+        db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        print(f"Error in open rollups, run open_rollups.py --repair: {e}")
+
+
+def count_contacts(db: Session, contacts: Iterable[Tuple[int, int, datetime.datetime]], sign: int = 1):
+    """
+    Count contacts as sent in the hour they are scheduled, in the transaction writing them
+    :param contacts: iterable of (campaign_id, group_id, scheduled_datetime)
+    :param sign: int 1 for written contacts, -1 for deleted ones
+    """
+    deltas = _deltas()
+    for campaign_id, group_id, scheduled_datetime in contacts:
+        deltas[(campaign_id, group_id, hour_start(scheduled_datetime))][2] += sign
+    add(db, deltas)
+
+
+def uncount_contact(db: Session, contact: models.Contacts):
+    """
+    Remove a contact about to be deleted from the rollups, in the transaction deleting it
+    """
+    count_contacts(db, [(contact.campaign_id, contact.group_id, contact.scheduled_datetime)], -1)
+    first_open = db.query(models.ContactOpens.first_open).filter(models.ContactOpens.contact_uuid == contact.uuid).scalar()
+    if first_open is not None:
+        add(db, {(contact.campaign_id, contact.group_id, hour_start(first_open)): [0, -1, 0]})
+        db.execute(delete(models.ContactOpens).where(models.ContactOpens.contact_uuid == contact.uuid))
+
+
+def count_contacts_select(db: Session, campaign_id: int, group_ids: Dict[int, int], scheduled, where: list):
+    """
+    Count the contacts selected by a condition as sent contacts of a campaign, grouped by the database
+    :param group_ids: dict of the group id of the selected contacts to the group id counted
+    :param scheduled: SQL expression of the scheduled datetime counted
+    """
+    hour = _hour_of(db, scheduled)
+    deltas = _deltas()
+    for group_id, hour_value, count in db.execute(
+        select(models.Contacts.group_id, hour, func.count()).where(*where).group_by(models.Contacts.group_id, hour)
+    ):
+        deltas[(campaign_id, group_ids[group_id], _parse_hour(hour_value))][2] += count
+    add(db, deltas)
+
+
+def _compacted_until(db: Session) -> Optional[datetime.datetime]:
+    """
+    :return: datetime before which the views of some shard are compacted, None if none is
+    """
+    compactions = view_shards.view_shards.fan_out(db, lambda hit_db, shard: hit_db.query(func.max(models.ViewCompactions.range_end)).filter(
+        models.ViewCompactions.completed_datetime != None
+    ).scalar())
+    return max(filter(None, compactions), default=None)
+
+
+def _chunk_first_opens(db: Session, pixel_contacts: Dict[str, str], counted, compacted_until: Optional[datetime.datetime]) -> Dict[str, datetime.datetime]:
+    """
+    Count the raw human opens of pixels per hour and read the first open of their contacts, on their shards
+    :param pixel_contacts: dict of pixel uuid to contact uuid
+    :param counted: callable of a contact uuid, an hour and a count of opens
+    :return: dict of contact uuid to first human open
+    """
+    views = models.Views
+    monthly = models.ViewsMonthly
+    first_opens = {}
+
+    def earliest(contact_uuid, value):
+        if contact_uuid not in first_opens or value < first_opens[contact_uuid]:
+            first_opens[contact_uuid] = value
+
+    for shard, pixel_uuids in view_shards.view_shards.by_shard(list(pixel_contacts)).items():
+        with view_shards.view_shards.session(db, shard) as hit_db:
+            hour = _hour_of(hit_db, views.view_datetime)
+            for pixel_uuid, hour_value, count, first_view in hit_db.execute(
+                select(views.pixel_uuid, hour, func.count(), func.min(views.view_datetime))
+                .where(views.pixel_uuid.in_(pixel_uuids), views.machine_label == None).group_by(views.pixel_uuid, hour)
+            ):
+                hour_value = _parse_hour(hour_value)
+                if compacted_until is None or hour_value >= compacted_until:
+                    counted(pixel_contacts[pixel_uuid], hour_value, count)
+                earliest(pixel_contacts[pixel_uuid], first_view)
+            for pixel_uuid, first_view in hit_db.execute(
+                select(monthly.pixel_uuid, func.min(monthly.first_view))
+                .where(monthly.pixel_uuid.in_(pixel_uuids), monthly.machine_label == "").group_by(monthly.pixel_uuid)
+            ):
+                earliest(pixel_contacts[pixel_uuid], first_view)
+    return first_opens
+
+
+def check_campaign(campaign_id: int, repair: bool = False, chunk: int = OPEN_ROLLUP_CHECK_CHUNK) -> Dict:
+    """
+    Recompute the rollup buckets and the first opens of the contacts of a campaign, compare them with the stored ones
+    :param repair: bool overwrite the mismatched buckets and first opens
+    :return: dict report of the check
+    """
+    contacts = models.Contacts
+    pixels = models.Pixels
+    contact_opens = models.ContactOpens
+    rollups = models.OpenRollups
+
+    db = database.SessionLocal()
+    try:
+        compacted_until = _compacted_until(db)
+        expected = defaultdict(lambda: [0, 0, 0])
+
+        hour = _hour_of(db, contacts.scheduled_datetime)
+        for group_id, hour_value, count in db.execute(
+            select(contacts.group_id, hour, func.count()).where(contacts.campaign_id == campaign_id).group_by(contacts.group_id, hour)
+        ):
+            expected[(group_id, _parse_hour(hour_value))][2] = count
+
+        mismatched_contacts = 0
+        last_uuid = None
+        while True:
+            after = [] if last_uuid is None else [contacts.uuid > last_uuid]
+            contact_groups = dict(db.execute(
+                select(contacts.uuid, contacts.group_id).where(contacts.campaign_id == campaign_id, *after).order_by(contacts.uuid).limit(chunk)
+            ).all())
+            if not contact_groups:
+                break
+            last_uuid = max(contact_groups)
+            pixel_contacts = dict(db.execute(select(pixels.uuid, pixels.contact_uuid).where(pixels.contact_uuid.in_(list(contact_groups)))).all())
+
+            def counted(contact_uuid, hour_value, count):
+                expected[(contact_groups[contact_uuid], hour_value)][0] += count
+
+            first_opens = _chunk_first_opens(db, pixel_contacts, counted, compacted_until)
+            for contact_uuid, first_open in first_opens.items():
+                expected[(contact_groups[contact_uuid], hour_start(first_open))][1] += 1
+
+            stored_opens = dict(db.execute(select(contact_opens.contact_uuid, contact_opens.first_open).where(contact_opens.contact_uuid.in_(list(contact_groups)))).all())
+            wrong = [contact_uuid for contact_uuid in set(stored_opens) | set(first_opens) if stored_opens.get(contact_uuid) != first_opens.get(contact_uuid)]
+            mismatched_contacts += len(wrong)
+            if repair and wrong:
+                db.execute(delete(contact_opens).where(contact_opens.contact_uuid.in_(wrong)))
+                fixed = [{"contact_uuid": contact_uuid, "first_open": first_opens[contact_uuid]} for contact_uuid in wrong if contact_uuid in first_opens]
+                if fixed:
+                    db.execute(insert(contact_opens), fixed)
+                db.commit()
+            else:
+                db.rollback()
+
+        stored = {
+            (row.group_id, row.hour): [row.opens, row.opened_contacts, row.sent_contacts]
+            for row in db.query(rollups).filter(rollups.campaign_id == campaign_id)
+        }
+        mismatches = []
+        for group_id, hour_value in sorted(set(stored) | set(expected)):
+            have = stored.get((group_id, hour_value), [0, 0, 0])
+            want = list(expected.get((group_id, hour_value), [0, 0, 0]))
+            if compacted_until and hour_value < compacted_until:
+                # The views of the hour are compacted by month, its opens cannot be recounted
+                want[0] = have[0]
+            if want != have:
+                mismatches.append({"group_id": group_id, "hour": hour_value, "stored": have, "expected": want})
+
+        if repair and mismatches:
+            for mismatch in mismatches:
+                db.execute(delete(rollups).where(
+                    rollups.campaign_id == campaign_id, rollups.group_id == mismatch["group_id"], rollups.hour == mismatch["hour"]
+                ))
+            rows = [
+                {"campaign_id": campaign_id, "group_id": mismatch["group_id"], "hour": mismatch["hour"],
+                 "opens": mismatch["expected"][0], "opened_contacts": mismatch["expected"][1], "sent_contacts": mismatch["expected"][2]}
+                for mismatch in mismatches if any(mismatch["expected"])
+            ]
+            if rows:
+                db.execute(insert(rollups), rows)
+            db.commit()
+    finally:
+        db.close()
+
+    return {
+        "campaign_id": campaign_id,
+        "buckets": len(set(stored) | set(expected)),
+        "mismatched_buckets": len(mismatches),
+        "mismatched_contacts": mismatched_contacts,
+        "opens_unchecked_before": compacted_until.isoformat() if compacted_until else None,
+        "repaired": repair,
+        "mismatches": [
+            dict(mismatch, hour=mismatch["hour"].isoformat()) for mismatch in mismatches[:OPEN_ROLLUP_REPORT_LIMIT]
+        ]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--campaign", type=int, nargs="+", help="ids of the campaigns to check")
+    target.add_argument("--all", action="store_true", help="check every campaign")
+    parser.add_argument("--repair", action="store_true", help="overwrite the mismatched buckets and first opens")
+    parser.add_argument("--chunk", type=int, default=OPEN_ROLLUP_CHECK_CHUNK, help="contacts per chunk")
+    args = parser.parse_args()
+
+    campaign_ids = args.campaign
+    if args.all:
+        db = database.SessionLocal()
+        try:
+            campaign_ids = [row.id for row in db.query(models.Campaigns.id).order_by(models.Campaigns.id)]
+        finally:
+            db.close()
+
+    consistent = True
+    for campaign_id in campaign_ids:
+        report = check_campaign(campaign_id, args.repair, args.chunk)
+        consistent = consistent and not report["mismatched_buckets"] and not report["mismatched_contacts"]
+        print(report)
+    if not consistent and not args.repair:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
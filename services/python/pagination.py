@@ -0,0 +1,90 @@
+"""
+Keyset pagination of the list endpoints.
+
+A page holds at most PAGE_SIZE_MAX rows sorted by a unique key, usually the
+primary key. When more rows follow, the X-Next-Cursor response header carries
+an opaque cursor of the last key of the page; passing it back as ?cursor=
+returns the rows after it with an index range scan, however deep the page,
+and rows inserted meanwhile never shift a page.
+"""
+import base64
+import json
+import os
+from typing import List, Optional, Tuple
+from fastapi import HTTPException, Response, status
+
+PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE_DEFAULT", 100))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", 1000))
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def page_size(limit: Optional[int]) -> int:
+    """
+    :return: int rows of a page, limit clamped to PAGE_SIZE_MAX
+    """
+    if limit is None:
+        return PAGE_SIZE_DEFAULT
+    if limit < 1:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="limit must be at least 1.")
+    return min(limit, PAGE_SIZE_MAX)
+
+
+def encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str], length: int) -> Optional[list]:
+    """
+    :param cursor: string cursor of a previous page, None for the first page
+    :param length: int number of values of the cursor
+    :return: list of the key values of the last row of the previous page, None for the first page
+    """
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        values = None
+    if not isinstance(values, list) or len(values) != length:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor.")
+    return values
+
+
+def keyset_query(query, column, after, limit: int):
+    """
+    Query of the rows after a key value, sorted by a unique column, one more than the page to know whether more follow
+    :param after: key value of the last row of the previous page, None for the first page
+    """
+    if after is not None:
+        query = query.filter(column > after)
+    return query.order_by(column).limit(limit + 1)
+
+
+def keyset_page(query, column, after, limit: int) -> Tuple[List, bool]:
+    """
+    Rows of a query after a key value, sorted by a unique column
+    :param after: key value of the last row of the previous page, None for the first page
+    :return: tuple of the list of at most limit rows and of whether more rows follow
+    """
+    rows = keyset_query(query, column, after, limit).all()
+    return rows[:limit], len(rows) > limit
+
+
+def set_next_cursor(response: Response, values: Optional[list]):
+    """
+    Announce the cursor of the next page, if any
+    """
+    if values is not None:
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(values)
+
+
+def paginate(query, column, cursor: Optional[str], limit: Optional[int], response: Response) -> List:
+    """
+    Page of a query sorted by a unique column, the cursor of the next one set on the response
+    :return: list of the rows of the page
+    """
+    size = page_size(limit)
+    after = decode_cursor(cursor, 1)
+    rows, more = keyset_page(query, column, after[0] if after else None, size)
+    set_next_cursor(response, [getattr(rows[-1], column.key)] if more else None)
+    return rows
@@ -0,0 +1,191 @@
+"""
+In-process Bloom filter of every known Pixels.uuid.
+
+Unknown uuids (scanners, mangled links) are rejected by the pixel endpoint
+without touching Redis nor MySQL. The filter is built in background at
+startup, receives the pixels created by any worker through a Redis channel
+and is rebuilt from the database every PIXEL_FILTER_REBUILD_SECONDS, which
+also resizes it to the current number of pixels. A Bloom filter has no false
+negatives, so until it is built every uuid is let through.
+"""
+import hashlib
+import math
+import os
+import threading
+import time
+import redis
+import database
+import models
+import utils
+
+PIXEL_FILTER_ENABLED = os.getenv("PIXEL_FILTER_ENABLED", "1") == "1"
+PIXEL_FILTER_ERROR_RATE = float(os.getenv("PIXEL_FILTER_ERROR_RATE", 0.001))
+PIXEL_FILTER_MIN_CAPACITY = int(os.getenv("PIXEL_FILTER_MIN_CAPACITY", 100000))
+PIXEL_FILTER_REBUILD_SECONDS = int(os.getenv("PIXEL_FILTER_REBUILD_SECONDS", 600))
+PIXEL_FILTER_CHANNEL = os.getenv("PIXEL_FILTER_CHANNEL", "pixeltracking:pixels")
+
+
+class BloomFilter:
+    """
+    Fixed size Bloom filter with double hashing over a blake2b digest
+    :param capacity: int expected number of items
+    :param error_rate: float false positive rate at capacity
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+        # Setting a bit is a read-modify-write of a byte, reads need no lock
+        self._lock = threading.Lock()
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item: str):
+        positions = self._positions(item)
+        with self._lock:
+            flipped = False
+            for position in positions:
+                mask = 1 << (position & 7)
+                if not self.bits[position >> 3] & mask:
+                    self.bits[position >> 3] |= mask
+                    flipped = True
+            # An item added again, by its own pubsub echo or a rebuild, is counted once
+            if flipped:
+                self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def false_positive_rate(self) -> float:
+        """
+        Expected false positive rate with the current number of items
+        """
+        return (1 - math.exp(-self.num_hashes * self.count / self.num_bits)) ** self.num_hashes
+
+
+class KnownPixels:
+    """
+    Bloom filter of the known pixel uuids with its rebuild and sync threads
+    """
+
+    def __init__(self):
+        self.filter = None
+        self.stats = utils.StatsCounter("passed", "rejected", "rebuilds", "synced")
+        self.last_rebuild = None
+        self._lock = threading.Lock()
+        self._added_while_rebuilding = None
+
+    def might_exist(self, pixel_uuid: str) -> bool:
+        """
+        :return: False only if the pixel certainly does not exist
+        """
+        bloom = self.filter
+        if bloom is None or pixel_uuid in bloom:
+            self.stats.incr("passed")
+            return True
+        self.stats.incr("rejected")
+        return False
+
+    def add(self, pixel_uuid: str):
+        with self._lock:
+            if self._added_while_rebuilding is not None:
+                self._added_while_rebuilding.append(pixel_uuid)
+            bloom = self.filter
+        if bloom is not None:
+            bloom.add(pixel_uuid)
+
+    def register(self, pixel_uuids):
+        """
+        Add newly created pixels here and announce them to the other workers
+        :param pixel_uuids: list of string pixel uuids
+        """
+        for pixel_uuid in pixel_uuids:
+            self.add(pixel_uuid)
+        try:
+            r = utils.get_redis_connection()
+            pipe = r.pipeline(transaction=False)
+            for pixel_uuid in pixel_uuids:
+                pipe.publish(PIXEL_FILTER_CHANNEL, pixel_uuid)
+            pipe.execute()
+        except redis.RedisError as e:
+            # The other workers catch up on their next rebuild
+            print(f"Error in pixel filter publish: {e}")
+
+    def rebuild(self):
+        """
+        Build a new filter sized for the current pixels and swap it in
+        """
+        with self._lock:
+            self._added_while_rebuilding = []
+
+        db = database.SessionLocal()
+        try:
+            count = db.query(models.Pixels.uuid).count()
+            bloom = BloomFilter(max(PIXEL_FILTER_MIN_CAPACITY, count * 2), PIXEL_FILTER_ERROR_RATE)
+            for row in db.query(models.Pixels.uuid).yield_per(50000):
+                bloom.add(row.uuid)
+        except Exception:
+            with self._lock:
+                self._added_while_rebuilding = None
+            raise
+        finally:
+            db.close()
+
+        with self._lock:
+            # Pixels created while the table was scanned
+            for pixel_uuid in self._added_while_rebuilding:
+                bloom.add(pixel_uuid)
+            self._added_while_rebuilding = None
+            self.filter = bloom
+        self.last_rebuild = time.time()
+        self.stats.incr("rebuilds")
+
+    def _rebuild_loop(self):
+        while True:
+            try:
+                self.rebuild()
+                time.sleep(PIXEL_FILTER_REBUILD_SECONDS)
+            except Exception as e:
+                print(f"Error in pixel filter rebuild: {e}")
+                time.sleep(min(PIXEL_FILTER_REBUILD_SECONDS, 30))
+
+    def _sync_loop(self):
+        while True:
+            try:
+                pubsub = utils.get_blocking_redis_connection().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(PIXEL_FILTER_CHANNEL)
+                for message in pubsub.listen():
+                    self.add(message["data"].decode())
+                    self.stats.incr("synced")
+            except Exception as e:
+                print(f"Error in pixel filter sync: {e}")
+                time.sleep(5)
+
+    def start(self):
+        for target in (self._rebuild_loop, self._sync_loop):
+            threading.Thread(target=target, daemon=True).start()
+
+    def get_stats(self) -> dict:
+        bloom = self.filter
+        stats = dict(self.stats.snapshot(), ready=bloom is not None, last_rebuild=self.last_rebuild)
+        if bloom is not None:
+            stats.update(
+                items=bloom.count,
+                capacity=bloom.capacity,
+                hashes=bloom.num_hashes,
+                memory_bytes=len(bloom.bits),
+                false_positive_rate=bloom.false_positive_rate()
+            )
+        return stats
+
+
+known_pixels = KnownPixels()
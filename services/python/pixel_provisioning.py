@@ -0,0 +1,87 @@
+"""
+Bulk provisioning of N pixels per contact for a whole group or campaign.
+
+Contacts are walked by uuid in chunks of PROVISION_BATCH_SIZE. For each chunk
+the (contact, pixel number) pairs that already exist are read in one query and
+left out, the uuids of the missing pixels are generated in one batch, their
+ordinals reserved as one block of the campaign, and they are inserted with a
+single executemany and committed. The created pixels are yielded as they are
+committed, so the caller can stream the mapping.
+"""
+import os
+from typing import Dict, Iterator, Optional
+from sqlalchemy import insert
+import database
+import models
+import pixel_filter
+import utils
+
+PROVISION_BATCH_SIZE = int(os.getenv("PROVISION_BATCH_SIZE", 1000))
+
+
+def provision_pixels(campaign_id: int, group_id: Optional[int], pixels_per_contact: int, signed: bool = False) -> Iterator[Dict]:
+    """
+    Create the missing pixels numbered 1 to pixels_per_contact of every contact of a campaign or of one of its groups
+    :param campaign_id: int campaign of the contacts
+    :param group_id: int group of the contacts, None for the whole campaign
+    :param pixels_per_contact: int number of pixels per contact
+    :param signed: bool also issue the signed pixel urls
+    :return: iterator of the created pixels, then of the created and skipped totals
+    """
+    numbers = range(1, pixels_per_contact + 1)
+    created = 0
+    skipped = 0
+    last_uuid = None
+
+    db = database.SessionLocal()
+    try:
+        while True:
+            query = db.query(models.Contacts.uuid, models.Contacts.group_id).filter(models.Contacts.campaign_id == campaign_id)
+            if group_id is not None:
+                query = query.filter(models.Contacts.group_id == group_id)
+            if last_uuid is not None:
+                query = query.filter(models.Contacts.uuid > last_uuid)
+            contacts = query.order_by(models.Contacts.uuid).limit(PROVISION_BATCH_SIZE).all()
+            if not contacts:
+                break
+            last_uuid = contacts[-1].uuid
+
+            # Anti-join of the wanted pairs of the chunk with the existing pixels
+            existing = set(
+                db.query(models.Pixels.contact_uuid, models.Pixels.contact_pixel_number).filter(
+                    models.Pixels.contact_uuid.in_([contact.uuid for contact in contacts]),
+                    models.Pixels.contact_pixel_number.in_(numbers)
+                ).all()
+            )
+            missing = [(contact, number) for contact in contacts for number in numbers if (contact.uuid, number) not in existing]
+            skipped += len(contacts) * len(numbers) - len(missing)
+            if not missing:
+                continue
+
+            pixel_uuids = utils.generate_uuid4_batch(len(missing))
+            first_ordinal = utils.allocate_pixel_ordinals(db, campaign_id, len(missing))
+            rows = [
+                {
+                    "uuid": pixel_uuid,
+                    "contact_uuid": contact.uuid,
+                    "contact_pixel_number": number,
+                    "ordinal": first_ordinal + i
+                }
+                for i, (pixel_uuid, (contact, number)) in enumerate(zip(pixel_uuids, missing))
+            ]
+            db.execute(insert(models.Pixels), rows)
+            db.commit()
+            created += len(rows)
+
+            if pixel_filter.PIXEL_FILTER_ENABLED:
+                pixel_filter.known_pixels.register(pixel_uuids)
+
+            for row, (contact, _) in zip(rows, missing):
+                pixel = {"contact_uuid": row["contact_uuid"], "contact_pixel_number": row["contact_pixel_number"], "uuid": row["uuid"]}
+                if signed:
+                    pixel["signed_uuid"] = utils.sign_pixel(utils.PixelRef(row["uuid"], contact.uuid, contact.group_id, campaign_id, row["ordinal"]))
+                yield pixel
+    finally:
+        db.close()
+
+    yield {"created": created, "skipped": skipped}
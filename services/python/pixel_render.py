@@ -0,0 +1,158 @@
+"""
+Bulk rendering of an email template per contact with its pixel urls injected.
+
+The Jinja2 template is compiled once per request. Contacts are walked by uuid
+in chunks of RENDER_BATCH_SIZE and the pixels of a chunk are read with one
+query, the rendered documents of a chunk are joined and yielded as a single
+piece, so a render of any size runs in constant memory.
+
+Template variables: pixel_url (url of the lowest numbered pixel), pixel_urls
+(urls of every pixel, by pixel number), contact_uuid, group_id, campaign_id and
+scheduled_datetime. Templates come from API callers, they run in a Jinja2
+sandbox: attributes such as __globals__ or __class__ raise a SecurityError.
+A contact whose render fails gets an error record instead of its document and
+the render goes on with the next contacts.
+
+The html output is a multipart/mixed body, one text/html part per contact
+with its uuid as Content-ID, an application/json part per failed contact and
+a last application/json part with the totals.
+"""
+import json
+import os
+from typing import Iterator, Optional
+import datetime
+import jinja2
+from jinja2.sandbox import ImmutableSandboxedEnvironment
+import database
+import models
+import utils
+
+RENDER_BATCH_SIZE = int(os.getenv("RENDER_BATCH_SIZE", 500))
+
+_environment = ImmutableSandboxedEnvironment(autoescape=True)
+
+
+def compile_template(source: str) -> jinja2.Template:
+    """
+    :raise jinja2.TemplateSyntaxError: if the template is invalid
+    """
+    return _environment.from_string(source)
+
+
+def check_template(template: jinja2.Template):
+    """
+    Render a template once with sample values, before any contact is streamed
+    :raise jinja2.exceptions.SecurityError: if the template reaches outside the sandbox
+    :raise jinja2.TemplateError: if the template fails to render
+    :raise Exception: if an operation of the template fails on the sample values
+    """
+    sample_url = "https://example.com/pixel/00000000-0000-0000-0000-000000000000"
+    template.render(
+        pixel_url=sample_url,
+        pixel_urls={1: sample_url},
+        contact_uuid="00000000-0000-0000-0000-000000000000",
+        group_id=0,
+        campaign_id=0,
+        scheduled_datetime=datetime.datetime(2000, 1, 1)
+    )
+
+
+def new_boundary() -> str:
+    """
+    :return: string multipart boundary, random so that no document contains it
+    """
+    return "render-" + os.urandom(16).hex()
+
+
+def _part(boundary: str, content_type: str, body: str, contact_uuid: Optional[str] = None) -> str:
+    headers = f"Content-Type: {content_type}\r\n" + (f"Content-ID: <{contact_uuid}>\r\n" if contact_uuid is not None else "")
+    return f"--{boundary}\r\n{headers}\r\n{body}\r\n"
+
+
+def render_contacts(template: jinja2.Template, base_url: str, campaign_id: int, group_id: Optional[int], output: str = "ndjson", signed: bool = False, boundary: Optional[str] = None) -> Iterator[str]:
+    """
+    Render the template for every contact of a campaign or of one of its groups that has pixels
+    :param template: jinja2.Template compiled by compile_template
+    :param base_url: string url the pixel uuids are appended to
+    :param campaign_id: int campaign of the contacts
+    :param group_id: int group of the contacts, None for the whole campaign
+    :param output: string "ndjson" for one {contact_uuid, html} line per contact, "html" for a multipart/mixed body
+    :param signed: bool use the signed pixel urls
+    :param boundary: string multipart boundary of the html output, from new_boundary
+    :return: iterator of rendered chunks
+    """
+    last_uuid = None
+    rendered = 0
+    failed = 0
+    without_pixels = 0
+
+    db = database.SessionLocal()
+    try:
+        while True:
+            query = db.query(models.Contacts).filter(models.Contacts.campaign_id == campaign_id)
+            if group_id is not None:
+                query = query.filter(models.Contacts.group_id == group_id)
+            if last_uuid is not None:
+                query = query.filter(models.Contacts.uuid > last_uuid)
+            contacts = query.order_by(models.Contacts.uuid).limit(RENDER_BATCH_SIZE).all()
+            if not contacts:
+                break
+            last_uuid = contacts[-1].uuid
+
+            pixels = {}
+            for pixel in db.query(
+                models.Pixels.uuid,
+                models.Pixels.contact_uuid,
+                models.Pixels.contact_pixel_number,
+                models.Pixels.ordinal
+            ).filter(models.Pixels.contact_uuid.in_([contact.uuid for contact in contacts])).order_by(models.Pixels.contact_pixel_number):
+                pixels.setdefault(pixel.contact_uuid, []).append(pixel)
+
+            chunk = []
+            for contact in contacts:
+                contact_pixels = pixels.get(contact.uuid)
+                if not contact_pixels:
+                    without_pixels += 1
+                    continue
+
+                pixel_urls = {}
+                for pixel in contact_pixels:
+                    pixel_uuid = pixel.uuid
+                    if signed:
+                        pixel_uuid = utils.sign_pixel(utils.PixelRef(pixel.uuid, contact.uuid, contact.group_id, contact.campaign_id, pixel.ordinal))
+                    pixel_urls[pixel.contact_pixel_number] = base_url + pixel_uuid
+
+                try:
+                    html = template.render(
+                        pixel_url=pixel_urls[contact_pixels[0].contact_pixel_number],
+                        pixel_urls=pixel_urls,
+                        contact_uuid=contact.uuid,
+                        group_id=contact.group_id,
+                        campaign_id=contact.campaign_id,
+                        scheduled_datetime=contact.scheduled_datetime
+                    )
+                except Exception as e:
+                    # The response is already streaming, the contact gets an error record instead
+                    reason = "Template refused" if isinstance(e, jinja2.exceptions.SecurityError) else "Render failed"
+                    error = json.dumps({"contact_uuid": contact.uuid, "error": f"{reason}: {e}"})
+                    chunk.append(error + "\n" if output == "ndjson" else _part(boundary, "application/json", error, contact.uuid))
+                    failed += 1
+                    continue
+                if output == "ndjson":
+                    chunk.append(json.dumps({"contact_uuid": contact.uuid, "html": html}) + "\n")
+                else:
+                    chunk.append(_part(boundary, "text/html; charset=utf-8", html, contact.uuid))
+                rendered += 1
+
+            # Loaded rows are not needed anymore
+            db.expunge_all()
+            if chunk:
+                yield "".join(chunk)
+    finally:
+        db.close()
+
+    totals = json.dumps({"rendered": rendered, "failed": failed, "without_pixels": without_pixels})
+    if output == "ndjson":
+        yield totals + "\n"
+    else:
+        yield _part(boundary, "application/json", totals) + f"--{boundary}--\r\n"
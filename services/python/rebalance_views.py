@@ -0,0 +1,202 @@
+"""
+Move the hit rows of the pixels whose shard changed, after a shard was added or removed in VIEW_SHARD_URLS.
+
+Run it once every worker uses the new VIEW_SHARD_URLS:
+    python rebalance_views.py
+    python rebalance_views.py --dry-run
+
+Every shard is walked table by table in chunks of --chunk pixel uuids. The rows
+of the pixels the ring now places on another shard are merged into it: views
+are copied without their id and skipped when their event id is already there,
+the open counters and the monthly compactions are added to the rows of the
+same key. The progress is saved in shard_moves on the receiving shard, in the
+same transaction as the copied rows, then the rows are deleted from their old
+shard. An interrupted run started again with the same shards resumes without
+copying a row twice. To remove a shard, take it out of the VIEW_SHARD_URLS of
+the workers, then run the tool with the shard still listed and --drain, its
+rows move to the remaining shards. With --dry-run the pixels to move are
+counted instead of the rows.
+"""
+import argparse
+import datetime
+import hashlib
+import time
+import os
+from typing import Dict, List
+from sqlalchemy import func, insert, select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+import models
+import view_shards
+
+REBALANCE_CHUNK = int(os.getenv("REBALANCE_CHUNK", 500))
+# Seconds slept between two chunks, to leave room to the hot path
+REBALANCE_PAUSE = float(os.getenv("REBALANCE_PAUSE", 0.05))
+
+# Per table, how the rows of a key already on the receiving shard are merged: None to keep the existing row
+MERGES = {
+    models.Views.__table__: None,
+    models.PixelOpens.__table__: {"first_open": "min", "last_open": "max", "open_count": "sum"},
+    models.MachineOpens.__table__: {"last_open": "max", "open_count": "sum"},
+    models.ViewsMonthly.__table__: {"first_view": "min", "last_view": "max", "view_count": "sum"},
+}
+
+
+def run_id(shards: List[str]) -> str:
+    """
+    :return: string id of a rebalancing toward a set of shards
+    """
+    return hashlib.md5(",".join(sorted(shards)).encode()).hexdigest()
+
+
+def _merge_rows(db, table, rows: List[Dict]):
+    merge = MERGES[table]
+    mysql = db.get_bind().dialect.name == "mysql"
+    if merge is None:
+        # A duplicate event id means the view was copied already
+        db.execute(insert(table).prefix_with("IGNORE" if mysql else "OR IGNORE"), rows)
+        return
+
+    if mysql:
+        stmt = mysql_insert(table).values(rows)
+        functions = {"min": func.least, "max": func.greatest, "sum": lambda current, new: current + new}
+        stmt = stmt.on_duplicate_key_update({
+            column: functions[kind](table.c[column], stmt.inserted[column]) for column, kind in merge.items()
+        })
+    else:
+        stmt = sqlite_insert(table).values(rows)
+        functions = {"min": func.min, "max": func.max, "sum": lambda current, new: current + new}
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(table.primary_key.columns),
+            set_={column: functions[kind](table.c[column], stmt.excluded[column]) for column, kind in merge.items()}
+        )
+    db.execute(stmt)
+
+
+def _save_progress(db, run: str, source: str, table_name: str, last_pixel_uuid: str):
+    moves = view_shards.shard_moves
+    values = {"run_id": run, "source": source, "table_name": table_name, "last_pixel_uuid": last_pixel_uuid, "moved_datetime": datetime.datetime.utcnow()}
+    if db.get_bind().dialect.name == "mysql":
+        stmt = mysql_insert(moves).values(values)
+        stmt = stmt.on_duplicate_key_update(last_pixel_uuid=stmt.inserted.last_pixel_uuid, moved_datetime=stmt.inserted.moved_datetime)
+    else:
+        stmt = sqlite_insert(moves).values(values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[moves.c.run_id, moves.c.source, moves.c.table_name],
+            set_={"last_pixel_uuid": stmt.excluded.last_pixel_uuid, "moved_datetime": stmt.excluded.moved_datetime}
+        )
+    db.execute(stmt)
+
+
+def move_pixels(source_db, target_db, table, pixel_uuids: List[str], run: str, source: str) -> int:
+    """
+    Copy the rows of pixels to their new shard, then delete them from the old one
+    :param pixel_uuids: list of pixel uuids in ascending order
+    :return: number of rows copied
+    """
+    moves = view_shards.shard_moves
+    copied_until = target_db.execute(select(moves.c.last_pixel_uuid).where(
+        moves.c.run_id == run, moves.c.source == source, moves.c.table_name == table.name
+    )).scalar()
+    to_copy = [pixel_uuid for pixel_uuid in pixel_uuids if copied_until is None or pixel_uuid > copied_until]
+
+    copied = 0
+    if to_copy:
+        # The ids of views are per shard
+        columns = [column for column in table.columns if column.name != "id" or table is not models.Views.__table__]
+        rows = [dict(row) for row in source_db.execute(select(*columns).where(table.c.pixel_uuid.in_(to_copy))).mappings()]
+        if rows:
+            _merge_rows(target_db, table, rows)
+        _save_progress(target_db, run, source, table.name, to_copy[-1])
+        target_db.commit()
+        copied = len(rows)
+
+    source_db.execute(table.delete().where(table.c.pixel_uuid.in_(pixel_uuids)))
+    source_db.commit()
+    return copied
+
+
+def rebalance(drain: List[str] = (), chunk: int = REBALANCE_CHUNK, pause: float = REBALANCE_PAUSE, dry_run: bool = False) -> dict:
+    """
+    Move the rows of every shard to the shard the ring places their pixel on
+    :param drain: list of shard names to empty, left out of the ring
+    :return: dict of the rows moved, per source shard and table
+    """
+    shards = view_shards.view_shards
+    if not shards.enabled:
+        raise ValueError("VIEW_SHARD_URLS is not set")
+    unknown = set(drain) - set(shards.sessions)
+    if unknown:
+        raise ValueError(f"Unknown shards {', '.join(sorted(unknown))}")
+    targets = [name for name in shards.sessions if name not in drain]
+    ring = view_shards.HashRing(targets)
+    run = run_id(targets)
+
+    for engine in shards.engines.values():
+        view_shards.shard_moves.metadata.create_all(bind=engine)
+
+    result = {}
+    for source, source_maker in shards.sessions.items():
+        for table in MERGES:
+            moved = {}
+            source_db = source_maker()
+            target_dbs = {}
+            try:
+                last_pixel_uuid = None
+                while True:
+                    after = [] if last_pixel_uuid is None else [table.c.pixel_uuid > last_pixel_uuid]
+                    pixel_uuids = source_db.execute(
+                        select(table.c.pixel_uuid).where(*after).group_by(table.c.pixel_uuid).order_by(table.c.pixel_uuid).limit(chunk)
+                    ).scalars().all()
+                    source_db.rollback()
+                    if not pixel_uuids:
+                        break
+                    last_pixel_uuid = pixel_uuids[-1]
+
+                    by_target = {}
+                    for pixel_uuid in pixel_uuids:
+                        target = ring.get(pixel_uuid)
+                        if target != source:
+                            by_target.setdefault(target, []).append(pixel_uuid)
+                    for target, target_pixels in by_target.items():
+                        if dry_run:
+                            copied = len(target_pixels)
+                        else:
+                            target_db = target_dbs[target] if target in target_dbs else target_dbs.setdefault(target, shards.sessions[target]())
+                            copied = move_pixels(source_db, target_db, table, target_pixels, run, source)
+                        moved[target] = moved.get(target, 0) + copied
+                    if by_target:
+                        time.sleep(pause)
+
+                if not dry_run:
+                    # The pass is complete, a later run of the same shards walks the table again
+                    for target in targets:
+                        target_db = target_dbs[target] if target in target_dbs else target_dbs.setdefault(target, shards.sessions[target]())
+                        target_db.execute(view_shards.shard_moves.delete().where(
+                            view_shards.shard_moves.c.run_id == run,
+                            view_shards.shard_moves.c.source == source,
+                            view_shards.shard_moves.c.table_name == table.name
+                        ))
+                        target_db.commit()
+            finally:
+                source_db.close()
+                for target_db in target_dbs.values():
+                    target_db.close()
+            if moved:
+                result.setdefault(source, {})[table.name] = moved
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--drain", nargs="*", default=[], help="shard names to empty before removing them from VIEW_SHARD_URLS")
+    parser.add_argument("--chunk", type=int, default=REBALANCE_CHUNK, help="pixel uuids read per chunk")
+    parser.add_argument("--pause", type=float, default=REBALANCE_PAUSE, help="seconds slept between two chunks")
+    parser.add_argument("--dry-run", action="store_true", help="only count the pixels to move")
+    args = parser.parse_args()
+
+    print(rebalance(args.drain, args.chunk, args.pause, args.dry_run))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,18 @@
-from fastapi import APIRouter, FastAPI, Depends, HTTPException, status
+from fastapi import APIRouter, FastAPI, Depends, HTTPException, Response, status
+from sqlalchemy import func
 from sqlalchemy.orm import Session
+from typing import Optional
 import models, schemas
 from database import get_db
 from passlib.context import CryptContext
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 import string
 import random
 import utils
+import campaign_activity
+import campaign_clone
+import pagination
+import json
 import datetime
 from utils import oauth2_scheme
 
@@ -53,6 +59,8 @@ def add(
     db.commit()
     db.refresh(new_campaign)
 
+    campaign_activity.campaign_windows.publish(new_campaign)
+
     response = JSONResponse(
         content={
             "message": "Campaign created successfully",
@@ -65,6 +73,66 @@ def add(
 
     return response
 
+@router.post('/{campaign_id}/clone', status_code=status.HTTP_201_CREATED, tags=["Campaign"])
+def clone(
+    campaign_id: int,
+    request: schemas.CloneCampaign,
+    db: Session = Depends(get_db),
+    token: str = Depends(oauth2_scheme)):
+    """
+    Create a campaign with a copy of the active groups, contacts and pixels of a campaign, contacts scheduled as much later as the new start
+    :param campaign_id: int campaign copied
+    :param request: schemas.CloneCampaign, the description and the end default to the ones of the copied campaign, shifted
+    :param db: Session
+    :param token: str
+
+    :return: StreamingResponse of NDJSON progress lines followed by the new campaign id and the totals
+    """
+
+    account_name = utils.verify_token(token)
+
+    user = db.query(models.Users).filter(models.Users.account_name == account_name).first()
+
+    # Check if user is active
+    if user.deleted_datetime:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
+
+    source = db.query(models.Campaigns).filter(models.Campaigns.id == campaign_id).first()
+
+    if not source:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Campaign with id {campaign_id} not found")
+
+    if source.deleted_datetime:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Campaign is not active")
+
+    # Check if an active campaign has the same name
+    campaign = db.query(models.Campaigns).filter(models.Campaigns.campaign_name == request.campaign_name, models.Campaigns.deleted_datetime == None).first()
+    if campaign:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Campaign with name {request.campaign_name} already exists, deactivate it before creating another one with the same name.")
+
+    shift = request.start_datetime - source.start_datetime
+    new_campaign = models.Campaigns(
+        user_id = user.id,
+        campaign_name = request.campaign_name,
+        campaign_description = request.campaign_description if request.campaign_description is not None else source.campaign_description,
+        start_datetime = request.start_datetime,
+        end_datetime = request.end_datetime or source.end_datetime + shift
+    )
+
+    db.add(new_campaign)
+    db.commit()
+    db.refresh(new_campaign)
+
+    campaign_activity.campaign_windows.publish(new_campaign)
+
+    progress = campaign_clone.clone_campaign(campaign_id, new_campaign.id, shift)
+
+    return StreamingResponse(
+        (json.dumps(line) + "\n" for line in progress),
+        media_type="application/x-ndjson",
+        status_code=status.HTTP_201_CREATED
+    )
+
 @router.delete('/{campaign_id}', status_code=status.HTTP_200_OK, tags=["Campaign"])
 def delete(
     campaign_id: int,
@@ -98,6 +166,9 @@ def delete(
 
     db.refresh(campaign)
 
+    # Hits of the campaign stop being recorded on every worker
+    campaign_activity.campaign_windows.publish(campaign)
+
     response = JSONResponse(
         content={"message": f"Campaign with id {campaign_id} has been deleted"},
         status_code=status.HTTP_200_OK
@@ -105,12 +176,33 @@ def delete(
 
     return response
 
+def _campaign_filters(deleted: Optional[bool], from_datetime: Optional[datetime.datetime], to_datetime: Optional[datetime.datetime]) -> list:
+    filters = []
+    if deleted is not None:
+        filters.append(models.Campaigns.deleted_datetime != None if deleted else models.Campaigns.deleted_datetime == None)
+    if from_datetime:
+        filters.append(models.Campaigns.start_datetime >= from_datetime)
+    if to_datetime:
+        filters.append(models.Campaigns.start_datetime < to_datetime)
+    return filters
+
 @router.get('/', status_code=status.HTTP_200_OK, tags=["Campaign"])
 def get_campaigns(
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    deleted: Optional[bool] = None,
+    from_datetime: Optional[datetime.datetime] = None,
+    to_datetime: Optional[datetime.datetime] = None,
     db: Session = Depends(get_db),
     token: str = Depends(oauth2_scheme)):
     """
-    Get all campaigns
+    Get a page of campaigns by id, the cursor of the next page is in the X-Next-Cursor header
+    :param cursor: str cursor of the previous page
+    :param limit: int campaigns per page, up to PAGE_SIZE_MAX
+    :param deleted: bool only the deleted campaigns, or only the active ones
+    :param from_datetime: datetime.datetime campaigns starting from then
+    :param to_datetime: datetime.datetime campaigns starting before then
     :param db: Session
     :param token: str
 
@@ -125,10 +217,41 @@ def get_campaigns(
     if user.deleted_datetime:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
     
-    campaigns = db.query(models.Campaigns).all()
+    query = db.query(models.Campaigns).filter(*_campaign_filters(deleted, from_datetime, to_datetime))
+    campaigns = pagination.paginate(query, models.Campaigns.id, cursor, limit, response)
 
     return campaigns
 
+@router.get('/count', status_code=status.HTTP_200_OK, tags=["Campaign"])
+def count_campaigns(
+    deleted: Optional[bool] = None,
+    from_datetime: Optional[datetime.datetime] = None,
+    to_datetime: Optional[datetime.datetime] = None,
+    db: Session = Depends(get_db),
+    token: str = Depends(oauth2_scheme)):
+    """
+    Count the campaigns, with the filters of the list
+    :param deleted: bool only the deleted campaigns, or only the active ones
+    :param from_datetime: datetime.datetime campaigns starting from then
+    :param to_datetime: datetime.datetime campaigns starting before then
+    :param db: Session
+    :param token: str
+
+    :return: dict(count)
+    """
+
+    account_name = utils.verify_token(token)
+
+    user = db.query(models.Users).filter(models.Users.account_name == account_name).first()
+
+    # Check if user is active
+    if user.deleted_datetime:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
+
+    count = db.query(func.count(models.Campaigns.id)).filter(*_campaign_filters(deleted, from_datetime, to_datetime)).scalar()
+
+    return {"count": count}
+
 @router.get('/{campaign_id}', status_code=status.HTTP_200_OK, tags=["Campaign"])
 def get_campaign(
     campaign_id: int,
@@ -196,4 +319,6 @@ def update(
 
     db.refresh(campaign)
 
+    campaign_activity.campaign_windows.publish(campaign)
+
     return campaign
@@ -1,12 +1,18 @@
-from fastapi import APIRouter, FastAPI, Depends, HTTPException, status
+from fastapi import APIRouter, FastAPI, Depends, HTTPException, Response, status
+from sqlalchemy import func
 from sqlalchemy.orm import Session
+from typing import Optional
 import models, schemas
 from database import get_db
 from passlib.context import CryptContext
 from fastapi.responses import JSONResponse
+from fastapi import File, Query, UploadFile
 import string
 import random
 import utils
+import contact_import
+import open_rollups
+import pagination
 import datetime
 from utils import oauth2_scheme
 #import pytz
@@ -58,6 +64,10 @@ def add(
     if campaign.deleted_datetime:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Campaign is not active")
     
+    # Check if the uuid fits the uuid columns
+    if not utils.is_storable_uuid(request.uuid):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Contact uuid {request.uuid} is not a UUID.")
+
     # Check if the scheduled datetime is in the future
     #if request.scheduled_datetime < datetime.datetime.now(tz=pytz.utc):
     #    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Scheduled datetime must be in the future.")
@@ -70,6 +80,8 @@ def add(
     )
 
     db.add(new_contact)
+    if open_rollups.OPEN_ROLLUPS_ENABLED:
+        open_rollups.count_contacts(db, [(new_contact.campaign_id, new_contact.group_id, new_contact.scheduled_datetime)])
     db.commit()
     db.refresh(new_contact)
 
@@ -83,6 +95,46 @@ def add(
 
     return response
 
+@router.post('/import', status_code=status.HTTP_200_OK, tags=["Contact"])
+def import_contacts(
+    file: UploadFile = File(...),
+    input_format: str = Query(None, alias="format"),
+    db: Session = Depends(get_db),
+    token: str = Depends(oauth2_scheme)):
+    """
+    Bulk import contacts from a CSV file with a header line or an NDJSON file,
+    with the fields of schemas.AddContact
+    :param file: UploadFile
+    :param input_format: str, "format" query parameter, "csv" or "ndjson", guessed from the file name by default
+    :param db: Session
+    :param token: str
+
+    :return: JSONResponse(inserted, rejected, errors)
+    """
+
+    account_name = utils.verify_token(token)
+
+    user = db.query(models.Users).filter(models.Users.account_name == account_name).first()
+
+    # Check if user is active
+    if user.deleted_datetime:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
+
+    if not input_format:
+        input_format = "ndjson" if (file.filename or "").lower().endswith((".ndjson", ".jsonl")) else "csv"
+    if input_format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Format must be csv or ndjson.")
+
+    importer = contact_import.ContactImporter(db)
+    result = importer.import_file(file.file, input_format)
+
+    response = JSONResponse(
+        content=dict(result, message=f"{result['inserted']} contacts imported"),
+        status_code=status.HTTP_200_OK
+    )
+
+    return response
+
 @router.delete('/{uuid}', status_code=status.HTTP_200_OK, tags=["Contact"])
 def delete(
     uuid: str,
@@ -105,11 +157,13 @@ def delete(
     if user.deleted_datetime:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
     
-    contact = db.query(models.Contacts).filter(models.Contacts.uuid == uuid).first()
+    contact = db.query(models.Contacts).filter(models.Contacts.uuid == uuid).first() if utils.is_storable_uuid(uuid) else None
 
     if not contact:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Contact with id {uuid} not found")
 
+    if open_rollups.OPEN_ROLLUPS_ENABLED:
+        open_rollups.uncount_contact(db, contact)
     db.delete(contact)
 
     db.commit()
@@ -121,12 +175,37 @@ def delete(
 
     return response
 
+def _contact_filters(campaign_id: Optional[int], group_id: Optional[int], from_datetime: Optional[datetime.datetime], to_datetime: Optional[datetime.datetime]) -> list:
+    filters = []
+    if campaign_id is not None:
+        filters.append(models.Contacts.campaign_id == campaign_id)
+    if group_id is not None:
+        filters.append(models.Contacts.group_id == group_id)
+    if from_datetime:
+        filters.append(models.Contacts.scheduled_datetime >= from_datetime)
+    if to_datetime:
+        filters.append(models.Contacts.scheduled_datetime < to_datetime)
+    return filters
+
 @router.get('/', status_code=status.HTTP_200_OK, tags=["Contact"])
 def get_all(
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    campaign_id: Optional[int] = None,
+    group_id: Optional[int] = None,
+    from_datetime: Optional[datetime.datetime] = None,
+    to_datetime: Optional[datetime.datetime] = None,
     db: Session = Depends(get_db),
     token: str = Depends(oauth2_scheme)):
     """
-    Get all contacts
+    Get a page of contacts by uuid, the cursor of the next page is in the X-Next-Cursor header
+    :param cursor: str cursor of the previous page
+    :param limit: int contacts per page, up to PAGE_SIZE_MAX
+    :param campaign_id: int only the contacts of a campaign
+    :param group_id: int only the contacts of a group
+    :param from_datetime: datetime.datetime contacts scheduled from then
+    :param to_datetime: datetime.datetime contacts scheduled before then
     :param db: Session
     :param token: str
 
@@ -141,10 +220,43 @@ def get_all(
     if user.deleted_datetime:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
     
-    contacts = db.query(models.Contacts).all()
+    query = db.query(models.Contacts).filter(*_contact_filters(campaign_id, group_id, from_datetime, to_datetime))
+    contacts = pagination.paginate(query, models.Contacts.uuid, cursor, limit, response)
 
     return contacts
 
+@router.get('/count', status_code=status.HTTP_200_OK, tags=["Contact"])
+def count_contacts(
+    campaign_id: Optional[int] = None,
+    group_id: Optional[int] = None,
+    from_datetime: Optional[datetime.datetime] = None,
+    to_datetime: Optional[datetime.datetime] = None,
+    db: Session = Depends(get_db),
+    token: str = Depends(oauth2_scheme)):
+    """
+    Count the contacts, with the filters of the list
+    :param campaign_id: int only the contacts of a campaign
+    :param group_id: int only the contacts of a group
+    :param from_datetime: datetime.datetime contacts scheduled from then
+    :param to_datetime: datetime.datetime contacts scheduled before then
+    :param db: Session
+    :param token: str
+
+    :return: dict(count)
+    """
+
+    account_name = utils.verify_token(token)
+
+    user = db.query(models.Users).filter(models.Users.account_name == account_name).first()
+
+    # Check if user is active
+    if user.deleted_datetime:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
+
+    count = db.query(func.count(models.Contacts.uuid)).filter(*_contact_filters(campaign_id, group_id, from_datetime, to_datetime)).scalar()
+
+    return {"count": count}
+
 @router.get('/{uuid}', status_code=status.HTTP_200_OK, tags=["Contact"])
 def get(
     uuid: str,
@@ -167,7 +279,7 @@ def get(
     if user.deleted_datetime:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
     
-    contact = db.query(models.Contacts).filter(models.Contacts.uuid == uuid).first()
+    contact = db.query(models.Contacts).filter(models.Contacts.uuid == uuid).first() if utils.is_storable_uuid(uuid) else None
 
     if not contact:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Contact with id {uuid} not found")
@@ -177,11 +289,20 @@ def get(
 @router.get('/group/{group_id}', status_code=status.HTTP_200_OK, tags=["Contact"])
 def get_by_group(
     group_id: int,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    from_datetime: Optional[datetime.datetime] = None,
+    to_datetime: Optional[datetime.datetime] = None,
     db: Session = Depends(get_db),
     token: str = Depends(oauth2_scheme)):
     """
-    Get all contacts by group
+    Get a page of the contacts of a group by uuid, the cursor of the next page is in the X-Next-Cursor header
     :param group_id: int
+    :param cursor: str cursor of the previous page
+    :param limit: int contacts per page, up to PAGE_SIZE_MAX
+    :param from_datetime: datetime.datetime contacts scheduled from then
+    :param to_datetime: datetime.datetime contacts scheduled before then
     :param db: Session
     :param token: str
 
@@ -196,18 +317,28 @@ def get_by_group(
     if user.deleted_datetime:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
     
-    contacts = db.query(models.Contacts).filter(models.Contacts.group_id == group_id).all()
+    query = db.query(models.Contacts).filter(models.Contacts.group_id == group_id, *_contact_filters(None, None, from_datetime, to_datetime))
+    contacts = pagination.paginate(query, models.Contacts.uuid, cursor, limit, response)
 
     return contacts
 
 @router.get('/campaign/{campaign_id}', status_code=status.HTTP_200_OK, tags=["Contact"])
 def get_by_campaign(
     campaign_id: int,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    from_datetime: Optional[datetime.datetime] = None,
+    to_datetime: Optional[datetime.datetime] = None,
     db: Session = Depends(get_db),
     token: str = Depends(oauth2_scheme)):
     """
-    Get all contacts by campaign
+    Get a page of the contacts of a campaign by uuid, the cursor of the next page is in the X-Next-Cursor header
     :param campaign_id: int
+    :param cursor: str cursor of the previous page
+    :param limit: int contacts per page, up to PAGE_SIZE_MAX
+    :param from_datetime: datetime.datetime contacts scheduled from then
+    :param to_datetime: datetime.datetime contacts scheduled before then
     :param db: Session
     :param token: str
 
@@ -222,6 +353,7 @@ def get_by_campaign(
     if user.deleted_datetime:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
     
-    contacts = db.query(models.Contacts).filter(models.Contacts.campaign_id == campaign_id).all()
+    query = db.query(models.Contacts).filter(models.Contacts.campaign_id == campaign_id, *_contact_filters(None, None, from_datetime, to_datetime))
+    contacts = pagination.paginate(query, models.Contacts.uuid, cursor, limit, response)
 
     return contacts
\ No newline at end of file
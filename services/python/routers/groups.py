@@ -1,5 +1,7 @@
-from fastapi import APIRouter, FastAPI, Depends, HTTPException, status
+from fastapi import APIRouter, FastAPI, Depends, HTTPException, Response, status
+from sqlalchemy import func
 from sqlalchemy.orm import Session
+from typing import Optional
 import models, schemas
 from database import get_db
 from passlib.context import CryptContext
@@ -7,6 +9,7 @@ from fastapi.responses import JSONResponse
 import string
 import random
 import utils
+import pagination
 import datetime
 from utils import oauth2_scheme
 
@@ -110,13 +113,30 @@ def delete(
 
     return response
 
+def _group_filters(campaign_id: Optional[int], deleted: Optional[bool]) -> list:
+    filters = []
+    if campaign_id is not None:
+        filters.append(models.Groups.campaign_id == campaign_id)
+    if deleted is not None:
+        filters.append(models.Groups.deleted_datetime != None if deleted else models.Groups.deleted_datetime == None)
+    return filters
+
 @router.get('/', status_code=status.HTTP_200_OK, tags=["Group"])
 def get_groups(
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    campaign_id: Optional[int] = None,
+    deleted: Optional[bool] = None,
     db: Session = Depends(get_db),
     token: str = Depends(oauth2_scheme)):
 
     """
-    Get all groups
+    Get a page of groups by id, the cursor of the next page is in the X-Next-Cursor header
+    :param cursor: str cursor of the previous page
+    :param limit: int groups per page, up to PAGE_SIZE_MAX
+    :param campaign_id: int only the groups of a campaign
+    :param deleted: bool only the deleted groups, or only the active ones
     :param db: Session
     :param token: str
 
@@ -131,10 +151,40 @@ def get_groups(
     if user.deleted_datetime:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
 
-    groups = db.query(models.Groups).all()
+    query = db.query(models.Groups).filter(*_group_filters(campaign_id, deleted))
+    groups = pagination.paginate(query, models.Groups.id, cursor, limit, response)
 
     return groups
 
+@router.get('/count', status_code=status.HTTP_200_OK, tags=["Group"])
+def count_groups(
+    campaign_id: Optional[int] = None,
+    deleted: Optional[bool] = None,
+    db: Session = Depends(get_db),
+    token: str = Depends(oauth2_scheme)):
+
+    """
+    Count the groups, with the filters of the list
+    :param campaign_id: int only the groups of a campaign
+    :param deleted: bool only the deleted groups, or only the active ones
+    :param db: Session
+    :param token: str
+
+    :return: dict(count)
+    """
+
+    account_name = utils.verify_token(token)
+
+    user = db.query(models.Users).filter(models.Users.account_name == account_name).first()
+
+    # Check if user is active
+    if user.deleted_datetime:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
+
+    count = db.query(func.count(models.Groups.id)).filter(*_group_filters(campaign_id, deleted)).scalar()
+
+    return {"count": count}
+
 @router.get('/{id}', status_code=status.HTTP_200_OK, tags=["Group"])
 def get_group(
     id: int,
@@ -1,16 +1,24 @@
-from fastapi import APIRouter, FastAPI, Depends, HTTPException, status
+from fastapi import APIRouter, FastAPI, Depends, HTTPException, Response, status
+from sqlalchemy import false, func
 from sqlalchemy.orm import Session
+from typing import Optional
 import models, schemas
 from database import get_db
 from passlib.context import CryptContext
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 import string
 import random
 import utils
-import datetime
+import tracking
+import journal
+import pixel_filter
+import pixel_provisioning
+import pixel_render
+import pagination
+import jinja2
+import json
 from utils import oauth2_scheme
 from fastapi import Request
-from fastapi.responses import FileResponse
 
 router = APIRouter(
     prefix="/pixel",
@@ -24,7 +32,7 @@ def add(
     token: str = Depends(oauth2_scheme)):
     """
     Add a new pixel to contact
-    :param request: schemas.AddPixel
+    :param request: schemas.AddPixel, signed=True also issues a signed pixel url
     :param db: Session
     :param token: str
 
@@ -40,7 +48,7 @@ def add(
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
     
     # Check if the contact exists
-    contact = db.query(models.Contacts).filter(models.Contacts.uuid == request.contact_uuid).first()
+    contact = db.query(models.Contacts).filter(models.Contacts.uuid == request.contact_uuid).first() if utils.is_storable_uuid(request.contact_uuid) else None
     if not contact:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Contact with uuid {request.contact_uuid} not found.")
     
@@ -50,79 +58,246 @@ def add(
     if contact_pixel:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Contact with uuid {request.contact_uuid} already has pixel number {request.contact_pixel_number}.")
 
+    if request.signed and not utils.PIXEL_SIGNING_KEY:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Signed pixels are not enabled, PIXEL_SIGNING_KEY is not set.")
+
     new_pixel = models.Pixels(
         uuid = utils.generate_uuid4(),
         contact_uuid = request.contact_uuid,
-        contact_pixel_number = request.contact_pixel_number
+        contact_pixel_number = request.contact_pixel_number,
+        ordinal = utils.allocate_pixel_ordinals(db, contact.campaign_id)
     )
 
     db.add(new_pixel)
     db.commit()
     db.refresh(new_pixel)
 
+    if pixel_filter.PIXEL_FILTER_ENABLED:
+        pixel_filter.known_pixels.register([new_pixel.uuid])
+
+    content = {
+        "message": "Pixel created successfully",
+        "uuid": new_pixel.uuid
+    }
+    if request.signed:
+        content["signed_uuid"] = utils.sign_pixel(utils.PixelRef(new_pixel.uuid, contact.uuid, contact.group_id, contact.campaign_id, new_pixel.ordinal))
+
     response = JSONResponse(
-        content={
-            "message": "Pixel created successfully",
-            "uuid": new_pixel.uuid
-        },
+        content=content,
         status_code=status.HTTP_201_CREATED
     )
 
     return response
 
+def _resolve_campaign(db: Session, campaign_id: int, group_id: int) -> int:
+    """
+    Check the active group or campaign targeted by a bulk operation
+    :param db: Session
+    :param campaign_id: int, optional if group_id is given
+    :param group_id: int, None for the whole campaign
+
+    :return: int campaign id
+    """
+    if group_id is not None:
+        group = db.query(models.Groups).filter(models.Groups.id == group_id).first()
+        if not group:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Group with id {group_id} not found.")
+        if group.deleted_datetime:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Group is not active.")
+        if campaign_id is not None and campaign_id != group.campaign_id:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Group with id {group_id} is not in campaign {campaign_id}.")
+        campaign_id = group.campaign_id
+
+    if campaign_id is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="A group_id or a campaign_id is required.")
+
+    campaign = db.query(models.Campaigns).filter(models.Campaigns.id == campaign_id).first()
+    if not campaign:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Campaign with id {campaign_id} not found.")
+    if campaign.deleted_datetime:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Campaign is not active")
+
+    return campaign_id
+
+@router.post('/provision', status_code=status.HTTP_201_CREATED, tags=["Pixel"])
+def provision(
+    request: schemas.ProvisionPixels,
+    db: Session = Depends(get_db),
+    token: str = Depends(oauth2_scheme)):
+    """
+    Create pixels 1 to pixels_per_contact of every contact of a group or campaign, existing ones are kept
+    :param request: schemas.ProvisionPixels, with group_id or campaign_id
+    :param db: Session
+    :param token: str
+
+    :return: StreamingResponse of NDJSON created pixels followed by the created and skipped totals
+    """
+
+    account_name = utils.verify_token(token)
+
+    user = db.query(models.Users).filter(models.Users.account_name == account_name).first()
+
+    # Check if user is active
+    if user.deleted_datetime:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
+
+    if request.pixels_per_contact < 1:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="pixels_per_contact must be at least 1.")
+
+    if request.signed and not utils.PIXEL_SIGNING_KEY:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Signed pixels are not enabled, PIXEL_SIGNING_KEY is not set.")
+
+    campaign_id = _resolve_campaign(db, request.campaign_id, request.group_id)
+
+    pixels = pixel_provisioning.provision_pixels(campaign_id, request.group_id, request.pixels_per_contact, request.signed)
+
+    return StreamingResponse(
+        (json.dumps(pixel) + "\n" for pixel in pixels),
+        media_type="application/x-ndjson",
+        status_code=status.HTTP_201_CREATED
+    )
+
+@router.post('/render', status_code=status.HTTP_200_OK, tags=["Pixel"])
+def render(
+    request: schemas.RenderPixels,
+    http_request: Request,
+    db: Session = Depends(get_db),
+    token: str = Depends(oauth2_scheme)):
+    """
+    Render a Jinja2 email template for every contact of a group or campaign with its pixel urls
+    :param request: schemas.RenderPixels, the template gets pixel_url, pixel_urls, contact_uuid, group_id, campaign_id and scheduled_datetime
+    :param http_request: Request, its base url is used when base_url is not given
+    :param db: Session
+    :param token: str
+
+    :return: StreamingResponse of NDJSON {contact_uuid, html} or {contact_uuid, error} lines followed by the totals, or multipart/mixed html documents
+    """
+
+    account_name = utils.verify_token(token)
+
+    user = db.query(models.Users).filter(models.Users.account_name == account_name).first()
+
+    # Check if user is active
+    if user.deleted_datetime:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
+
+    if request.output not in ("ndjson", "html"):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Output must be ndjson or html.")
+
+    if request.signed and not utils.PIXEL_SIGNING_KEY:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Signed pixels are not enabled, PIXEL_SIGNING_KEY is not set.")
+
+    campaign_id = _resolve_campaign(db, request.campaign_id, request.group_id)
+
+    try:
+        template = pixel_render.compile_template(request.template)
+        pixel_render.check_template(template)
+    except jinja2.exceptions.SecurityError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Template refused: {e}")
+    except jinja2.TemplateError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid template: {e}")
+    except Exception as e:
+        # A filter or an operation of the template failing on the sample values
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Template failed to render: {e}")
+
+    base_url = request.base_url or f"{str(http_request.base_url).rstrip('/')}{router.prefix}/"
+    boundary = pixel_render.new_boundary()
+    documents = pixel_render.render_contacts(template, base_url, campaign_id, request.group_id, request.output, request.signed, boundary)
+
+    return StreamingResponse(
+        documents,
+        media_type="application/x-ndjson" if request.output == "ndjson" else f"multipart/mixed; boundary={boundary}"
+    )
+
+def _filter_pixels(query, contact_uuid: Optional[str], campaign_id: Optional[int], group_id: Optional[int]):
+    if contact_uuid is not None:
+        query = query.filter(models.Pixels.contact_uuid == contact_uuid) if utils.is_storable_uuid(contact_uuid) else query.filter(false())
+    if campaign_id is not None or group_id is not None:
+        query = query.join(models.Contacts, models.Pixels.contact_uuid == models.Contacts.uuid)
+    if campaign_id is not None:
+        query = query.filter(models.Contacts.campaign_id == campaign_id)
+    if group_id is not None:
+        query = query.filter(models.Contacts.group_id == group_id)
+    return query
+
+# Declared before the pixel route, which takes any path
+@router.get('/count', tags=["Pixel"])
+def count_pixels(
+    contact_uuid: Optional[str] = None,
+    campaign_id: Optional[int] = None,
+    group_id: Optional[int] = None,
+    db: Session = Depends(get_db)):
+    """
+    Count the pixels, with the filters of the list
+    :param contact_uuid: str only the pixels of a contact
+    :param campaign_id: int only the pixels of the contacts of a campaign
+    :param group_id: int only the pixels of the contacts of a group
+    :param db: Session
+
+    :return: dict(count)
+    """
+    count = _filter_pixels(db.query(func.count(models.Pixels.uuid)).select_from(models.Pixels), contact_uuid, campaign_id, group_id).scalar()
+
+    return {"count": count}
+
 @router.get('/{uuid}', tags=["Pixel"])
 def get(
     request: Request,
     uuid: str,
     db: Session = Depends(get_db)):
     """
-    Get a pixel by uuid
-    :param uuid: str
+    Get a pixel by uuid, served from memory
+    :param uuid: str, optionally suffixed with .gif, .png or .webp
     :param db: Session
 
-    :return: schemas.GetPixel
+    :return: utils.PixelResponse
     """
 
-    utils.write_pixel()
-
-    # Check if the pixel exists in redis
-    from_redis = utils.get_from_redis(key=uuid)
+    uuid, image_format = utils.split_pixel_format(uuid)
 
-    if from_redis:
-        return FileResponse("tracking_pixel.gif", media_type="image/gif")
-    else:
-        utils.save_to_redis(key=uuid, value=request.client.host)
+    # Signed pixels carry their attribution, classic uuids are looked up
+    ref = None
+    if utils.is_signed_pixel(uuid):
+        ref = utils.verify_signed_pixel(uuid)
+        if not ref:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Invalid signed pixel.")
+        uuid = ref.pixel_uuid
 
-        # Check if pixel exists
-        pixel = db.query(models.Pixels).filter(models.Pixels.uuid == uuid).first()
-        if not pixel:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Pixel with uuid {uuid} not found.")
-    
-        # Check if views already exists
-        views = db.query(models.Views).filter(models.Views.pixel_uuid == pixel.uuid).all()
-        if not views:
-            # Add a View
-            new_view = models.Views(
-                view_datetime = datetime.datetime.utcnow(),
-                pixel_uuid = pixel.uuid
-            )
-    
-            db.add(new_view)
-            db.commit()
-            db.refresh(new_view)
+    try:
+        tracking.track_hit(db, uuid, request.client.host, ref, request.headers.get("user-agent", ""))
+    except tracking.BACKEND_ERRORS as e:
+        if not journal.JOURNAL_ENABLED:
+            raise
+        # Redis or MySQL are down, the hit is replayed from the local journal
+        print(f"Error in pixel hit, journaling it: {e}")
+        # Decoded tabs and newlines would split or forge journal lines
+        if utils.is_storable_uuid(uuid) and uuid.isprintable():
+            journal.hit_journal.append(uuid, client_host=request.client.host, user_agent=request.headers.get("user-agent", ""))
 
-        return FileResponse("tracking_pixel.gif", media_type="image/gif")
+    return utils.PixelResponse(image_format)
     
 
 @router.get('/', tags=["Pixel"])
 def get_all(
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    contact_uuid: Optional[str] = None,
+    campaign_id: Optional[int] = None,
+    group_id: Optional[int] = None,
     db: Session = Depends(get_db)):
     """
-    Get all pixels
+    Get a page of pixels by uuid, the cursor of the next page is in the X-Next-Cursor header
+    :param cursor: str cursor of the previous page
+    :param limit: int pixels per page, up to PAGE_SIZE_MAX
+    :param contact_uuid: str only the pixels of a contact
+    :param campaign_id: int only the pixels of the contacts of a campaign
+    :param group_id: int only the pixels of the contacts of a group
     :param db: Session
 
     :return: schemas.GetPixel
     """
-    pixels = db.query(models.Pixels).all()
+    query = _filter_pixels(db.query(models.Pixels), contact_uuid, campaign_id, group_id)
+    pixels = pagination.paginate(query, models.Pixels.uuid, cursor, limit, response)
     
     return pixels
\ No newline at end of file
@@ -0,0 +1,253 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from typing import Optional, Tuple
+import datetime
+import os
+import models
+from database import get_db
+import utils
+import journal
+import pixel_filter
+import campaign_activity
+import tracking
+import open_classifier
+import view_shards
+import open_rollups
+from utils import oauth2_scheme
+
+# Pixel uuids per IN list when counting the views of a campaign on the shards
+CAMPAIGN_VIEWS_CHUNK = int(os.getenv("CAMPAIGN_VIEWS_CHUNK", 1000))
+
+router = APIRouter(
+    prefix="/stats",
+    tags=["Stats"]
+)
+
+@router.get('/', status_code=status.HTTP_200_OK, tags=["Stats"])
+def get_stats(
+    db: Session = Depends(get_db),
+    token: str = Depends(oauth2_scheme)):
+    """
+    Get the pixel hot path statistics of this worker
+    :param db: Session
+    :param token: str
+
+    :return: dict of statistics
+    """
+
+    account_name = utils.verify_token(token)
+
+    user = db.query(models.Users).filter(models.Users.account_name == account_name).first()
+
+    # Check if user is active
+    if user.deleted_datetime:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
+
+    return {
+        "redis": {
+            "pool": utils.get_redis_pool_stats(),
+            "dedupe": utils.get_dedupe_stats()
+        },
+        "rate_limit": dict(utils.rate_limit_stats.snapshot(), enabled=utils.RATE_LIMIT_ENABLED),
+        "journal": journal.hit_journal.get_stats(),
+        "pixel_filter": pixel_filter.known_pixels.get_stats(),
+        "campaign_activity": dict(
+            campaign_activity.campaign_windows.get_stats(),
+            pixel_refs_cached=len(tracking.pixel_refs) if tracking.pixel_refs is not None else 0
+        ),
+        "machine_opens": dict(
+            open_classifier.open_classifier.get_stats(),
+            counters=open_classifier.machine_opens.get_stats()
+        ),
+        "view_shards": view_shards.view_shards.get_stats()
+    }
+
+@router.get('/dedupe/{campaign_id}', status_code=status.HTTP_200_OK, tags=["Stats"])
+def get_dedupe_memory(
+    campaign_id: int,
+    db: Session = Depends(get_db),
+    token: str = Depends(oauth2_scheme)):
+    """
+    Get the Redis memory used by the dedupe bitmaps of a campaign
+    :param campaign_id: int
+    :param db: Session
+    :param token: str
+
+    :return: dict of memory usage per dedupe window
+    """
+
+    account_name = utils.verify_token(token)
+
+    user = db.query(models.Users).filter(models.Users.account_name == account_name).first()
+
+    # Check if user is active
+    if user.deleted_datetime:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
+
+    campaign = db.query(models.Campaigns).filter(models.Campaigns.id == campaign_id).first()
+    if not campaign:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Campaign with id {campaign_id} not found")
+
+    pixels = db.query(models.Pixels).join(models.Contacts, models.Pixels.contact_uuid == models.Contacts.uuid).filter(models.Contacts.campaign_id == campaign_id).count()
+
+    return utils.get_bitmap_dedupe_report(campaign_id, pixels)
+
+@router.get('/views/{campaign_id}', status_code=status.HTTP_200_OK, tags=["Stats"])
+def get_campaign_views(
+    campaign_id: int,
+    db: Session = Depends(get_db),
+    token: str = Depends(oauth2_scheme)):
+    """
+    Count the views of a campaign within its start and end datetimes, raw and compacted ones
+    :param campaign_id: int
+    :param db: Session
+    :param token: str
+
+    :return: dict of human and machine view counts
+    """
+
+    account_name = utils.verify_token(token)
+
+    user = db.query(models.Users).filter(models.Users.account_name == account_name).first()
+
+    # Check if user is active
+    if user.deleted_datetime:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
+
+    campaign = db.query(models.Campaigns).filter(models.Campaigns.id == campaign_id).first()
+    if not campaign:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Campaign with id {campaign_id} not found")
+
+    campaign_pixels = db.query(models.Pixels.uuid).join(
+        models.Contacts, models.Pixels.contact_uuid == models.Contacts.uuid
+    ).filter(models.Contacts.campaign_id == campaign_id)
+
+    if view_shards.view_shards.enabled:
+        # The pixels are on the main database, each shard counts the views of its own pixels
+        pixels_by_shard = view_shards.view_shards.by_shard(row.uuid for row in campaign_pixels)
+
+        def count_shard(hit_db, shard):
+            pixel_uuids = pixels_by_shard.get(shard, [])
+            counts = [0, 0, 0, 0]
+            for i in range(0, len(pixel_uuids), CAMPAIGN_VIEWS_CHUNK):
+                chunk = pixel_uuids[i:i + CAMPAIGN_VIEWS_CHUNK]
+                for i_count, count in enumerate(_count_campaign_views(hit_db, campaign, lambda column: column.in_(chunk))):
+                    counts[i_count] += count
+            return counts
+
+        shard_counts = view_shards.view_shards.fan_out(db, count_shard)
+        raw_views, raw_machine_views, compacted_views, compacted_machine_views = [sum(counts) for counts in zip(*shard_counts)]
+    else:
+        raw_views, raw_machine_views, compacted_views, compacted_machine_views = _count_campaign_views(
+            db, campaign, lambda column: column.in_(campaign_pixels.subquery().select())
+        )
+
+    return {
+        "campaign_id": campaign_id,
+        "views": raw_views - raw_machine_views + compacted_views,
+        "machine_views": raw_machine_views + compacted_machine_views,
+        "compacted_views": compacted_views + compacted_machine_views
+    }
+
+@router.get('/opens/{campaign_id}', status_code=status.HTTP_200_OK, tags=["Stats"])
+def get_campaign_opens(
+    campaign_id: int,
+    group_id: Optional[int] = None,
+    from_datetime: Optional[datetime.datetime] = None,
+    to_datetime: Optional[datetime.datetime] = None,
+    per_group: bool = False,
+    db: Session = Depends(get_db),
+    token: str = Depends(oauth2_scheme)):
+    """
+    Get the opens, opened contacts and sent contacts of a campaign per hour, from the open rollups
+    :param campaign_id: int
+    :param group_id: int only the buckets of a group
+    :param from_datetime: datetime.datetime hours from the one of then
+    :param to_datetime: datetime.datetime hours before then
+    :param per_group: bool one bucket per group and hour instead of per hour
+    :param db: Session
+    :param token: str
+
+    :return: dict of the totals and open rate, and of the buckets sorted by hour
+    """
+
+    account_name = utils.verify_token(token)
+
+    user = db.query(models.Users).filter(models.Users.account_name == account_name).first()
+
+    # Check if user is active
+    if user.deleted_datetime:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
+
+    campaign = db.query(models.Campaigns).filter(models.Campaigns.id == campaign_id).first()
+    if not campaign:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Campaign with id {campaign_id} not found")
+
+    rollups = models.OpenRollups
+    filters = [rollups.campaign_id == campaign_id]
+    if group_id is not None:
+        filters.append(rollups.group_id == group_id)
+    if from_datetime:
+        filters.append(rollups.hour >= open_rollups.hour_start(from_datetime))
+    if to_datetime:
+        filters.append(rollups.hour < to_datetime)
+
+    keys = [rollups.hour, rollups.group_id] if per_group else [rollups.hour]
+    buckets = []
+    for row in db.query(
+        *keys, func.sum(rollups.opens), func.sum(rollups.opened_contacts), func.sum(rollups.sent_contacts)
+    ).filter(*filters).group_by(*keys).order_by(*keys):
+        opens, opened_contacts, sent_contacts = (int(value) for value in row[len(keys):])
+        bucket = {"hour": row[0], "opens": opens, "opened_contacts": opened_contacts, "sent_contacts": sent_contacts}
+        if per_group:
+            bucket["group_id"] = row[1]
+        buckets.append(bucket)
+
+    totals = {name: sum(bucket[name] for bucket in buckets) for name in ["opens", "opened_contacts", "sent_contacts"]}
+    # A contact is counted as opened in the hour of its first open only, a range of hours may open contacts sent before it
+    totals["open_rate"] = totals["opened_contacts"] / totals["sent_contacts"] if totals["sent_contacts"] else None
+
+    return {
+        "campaign_id": campaign_id,
+        "totals": totals,
+        "buckets": buckets
+    }
+
+def _campaign_views_queries(db: Session, campaign: models.Campaigns, of_pixels) -> Tuple:
+    """
+    Queries of the views of pixels within the start and end datetimes of a campaign
+    :param of_pixels: callable of a pixel uuid column returning the condition selecting the pixels
+    :return: tuple of the query of the raw and raw machine view counts, and of the query of the compacted counts by machine label
+    """
+    # Bounded by the campaign dates, only the partitions of its months are read
+    raw = db.query(func.count(), func.count(models.Views.machine_label)).filter(
+        of_pixels(models.Views.pixel_uuid),
+        models.Views.view_datetime >= campaign.start_datetime,
+        models.Views.view_datetime < campaign.end_datetime
+    )
+    compacted = db.query(models.ViewsMonthly.machine_label, func.sum(models.ViewsMonthly.view_count)).filter(
+        of_pixels(models.ViewsMonthly.pixel_uuid),
+        models.ViewsMonthly.month >= campaign.start_datetime.date().replace(day=1),
+        models.ViewsMonthly.month <= campaign.end_datetime.date()
+    ).group_by(models.ViewsMonthly.machine_label)
+    return raw, compacted
+
+def _count_campaign_views(db: Session, campaign: models.Campaigns, of_pixels) -> Tuple[int, int, int, int]:
+    """
+    Count the views of pixels within the start and end datetimes of a campaign
+    :param of_pixels: callable of a pixel uuid column returning the condition selecting the pixels
+    :return: tuple of raw views, raw machine views, compacted views, compacted machine views
+    """
+    raw, compacted = _campaign_views_queries(db, campaign, of_pixels)
+    raw_views, raw_machine_views = raw.one()
+
+    compacted_views = 0
+    compacted_machine_views = 0
+    for machine_label, view_count in compacted:
+        if machine_label:
+            compacted_machine_views += view_count
+        else:
+            compacted_views += view_count
+
+    return raw_views, raw_machine_views, compacted_views, compacted_machine_views
@@ -1,5 +1,7 @@
-from fastapi import APIRouter, FastAPI, Depends, HTTPException, status
+from fastapi import APIRouter, FastAPI, Depends, HTTPException, Response, status
+from sqlalchemy import false, func
 from sqlalchemy.orm import Session
+from typing import Callable, List, Optional
 import models, schemas
 from database import get_db
 from passlib.context import CryptContext
@@ -7,27 +9,73 @@ from fastapi.responses import JSONResponse
 import string
 import random
 import utils
+import log_replay
+import view_shards
+import pagination
+import view_export
+import os
 import datetime
 from utils import oauth2_scheme
 from fastapi import Request
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 
 router = APIRouter(
     prefix="/view",
     tags=["View"]
 )
 
+def _view_filters(db: Session, pixel_uuid: Optional[str], campaign_id: Optional[int], group_id: Optional[int],
+                  from_datetime: Optional[datetime.datetime], to_datetime: Optional[datetime.datetime]) -> Callable[[Optional[str]], List]:
+    """
+    :return: callable of a view shard name, None without shards, returning the filters of the views on it
+    """
+    filters = []
+    if pixel_uuid is not None:
+        filters.append(models.Views.pixel_uuid == pixel_uuid if utils.is_storable_uuid(pixel_uuid) else false())
+    if from_datetime:
+        filters.append(models.Views.view_datetime >= from_datetime)
+    if to_datetime:
+        filters.append(models.Views.view_datetime < to_datetime)
+    if campaign_id is None and group_id is None:
+        return lambda shard: filters
+
+    pixels = db.query(models.Pixels.uuid).join(models.Contacts, models.Pixels.contact_uuid == models.Contacts.uuid)
+    if campaign_id is not None:
+        pixels = pixels.filter(models.Contacts.campaign_id == campaign_id)
+    if group_id is not None:
+        pixels = pixels.filter(models.Contacts.group_id == group_id)
+    if not view_shards.view_shards.enabled:
+        return lambda shard: filters + [models.Views.pixel_uuid.in_(pixels.subquery().select())]
+    # The pixels are on the main database, each shard gets the list of its own
+    pixels_by_shard = view_shards.view_shards.by_shard(row.uuid for row in pixels)
+    return lambda shard: filters + [models.Views.pixel_uuid.in_(pixels_by_shard.get(shard, []))]
+
 @router.get('/', status_code=status.HTTP_200_OK, tags=["View"])
 def get_views(
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    pixel_uuid: Optional[str] = None,
+    campaign_id: Optional[int] = None,
+    group_id: Optional[int] = None,
+    from_datetime: Optional[datetime.datetime] = None,
+    to_datetime: Optional[datetime.datetime] = None,
     db: Session = Depends(get_db),
     token: str = Depends(oauth2_scheme)):
 
     """
-    Get all groups
+    Get a page of views by view shard and id, the cursor of the next page is in the X-Next-Cursor header
+    :param cursor: str cursor of the previous page
+    :param limit: int views per page, up to PAGE_SIZE_MAX
+    :param pixel_uuid: str only the views of a pixel
+    :param campaign_id: int only the views of the pixels of a campaign
+    :param group_id: int only the views of the pixels of a group
+    :param from_datetime: datetime.datetime views from then
+    :param to_datetime: datetime.datetime views before then
     :param db: Session
     :param token: str
 
-    :return: List[schemas.Group]
+    :return: List[schemas.View]
     """
 
     account_name = utils.verify_token(token)
@@ -38,6 +86,185 @@ def get_views(
     if user.deleted_datetime:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
     
-    views = db.query(models.Views).all()
+    size = pagination.page_size(limit)
+    # Ids are per view shard, the shards are read one after the other
+    shards = sorted(view_shards.view_shards.session_makers(), key=str)
+    after = pagination.decode_cursor(cursor, 2)
+    if after and after[0] not in shards:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor.")
+    first, last_id = (shards.index(after[0]), after[1]) if after else (0, None)
+    filters = _view_filters(db, pixel_uuid, campaign_id, group_id, from_datetime, to_datetime)
+
+    views = []
+    next_cursor = None
+    for i in range(first, len(shards)):
+        with view_shards.view_shards.session(db, shards[i]) as hit_db:
+            rows, more = pagination.keyset_page(hit_db.query(models.Views).filter(*filters(shards[i])), models.Views.id, last_id, size - len(views))
+        views += rows
+        last_id = None
+        if more:
+            next_cursor = [shards[i], rows[-1].id]
+            break
+        if len(views) == size:
+            next_cursor = [shards[i + 1], None] if i + 1 < len(shards) else None
+            break
+    pagination.set_next_cursor(response, next_cursor)
+
+    return views
+
+@router.get('/count', status_code=status.HTTP_200_OK, tags=["View"])
+def count_views(
+    pixel_uuid: Optional[str] = None,
+    campaign_id: Optional[int] = None,
+    group_id: Optional[int] = None,
+    from_datetime: Optional[datetime.datetime] = None,
+    to_datetime: Optional[datetime.datetime] = None,
+    db: Session = Depends(get_db),
+    token: str = Depends(oauth2_scheme)):
+    """
+    Count the views, with the filters of the list
+    :param pixel_uuid: str only the views of a pixel
+    :param campaign_id: int only the views of the pixels of a campaign
+    :param group_id: int only the views of the pixels of a group
+    :param from_datetime: datetime.datetime views from then
+    :param to_datetime: datetime.datetime views before then
+    :param db: Session
+    :param token: str
+
+    :return: dict(count)
+    """
+
+    account_name = utils.verify_token(token)
+
+    user = db.query(models.Users).filter(models.Users.account_name == account_name).first()
+
+    # Check if user is active
+    if user.deleted_datetime:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
+
+    filters = _view_filters(db, pixel_uuid, campaign_id, group_id, from_datetime, to_datetime)
+    counts = view_shards.view_shards.fan_out(db, lambda hit_db, shard: hit_db.query(func.count(models.Views.id)).filter(*filters(shard)).scalar())
+
+    return {"count": sum(counts)}
+
+@router.get('/export/{campaign_id}', status_code=status.HTTP_200_OK, tags=["View"])
+def export(
+    campaign_id: int,
+    output: str = "ndjson",
+    gzip: bool = False,
+    group_id: Optional[int] = None,
+    from_datetime: Optional[datetime.datetime] = None,
+    to_datetime: Optional[datetime.datetime] = None,
+    db: Session = Depends(get_db),
+    token: str = Depends(oauth2_scheme)):
+    """
+    Stream the views of a campaign with their pixel, contact, group and campaign
+    :param campaign_id: int
+    :param output: str "ndjson" or "csv"
+    :param gzip: bool gzip the stream
+    :param group_id: int only the views of the pixels of a group
+    :param from_datetime: datetime.datetime views from then
+    :param to_datetime: datetime.datetime views before then
+    :param db: Session
+    :param token: str
+
+    :return: StreamingResponse of the NDJSON or CSV views, as a file attachment
+    """
+
+    account_name = utils.verify_token(token)
+
+    user = db.query(models.Users).filter(models.Users.account_name == account_name).first()
+
+    # Check if user is active
+    if user.deleted_datetime:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
+
+    if output not in ("ndjson", "csv"):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Output must be ndjson or csv.")
+
+    campaign = db.query(models.Campaigns).filter(models.Campaigns.id == campaign_id).first()
+    if not campaign:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Campaign with id {campaign_id} not found")
+
+    chunks = view_export.export_views(campaign_id, group_id, output, from_datetime, to_datetime)
+    filename = f"views_{campaign_id}.{output}"
+    media_type = "application/x-ndjson" if output == "ndjson" else "text/csv"
+    if gzip:
+        chunks = view_export.gzip_chunks(chunks)
+        filename += ".gz"
+        media_type = "application/gzip"
+
+    return StreamingResponse(
+        chunks,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@router.post('/replay', status_code=status.HTTP_202_ACCEPTED, tags=["View"])
+def replay(
+    request: schemas.ReplayLogs,
+    db: Session = Depends(get_db),
+    token: str = Depends(oauth2_scheme)):
+    """
+    Start replaying the pixel hits of access log files of LOG_REPLAY_DIR into Views, in background
+    :param request: schemas.ReplayLogs, paths relative to LOG_REPLAY_DIR
+    :param db: Session
+    :param token: str
+
+    :return: JSONResponse(job_id, status), the job is followed with GET /view/replay/{job_id}
+    """
+
+    account_name = utils.verify_token(token)
+
+    user = db.query(models.Users).filter(models.Users.account_name == account_name).first()
+
+    # Check if user is active
+    if user.deleted_datetime:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
+
+    log_dir = os.path.realpath(log_replay.LOG_REPLAY_DIR)
+    paths = []
+    for path in request.paths:
+        full_path = os.path.realpath(os.path.join(log_dir, path))
+        if os.path.commonpath([log_dir, full_path]) != log_dir:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Log file {path} is outside of the log directory.")
+        if not os.path.isfile(full_path):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Log file {path} not found.")
+        paths.append(full_path)
+
+    job_id = log_replay.start_job(paths, request.workers or log_replay.LOG_REPLAY_WORKERS)
+
+    response = JSONResponse(
+        content={"job_id": job_id, "status": "running"},
+        status_code=status.HTTP_202_ACCEPTED
+    )
+
+    return response
+
+@router.get('/replay/{job_id}', status_code=status.HTTP_200_OK, tags=["View"])
+def get_replay(
+    job_id: str,
+    db: Session = Depends(get_db),
+    token: str = Depends(oauth2_scheme)):
+    """
+    Get the status of a log replay job
+    :param job_id: str id returned by POST /view/replay
+    :param db: Session
+    :param token: str
+
+    :return: dict of the job status, with the counters of each file once done
+    """
+
+    account_name = utils.verify_token(token)
+
+    user = db.query(models.Users).filter(models.Users.account_name == account_name).first()
+
+    # Check if user is active
+    if user.deleted_datetime:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User is not active.")
+
+    job = log_replay.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Replay job {job_id} not found.")
 
-    return views
\ No newline at end of file
+    return job
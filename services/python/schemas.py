@@ -1,6 +1,6 @@
 from pydantic import BaseModel
 from sqlalchemy import Column, Integer, String, Float, Date, DateTime, ForeignKey
-from typing import Optional
+from typing import List, Optional
 import datetime
 
 class AddUser(BaseModel):
@@ -17,6 +17,12 @@ class AddCampaign(BaseModel):
     start_datetime: datetime.datetime
     end_datetime: datetime.datetime
 
+class CloneCampaign(BaseModel):
+    campaign_name: str
+    campaign_description: Optional[str] = None
+    start_datetime: datetime.datetime
+    end_datetime: Optional[datetime.datetime] = None
+
 class AddContact(BaseModel):
     uuid: str
     campaign_id: int
@@ -49,7 +55,26 @@ class UpdateCampaign(BaseModel):
 class AddPixel(BaseModel):
     contact_uuid: str
     contact_pixel_number: int
+    signed: bool = False
+
+class ProvisionPixels(BaseModel):
+    campaign_id: Optional[int] = None
+    group_id: Optional[int] = None
+    pixels_per_contact: int = 1
+    signed: bool = False
+
+class RenderPixels(BaseModel):
+    template: str
+    campaign_id: Optional[int] = None
+    group_id: Optional[int] = None
+    output: str = "ndjson"
+    base_url: Optional[str] = None
+    signed: bool = False
 
 class AddView(BaseModel):
     view_datetime: datetime.datetime
-    pixel_uuid: str
\ No newline at end of file
+    pixel_uuid: str
+
+class ReplayLogs(BaseModel):
+    paths: List[str]
+    workers: Optional[int] = None
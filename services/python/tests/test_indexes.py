@@ -0,0 +1,139 @@
+"""
+The queries of the endpoints and of the pixel hot path use an index, on a
+scratch SQLite database upgraded with the Alembic migrations.
+
+    cd services/python && python -m unittest discover tests
+"""
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# utils and database read their settings at import, no server is reached
+os.environ.setdefault("MYSQL_PORT", "3306")
+os.environ.setdefault("FERNET_KEY", "MDAwMDAwMDAwMDAwMDAwMDAwMDAwMDAwMDAwMDAwMDA=")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine, func
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+import database
+import models
+import pagination
+import tracking
+from routers import campaigns, contacts, groups, pixels, stats, views
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_UUID = "00000000-0000-4000-8000-000000000000"
+
+
+class Explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, "sqlite")
+def _compile_explain_sqlite(element, compiler, **kw):
+    return "EXPLAIN QUERY PLAN " + compiler.process(element.statement, **kw)
+
+
+def endpoint_queries(db):
+    """
+    :return: list of (name, select) of the queries to check, built by the helpers of their endpoints
+    """
+    campaign = models.Campaigns(id=1, start_datetime=datetime.datetime(2024, 1, 1), end_datetime=datetime.datetime(2024, 2, 1))
+    since = datetime.datetime(2024, 1, 1)
+    page = pagination.PAGE_SIZE_DEFAULT
+
+    # Without view shards the filters of the views do not depend on the shard
+    campaign_views = views._view_filters(db, None, campaign.id, None, since, None)(None)
+    campaign_pixels = pixels._filter_pixels(db.query(models.Pixels.uuid), None, campaign.id, None)
+    raw_views, compacted_views = stats._campaign_views_queries(
+        db, campaign, lambda column: column.in_(campaign_pixels.subquery().select())
+    )
+
+    queries = [
+        ("pixels.get lookup_pixel", tracking._pixel_ref_query(db, SAMPLE_UUID)),
+        ("pixels.get pixel_opens upsert", db.query(models.PixelOpens).filter(models.PixelOpens.pixel_uuid == SAMPLE_UUID)),
+        ("tracking.record_views event ids", db.query(models.Views.event_id).filter(models.Views.event_id.in_(["k:sample"]))),
+        ("tracking.dedupe_hits views of pixels", db.query(models.Views.pixel_uuid, models.Views.view_datetime).filter(models.Views.pixel_uuid.in_([SAMPLE_UUID]))),
+        ("pixels.add contact pixel", db.query(models.Pixels).filter(
+            (models.Pixels.contact_uuid == SAMPLE_UUID) & (models.Pixels.contact_pixel_number == 1)
+        )),
+        ("pixels.get_all by campaign", pagination.keyset_query(
+            pixels._filter_pixels(db.query(models.Pixels), None, campaign.id, None), models.Pixels.uuid, SAMPLE_UUID, page
+        )),
+        ("pixels.get_all by contact", pagination.keyset_query(
+            pixels._filter_pixels(db.query(models.Pixels), SAMPLE_UUID, None, None), models.Pixels.uuid, None, page
+        )),
+        ("contacts.get", db.query(models.Contacts).filter(models.Contacts.uuid == SAMPLE_UUID)),
+        ("contacts.get_all by group", pagination.keyset_query(
+            db.query(models.Contacts).filter(*contacts._contact_filters(None, 1, None, None)), models.Contacts.uuid, SAMPLE_UUID, page
+        )),
+        ("contacts.get_all by campaign", pagination.keyset_query(
+            db.query(models.Contacts).filter(*contacts._contact_filters(campaign.id, None, since, None)), models.Contacts.uuid, None, page
+        )),
+        ("campaigns.add name check", db.query(models.Campaigns).filter(models.Campaigns.campaign_name == "sample")),
+        ("campaigns.get_campaigns", pagination.keyset_query(
+            db.query(models.Campaigns).filter(*campaigns._campaign_filters(False, since, None)), models.Campaigns.id, campaign.id, page
+        )),
+        ("groups.get_groups", pagination.keyset_query(
+            db.query(models.Groups).filter(*groups._group_filters(campaign.id, False)), models.Groups.id, 1, page
+        )),
+        ("views.get_views by campaign", pagination.keyset_query(db.query(models.Views).filter(*campaign_views), models.Views.id, None, page)),
+        ("views.count_views by campaign", db.query(func.count(models.Views.id)).filter(*campaign_views)),
+        ("stats.get_campaign_views raw", raw_views),
+        ("stats.get_campaign_views compacted", compacted_views),
+    ]
+    return [(name, query.statement) for name, query in queries]
+
+
+def full_scans(conn, statement):
+    """
+    :return: list of the tables the statement reads in full
+    """
+    # Read from the cursor, the result columns of the statement do not apply to its plan
+    cursor = conn.execute(Explain(statement)).cursor
+    details = [row[-1] for row in cursor.fetchall()]
+    # "SCAN pixels" reads the table, "SCAN pixels USING (COVERING) INDEX ..." an index
+    return [detail.split()[1] for detail in details if detail.startswith("SCAN") and "INDEX" not in detail]
+
+
+class TestEndpointIndexes(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.engine = database.engine
+        database.engine = create_engine(f"sqlite:///{os.path.join(cls.directory, 'scratch.db')}")
+        database.SessionLocal.configure(bind=database.engine)
+        config = Config(os.path.join(SERVICE_DIR, "alembic.ini"))
+        config.attributes["embedded"] = True
+        command.upgrade(config, "head")
+
+    @classmethod
+    def tearDownClass(cls):
+        database.engine.dispose()
+        database.engine = cls.engine
+        database.SessionLocal.configure(bind=cls.engine)
+        shutil.rmtree(cls.directory)
+
+    def test_no_full_scan(self):
+        db = database.SessionLocal()
+        try:
+            conn = db.connection()
+            for name, statement in endpoint_queries(db):
+                with self.subTest(name):
+                    self.assertFalse(full_scans(conn, statement), f"{name} reads a table without index")
+        finally:
+            db.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+"""
+Templates of POST /pixel/render run in a sandbox.
+
+    cd services/python && python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+# utils and database read their settings at import, no server is reached
+os.environ.setdefault("MYSQL_PORT", "3306")
+os.environ.setdefault("FERNET_KEY", "MDAwMDAwMDAwMDAwMDAwMDAwMDAwMDAwMDAwMDAwMDA=")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jinja2
+import pixel_render
+
+
+class TestTemplateSandbox(unittest.TestCase):
+
+    def test_code_execution_refused(self):
+        template = pixel_render.compile_template("{{ cycler.__init__.__globals__.os.popen('id').read() }}")
+        with self.assertRaises(jinja2.exceptions.SecurityError):
+            pixel_render.check_template(template)
+
+    def test_class_walk_refused(self):
+        template = pixel_render.compile_template("{{ ''.__class__.__mro__[1].__subclasses__() }}")
+        with self.assertRaises(jinja2.exceptions.SecurityError):
+            pixel_render.check_template(template)
+
+    def test_email_template_renders(self):
+        template = pixel_render.compile_template('<img src="{{ pixel_url }}"> {{ pixel_urls[1] }} {{ scheduled_datetime.year }}')
+        pixel_render.check_template(template)
+        self.assertIn("2000", template.render(pixel_url="u", pixel_urls={1: "v"}, scheduled_datetime=pixel_render.datetime.datetime(2000, 1, 1)))
+
+
+if __name__ == "__main__":
+    unittest.main()
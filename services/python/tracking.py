@@ -0,0 +1,367 @@
+from sqlalchemy import func, insert
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from fastapi import HTTPException, status
+from typing import Dict, Iterable, List, Optional, Tuple
+import bisect
+import datetime
+import os
+import time
+import redis
+import models
+import utils
+import pixel_filter
+import campaign_activity
+import open_classifier
+import open_rollups
+import view_shards
+
+# "sync" records the view inside the pixel request, "stream" appends it to a
+# Redis Stream drained by view_writer.py
+VIEW_WRITE_MODE = os.getenv("VIEW_WRITE_MODE", "sync")
+VIEW_STREAM_KEY = os.getenv("VIEW_STREAM_KEY", "pixel:views")
+VIEW_STREAM_GROUP = os.getenv("VIEW_STREAM_GROUP", "view_writers")
+VIEW_STREAM_MAXLEN = int(os.getenv("VIEW_STREAM_MAXLEN", 1000000))
+# Insert a Views row per recorded hit next to the PixelOpens counters
+RECORD_RAW_VIEWS = os.getenv("RECORD_RAW_VIEWS", "1") == "1"
+# Attribution of the recently hit pixels, it never changes once the pixel exists
+PIXEL_REF_CACHE_SIZE = int(os.getenv("PIXEL_REF_CACHE_SIZE", 100000))
+PIXEL_REF_CACHE_TTL = float(os.getenv("PIXEL_REF_CACHE_TTL", 3600))
+
+# Failures of the tracking backends, the hit can be journaled and replayed
+BACKEND_ERRORS = (redis.RedisError, SQLAlchemyError)
+
+pixel_refs = utils.TTLCache(PIXEL_REF_CACHE_SIZE, PIXEL_REF_CACHE_TTL) if PIXEL_REF_CACHE_SIZE > 0 else None
+
+def cached_pixel_ref(pixel_uuid: str) -> Optional[utils.PixelRef]:
+    """
+    :return: utils.PixelRef of a pixel looked up recently by this worker, None otherwise
+    """
+    return pixel_refs.get(pixel_uuid) if pixel_refs is not None else None
+
+def _pixel_ref_query(db: Session, pixel_uuid: str):
+    """
+    Query of the utils.PixelRef fields of a pixel
+    """
+    return db.query(
+        models.Pixels.uuid,
+        models.Pixels.contact_uuid,
+        models.Contacts.group_id,
+        models.Contacts.campaign_id,
+        models.Pixels.ordinal
+    ).join(models.Contacts, models.Pixels.contact_uuid == models.Contacts.uuid).filter(models.Pixels.uuid == pixel_uuid)
+
+def lookup_pixel(db: Session, pixel_uuid: str) -> Optional[utils.PixelRef]:
+    """
+    Read the attribution of a classic pixel uuid, from the cache if possible
+    :param db: Session
+    :param pixel_uuid: string pixel uuid
+    :return: utils.PixelRef, None if the pixel does not exist
+    """
+    ref = cached_pixel_ref(pixel_uuid)
+    if ref:
+        return ref
+
+    row = _pixel_ref_query(db, pixel_uuid).first()
+    if not row:
+        return None
+
+    ref = utils.PixelRef(*row)
+    if pixel_refs is not None:
+        pixel_refs.set(pixel_uuid, ref)
+    return ref
+
+def campaign_is_active(ref: utils.PixelRef) -> bool:
+    """
+    :return: False if the hit must not be recorded because its campaign is deleted or out of its window
+    """
+    return not campaign_activity.CAMPAIGN_ACTIVITY_ENABLED or campaign_activity.campaign_windows.is_active(ref.campaign_id)
+
+def track_hit(db: Session, pixel_uuid: str, client_host: str, ref: utils.PixelRef = None, user_agent: str = ""):
+    """
+    Dedupe and record a pixel hit
+    :param db: Session
+    :param pixel_uuid: string pixel uuid
+    :param client_host: string client ip
+    :param ref: utils.PixelRef of a verified signed pixel, None for a classic uuid
+    :param user_agent: string User-Agent header of the hit
+
+    :raise HTTPException: 404 if the pixel does not exist
+    :raise BACKEND_ERRORS: if Redis or MySQL fail
+    """
+
+    # Binary uuid columns cannot be queried with anything else than a uuid
+    if not utils.is_storable_uuid(pixel_uuid):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Pixel with uuid {pixel_uuid} not found.")
+
+    # Reject unknown pixels without backend I/O, signed pixels are known by construction
+    if not ref and pixel_filter.PIXEL_FILTER_ENABLED and not pixel_filter.known_pixels.might_exist(pixel_uuid):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Pixel with uuid {pixel_uuid} not found.")
+
+    # Abusive clients and broken proxies still get the pixel, but nothing is recorded
+    if utils.RATE_LIMIT_ENABLED and not utils.allow_pixel_hit(client_host, pixel_uuid):
+        return
+
+    # Signed and recently hit pixels are attributed without a query
+    if not ref:
+        ref = cached_pixel_ref(pixel_uuid)
+    if not ref and utils.PIXEL_DEDUPE_MODE == "bitmap":
+        # Bitmaps are indexed by campaign and ordinal, classic uuids need their row first
+        ref = lookup_pixel(db, pixel_uuid)
+        if not ref:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Pixel with uuid {pixel_uuid} not found.")
+
+    # Hits of inactive campaigns skip the dedupe as well when the attribution is known
+    gated = ref is not None
+    if gated and not campaign_is_active(ref):
+        return
+
+    # Image proxies, prefetchers and scanners must not use up the dedupe window of the human open
+    machine_label = None
+    if open_classifier.MACHINE_OPEN_MODE != "off":
+        machine_label = open_classifier.open_classifier.classify(client_host, user_agent)
+    if machine_label and (open_classifier.MACHINE_OPEN_MODE == "count" or VIEW_WRITE_MODE == "stream" or not RECORD_RAW_VIEWS):
+        # Collapsed into a counter flushed in background, no Redis nor row
+        open_classifier.machine_opens.add(pixel_uuid, machine_label)
+        return
+
+    dedupe_key = pixel_uuid
+    if machine_label:
+        dedupe_key = f"m:{pixel_uuid}"
+        first_hit = utils.mark_pixel_seen(key=dedupe_key, value=client_host)
+    elif utils.PIXEL_DEDUPE_MODE == "bitmap" and ref.ordinal is not None:
+        first_hit = utils.mark_pixel_bit_seen(ref.campaign_id, ref.ordinal)
+    else:
+        # Check and mark the pixel in redis in a single round trip,
+        # bitmap mode falls back to it for pixels created before ordinals existed
+        first_hit = utils.mark_pixel_seen(key=dedupe_key, value=client_host)
+
+    if not first_hit:
+        return
+
+    if VIEW_WRITE_MODE == "stream":
+        # Recorded by view_writer.py, which also drops unknown pixels and hits of inactive campaigns
+        publish_view(pixel_uuid)
+        return
+
+    # Check if pixel exists
+    if not ref:
+        ref = lookup_pixel(db, pixel_uuid)
+    if not ref:
+        # Do not keep the bogus uuid in the dedupe window
+        utils.unmark_pixel_seen(dedupe_key)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Pixel with uuid {pixel_uuid} not found.")
+
+    if not gated and not campaign_is_active(ref):
+        return
+
+    record_view(db, ref.pixel_uuid, machine_label=machine_label, ref=ref)
+
+def _upsert_pixel_opens(db: Session, rows: List[Dict]):
+    """
+    Add hits to the per-pixel summary rows in one INSERT ... ON DUPLICATE KEY UPDATE
+    :param db: Session
+    :param rows: list of dict with pixel_uuid, first_open, last_open and open_count
+    """
+    table = models.PixelOpens
+    if db.get_bind().dialect.name == "mysql":
+        stmt = mysql_insert(table).values(rows)
+        stmt = stmt.on_duplicate_key_update(
+            first_open=func.least(table.first_open, stmt.inserted.first_open),
+            last_open=func.greatest(table.last_open, stmt.inserted.last_open),
+            open_count=table.open_count + stmt.inserted.open_count
+        )
+    else:
+        stmt = sqlite_insert(table).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.pixel_uuid],
+            set_={
+                "first_open": func.min(table.first_open, stmt.excluded.first_open),
+                "last_open": func.max(table.last_open, stmt.excluded.last_open),
+                "open_count": table.open_count + stmt.excluded.open_count
+            }
+        )
+    db.execute(stmt)
+
+def record_view(db: Session, pixel_uuid: str, view_datetime: datetime.datetime = None, machine_label: str = None, ref: utils.PixelRef = None):
+    """
+    Count a pixel hit with a single upsert of its summary row, plus its raw Views row if RECORD_RAW_VIEWS.
+    Machine opens only get their tagged Views row, the summary counts human opens.
+    :param db: Session
+    :param pixel_uuid: string pixel uuid, must exist
+    :param view_datetime: datetime of the hit, defaults to now
+    :param machine_label: string label of a machine open, None for a human open
+    :param ref: utils.PixelRef of the pixel, its human opens are then counted in the open rollups
+    """
+    view_datetime = view_datetime or datetime.datetime.utcnow()
+
+    with view_shards.view_shards.session_for(db, pixel_uuid) as hit_db:
+        if machine_label:
+            hit_db.execute(insert(models.Views).values(pixel_uuid=pixel_uuid, view_datetime=view_datetime, machine_label=machine_label))
+        else:
+            _upsert_pixel_opens(hit_db, [{"pixel_uuid": pixel_uuid, "first_open": view_datetime, "last_open": view_datetime, "open_count": 1}])
+            if RECORD_RAW_VIEWS:
+                hit_db.execute(insert(models.Views).values(pixel_uuid=pixel_uuid, view_datetime=view_datetime))
+        hit_db.commit()
+
+    if ref and not machine_label and open_rollups.OPEN_ROLLUPS_ENABLED:
+        open_rollups.record_opens(db, [(ref, view_datetime)])
+
+def record_views(db: Session, events: Iterable[Tuple[str, datetime.datetime, str]], machine_labels: Dict[str, str] = None) -> Dict[str, int]:
+    """
+    Bulk record hits of the write-behind paths, replaying the same events is a no-op.
+    The Views rows are always written here because their event_id is the replay ledger,
+    machine opens as tagged rows whatever MACHINE_OPEN_MODE.
+    Hits of deleted campaigns, or outside the window of their campaign at their datetime, are dropped.
+    :param db: Session
+    :param events: iterable of (pixel uuid, view datetime, unique event id)
+    :param machine_labels: dict of event id to the label of a machine open, the other events are human opens
+
+    :return: dict with inserted, duplicated, unknown and inactive counts
+    """
+    machine_labels = machine_labels or {}
+    batch = {}
+    for pixel_uuid, view_datetime, event_id in events:
+        batch[event_id] = (pixel_uuid, view_datetime)
+
+    if not batch:
+        return {"inserted": 0, "duplicated": 0, "unknown": 0, "inactive": 0}
+
+    pixel_uuids = {pixel_uuid for pixel_uuid, _ in batch.values() if utils.is_storable_uuid(pixel_uuid)}
+    # Attribution of the known pixels, for the open rollups, and window of their campaign
+    known = {}
+    windows = {}
+    for row in db.query(
+        models.Pixels.uuid,
+        models.Pixels.contact_uuid,
+        models.Contacts.group_id,
+        models.Contacts.campaign_id,
+        models.Pixels.ordinal,
+        models.Campaigns.start_datetime,
+        models.Campaigns.end_datetime,
+        models.Campaigns.deleted_datetime
+    ).join(models.Contacts, models.Pixels.contact_uuid == models.Contacts.uuid).join(
+        models.Campaigns, models.Contacts.campaign_id == models.Campaigns.id
+    ).filter(models.Pixels.uuid.in_(list(pixel_uuids))):
+        known[row.uuid] = utils.PixelRef(*row[:5])
+        windows[row.uuid] = (row.start_datetime, row.end_datetime, row.deleted_datetime is not None)
+
+    # The write-behind paths run apart from the map of campaign_activity, and replay past hits
+    inactive = {
+        event_id for event_id, (pixel_uuid, view_datetime) in batch.items()
+        if pixel_uuid in known and campaign_activity.CAMPAIGN_ACTIVITY_ENABLED and not campaign_activity.in_window(windows[pixel_uuid], view_datetime)
+    }
+
+    inserted = []
+    known_events = (event_id for event_id, (pixel_uuid, _) in batch.items() if pixel_uuid in known and event_id not in inactive)
+    for shard, event_ids in view_shards.view_shards.by_shard(known_events, key=lambda event_id: batch[event_id][0]).items():
+        with view_shards.view_shards.session(db, shard) as hit_db:
+            inserted += _record_shard_views(hit_db, {event_id: batch[event_id] for event_id in event_ids}, machine_labels)
+
+    human = [view for view in inserted if not view["machine_label"]]
+    if human and open_rollups.OPEN_ROLLUPS_ENABLED:
+        open_rollups.record_opens(db, [(known[view["pixel_uuid"]], view["view_datetime"]) for view in human])
+
+    unknown = sum(1 for pixel_uuid, _ in batch.values() if pixel_uuid not in known)
+    return {
+        "inserted": len(inserted),
+        "duplicated": len(batch) - len(inserted) - unknown - len(inactive),
+        "unknown": unknown,
+        "inactive": len(inactive)
+    }
+
+def dedupe_hits(db: Session, hits: List, window: datetime.timedelta) -> List:
+    """
+    Keep the hits without another hit of their pixel within the window, in Views or earlier in the list.
+    Human and machine opens are deduplicated apart, as on the pixel endpoint.
+    :param hits: list of (pixel uuid, view datetime, event id, machine label or None), sorted by datetime
+    :return: list of the hits kept
+    """
+    if not hits:
+        return []
+    recorded = {}
+    for shard, pixel_uuids in view_shards.view_shards.by_shard({hit[0] for hit in hits}).items():
+        with view_shards.view_shards.session(db, shard) as hit_db:
+            for row in hit_db.query(models.Views.pixel_uuid, models.Views.view_datetime, models.Views.machine_label).filter(
+                models.Views.pixel_uuid.in_(pixel_uuids),
+                models.Views.view_datetime > hits[0][1] - window,
+                models.Views.view_datetime < hits[-1][1] + window
+            ):
+                recorded.setdefault((row.pixel_uuid, row.machine_label is not None), []).append(row.view_datetime)
+    for times in recorded.values():
+        times.sort()
+
+    kept = []
+    for hit in hits:
+        pixel_uuid, view_datetime, _, machine_label = hit
+        times = recorded.setdefault((pixel_uuid, machine_label is not None), [])
+        i = bisect.bisect_left(times, view_datetime)
+        if (i < len(times) and times[i] - view_datetime < window) or (i > 0 and view_datetime - times[i - 1] < window):
+            continue
+        times.insert(i, view_datetime)
+        kept.append(hit)
+    return kept
+
+def _record_shard_views(db: Session, batch: Dict[str, Tuple[str, datetime.datetime]], machine_labels: Dict[str, str]) -> List[Dict]:
+    """
+    Write the events of known pixels not applied yet, on the database holding their views
+    :param batch: dict of event id to (pixel uuid, view datetime)
+    :param machine_labels: dict of event id to the label of a machine open
+    :return: list of the views inserted
+    """
+    # An event id always comes with the same datetime, bounding it prunes the monthly partitions of views
+    view_datetimes = [view_datetime for _, view_datetime in batch.values()]
+    applied = {row.event_id for row in db.query(models.Views.event_id).filter(
+        models.Views.event_id.in_(list(batch)),
+        models.Views.view_datetime.between(min(view_datetimes), max(view_datetimes))
+    )}
+    # The event ids of the views compacted by view_retention.py are gone, their events are taken as applied
+    compacted_until = db.query(func.max(models.ViewCompactions.range_end)).filter(models.ViewCompactions.completed_datetime != None).scalar()
+
+    views = []
+    opens = {}
+    for event_id, (pixel_uuid, view_datetime) in batch.items():
+        if event_id in applied or (compacted_until and view_datetime < compacted_until):
+            continue
+        machine_label = machine_labels.get(event_id)
+        views.append({"pixel_uuid": pixel_uuid, "view_datetime": view_datetime, "event_id": event_id, "machine_label": machine_label})
+        # The summary counts human opens, like record_view
+        if machine_label:
+            continue
+        summary = opens.setdefault(pixel_uuid, {"pixel_uuid": pixel_uuid, "first_open": view_datetime, "last_open": view_datetime, "open_count": 0})
+        summary["first_open"] = min(summary["first_open"], view_datetime)
+        summary["last_open"] = max(summary["last_open"], view_datetime)
+        summary["open_count"] += 1
+
+    if views:
+        db.execute(insert(models.Views), views)
+    if opens:
+        _upsert_pixel_opens(db, list(opens.values()))
+    db.commit()
+    return views
+
+def publish_view(pixel_uuid: str):
+    """
+    Append a compact view event to the write-behind stream
+    :param pixel_uuid: string pixel uuid
+    """
+    r = utils.get_redis_connection()
+    r.xadd(
+        VIEW_STREAM_KEY,
+        {"p": pixel_uuid, "t": int(time.time() * 1000)},
+        maxlen=VIEW_STREAM_MAXLEN,
+        approximate=True
+    )
+
+def parse_view_event(entry_id: bytes, fields: Dict[bytes, bytes]) -> Tuple[str, datetime.datetime, str]:
+    """
+    Decode a view event read from the stream
+    :param entry_id: bytes stream entry id, unique for the stream
+    :param fields: dict of stream entry fields
+    :return: tuple of (pixel uuid, view datetime, event id)
+    """
+    pixel_uuid = fields[b"p"].decode()
+    view_datetime = datetime.datetime.utcfromtimestamp(int(fields[b"t"]) / 1000)
+    return pixel_uuid, view_datetime, "s:" + entry_id.decode()
@@ -1,7 +1,8 @@
 from database import SessionLocal
 import os
 import datetime
-from typing import Dict
+from typing import Dict, List, Optional
+from collections import namedtuple, OrderedDict
 from dotenv import load_dotenv
 from jose import jwt
 from jose.exceptions import JWTError
@@ -12,6 +13,7 @@ from fastapi import HTTPException
 from sqlalchemy.orm import Session
 import uuid
 from fastapi import status
+from fastapi.responses import Response
 import models
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from passlib.context import CryptContext
@@ -19,6 +21,12 @@ import datetime
 from database import get_db
 from cryptography.fernet import Fernet
 import redis
+import threading
+import base64
+import binascii
+import hashlib
+import hmac
+import time
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login")
 
@@ -31,6 +39,32 @@ API_SECRET_ALGORITHM = os.getenv("API_SECRET_ALGORITHM")
 API_ACCESS_TOKEN_EXPIRE_MINUTES = os.getenv("API_ACCESS_TOKEN_EXPIRE_MINUTES")
 FERNET_KEY = os.getenv("FERNET_KEY")
 
+REDIS_HOST = os.getenv("REDIS_HOST", "redis_service")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 2))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 0.5))
+PIXEL_DEDUPE_SECONDS = int(os.getenv("PIXEL_DEDUPE_SECONDS", 60*60))
+PIXEL_SIGNING_KEY = os.getenv("PIXEL_SIGNING_KEY")
+PIXEL_L1_SIZE = int(os.getenv("PIXEL_L1_SIZE", 100000))
+PIXEL_L1_TTL = float(os.getenv("PIXEL_L1_TTL", 60))
+# "key" keeps one Redis key per pixel, "bitmap" one bit per pixel in a bitmap per campaign and window
+PIXEL_DEDUPE_MODE = os.getenv("PIXEL_DEDUPE_MODE", "key")
+DEDUPE_BITMAP_PREFIX = "dedupe:bm:"
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "0") == "1"
+RATE_LIMIT_IP_PER_SECOND = float(os.getenv("RATE_LIMIT_IP_PER_SECOND", 20))
+RATE_LIMIT_IP_BURST = float(os.getenv("RATE_LIMIT_IP_BURST", 100))
+RATE_LIMIT_PIXEL_PER_SECOND = float(os.getenv("RATE_LIMIT_PIXEL_PER_SECOND", 1))
+RATE_LIMIT_PIXEL_BURST = float(os.getenv("RATE_LIMIT_PIXEL_BURST", 20))
+if RATE_LIMIT_ENABLED:
+    # The token bucket script divides by the rate, and a bucket below one token never allows a hit
+    for name, value in [("RATE_LIMIT_IP_PER_SECOND", RATE_LIMIT_IP_PER_SECOND), ("RATE_LIMIT_PIXEL_PER_SECOND", RATE_LIMIT_PIXEL_PER_SECOND)]:
+        if not value > 0:
+            raise ValueError(f"{name} must be greater than 0, got {value}")
+    for name, value in [("RATE_LIMIT_IP_BURST", RATE_LIMIT_IP_BURST), ("RATE_LIMIT_PIXEL_BURST", RATE_LIMIT_PIXEL_BURST)]:
+        if not value >= 1:
+            raise ValueError(f"{name} must be at least 1, got {value}")
+
 
 cipher_suite = Fernet(FERNET_KEY)
 
@@ -111,6 +145,21 @@ def generate_uuid4():
     """Generate a random UUID4 string."""
     return str(uuid.uuid4())
 
+def is_storable_uuid(value: str) -> bool:
+    """Check that a string can be stored in the uuid columns, anything goes unless UUID_STORAGE is binary."""
+    if models.UUID_STORAGE != "binary":
+        return True
+    try:
+        uuid.UUID(value)
+    except (TypeError, ValueError, AttributeError):
+        return False
+    return True
+
+def generate_uuid4_batch(count: int) -> List[str]:
+    """Generate count random UUID4 strings from a single urandom read."""
+    random_bytes = os.urandom(16 * count)
+    return [str(uuid.UUID(bytes=random_bytes[i:i + 16], version=4)) for i in range(0, 16 * count, 16)]
+
 def encrypt_value(original_value: str):
     encrypted_value = cipher_suite.encrypt(original_value.encode())
     return encrypted_value
@@ -119,24 +168,421 @@ def decrypt_value(encrypted_value: str):
     decrypted_value = cipher_suite.decrypt(encrypted_value).decode()
     return decrypted_value
 
-def write_pixel():
-    pixel_path = "tracking_pixel.gif"
-    if not os.path.exists(pixel_path):
-        with open(pixel_path, "wb") as f:
-            f.write(b"GIF89a\x01\x00\x01\x00\x80\x01\x00\x00\x00\x00\xff\xff\xff!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;")
+# Attribution of a pixel hit, read from a signed pixel url or from the database
+PixelRef = namedtuple("PixelRef", ["pixel_uuid", "contact_uuid", "group_id", "campaign_id", "ordinal"])
+
+SIGNED_PIXEL_PREFIX = "s1."
+
+def _b64encode(value: bytes) -> str:
+    return base64.urlsafe_b64encode(value).rstrip(b"=").decode()
+
+def _b64decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+def _pixel_signature(payload: bytes) -> bytes:
+    return hmac.new(PIXEL_SIGNING_KEY.encode(), payload, hashlib.sha256).digest()[:16]
+
+def sign_pixel(ref: PixelRef) -> str:
+    """
+    Build a stateless pixel token carrying its attribution
+    :param ref: PixelRef of the pixel
+    :return: string s1.<payload>.<signature>, usable in place of the pixel uuid
+    """
+    payload = "|".join("" if value is None else str(value) for value in ref).encode()
+    return SIGNED_PIXEL_PREFIX + _b64encode(payload) + "." + _b64encode(_pixel_signature(payload))
+
+def is_signed_pixel(pixel: str) -> bool:
+    return pixel.startswith(SIGNED_PIXEL_PREFIX)
+
+def verify_signed_pixel(token: str) -> Optional[PixelRef]:
+    """
+    Verify a token built by sign_pixel in constant time
+    :param token: string signed pixel token
+    :return: PixelRef, None if the token is malformed or its signature is wrong
+    """
+    if not PIXEL_SIGNING_KEY:
+        return None
+    try:
+        encoded_payload, encoded_signature = token[len(SIGNED_PIXEL_PREFIX):].split(".")
+        payload = _b64decode(encoded_payload)
+        signature = _b64decode(encoded_signature)
+    except (ValueError, binascii.Error):
+        return None
+
+    if not hmac.compare_digest(signature, _pixel_signature(payload)):
+        return None
+
+    # Contact uuids are free text, the other fields cannot contain the separator
+    pixel_uuid, rest = payload.decode().split("|", 1)
+    contact_uuid, group_id, campaign_id, ordinal = rest.rsplit("|", 3)
+    return PixelRef(pixel_uuid, contact_uuid, int(group_id), int(campaign_id), int(ordinal) if ordinal else None)
+
+PIXEL_PATH = "tracking_pixel.gif"
+
+# Transparent 1x1 images, one per format selectable with the pixel url suffix
+PIXEL_GIF = b"GIF89a\x01\x00\x01\x00\x80\x01\x00\x00\x00\x00\xff\xff\xff!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;"
+PIXEL_PNG = b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x04\x00\x00\x00\xb5\x1c\x0c\x02\x00\x00\x00\x0bIDATx\xdacd`\x00\x00\x00\x06\x00\x020\x81\xd0/\x00\x00\x00\x00IEND\xaeB`\x82"
+PIXEL_WEBP = b"RIFF\x1a\x00\x00\x00WEBPVP8L\r\x00\x00\x00/\x00\x00\x00\x10\x07\x10\x11\x11\x88\x88\xfe\x07\x00"
+
+PIXEL_HEADERS = {
+    "cache-control": "no-cache, no-store, must-revalidate, private",
+    "pragma": "no-cache",
+    "expires": "0"
+}
+
+def load_pixel_variants() -> Dict[str, tuple]:
+    """
+    Read the tracking pixel once and precompute body and raw headers of every variant
+    :return: dict of format -> (body, raw_headers)
+    """
+    gif = PIXEL_GIF
+    if os.path.exists(PIXEL_PATH):
+        with open(PIXEL_PATH, "rb") as f:
+            gif = f.read()
+
+    variants = {}
+    for image_format, body, media_type in (("gif", gif, "image/gif"), ("png", PIXEL_PNG, "image/png"), ("webp", PIXEL_WEBP, "image/webp")):
+        headers = dict(PIXEL_HEADERS, **{"content-type": media_type, "content-length": str(len(body))})
+        raw_headers = [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()]
+        variants[image_format] = (body, raw_headers)
+    return variants
+
+PIXEL_VARIANTS = load_pixel_variants()
+
+class PixelResponse(Response):
+    """
+    Prebuilt in-memory pixel response, no file system access nor header encoding per hit
+    :param image_format: one of PIXEL_VARIANTS keys
+    """
+
+    def __init__(self, image_format: str = "gif"):
+        body, raw_headers = PIXEL_VARIANTS[image_format]
+        self.status_code = 200
+        self.background = None
+        self.body = body
+        # Copied because middlewares may mutate the headers of the response
+        self.raw_headers = list(raw_headers)
+
+def split_pixel_format(pixel: str) -> tuple:
+    """
+    Split the optional image suffix of a pixel url
+    :param pixel: string pixel uuid, optionally followed by .gif, .png or .webp
+    :return: tuple of (pixel uuid, image format)
+    """
+    uuid_part, _, suffix = pixel.rpartition(".")
+    if uuid_part and suffix.lower() in PIXEL_VARIANTS:
+        return uuid_part, suffix.lower()
+    return pixel, "gif"
+
+class StatsCounter:
+    """
+    Thread safe named counters for hot path statistics
+    :param names: counter names initialized to zero
+    """
+
+    def __init__(self, *names):
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(names, 0)
+
+    def incr(self, name: str, amount: int = 1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + amount
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
+
+class TTLCache:
+    """
+    Bounded in-process LRU whose entries expire
+    :param maxsize: int maximum number of entries, least recently used are evicted
+    :param ttl: float default seconds to live of an entry
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+redis_stats = StatsCounter("l1_hits", "l2_hits", "misses", "errors")
+
+# L1 of the dedupe window: only "seen" marks confirmed by Redis, never living
+# longer than their Redis key, so every worker agrees with Redis
+pixel_l1 = TTLCache(PIXEL_L1_SIZE, min(PIXEL_L1_TTL, PIXEL_DEDUPE_SECONDS)) if PIXEL_L1_SIZE else None
+
+# One pool per worker process, shared by every request thread
+redis_pool = redis.BlockingConnectionPool(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    password=os.getenv("REDIS_PASSWORD"),
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT,
+    socket_timeout=REDIS_SOCKET_TIMEOUT,
+    socket_connect_timeout=REDIS_SOCKET_TIMEOUT
+)
+redis_client = redis.Redis(connection_pool=redis_pool)
 
 def get_redis_connection():
-    redis_host = 'redis_service'
-    redis_port = 6379
-    redis_password = os.getenv("REDIS_PASSWORD")
-    r = redis.Redis(host=redis_host, port=redis_port, password=redis_password)
-    return r
+    return redis_client
+
+def get_blocking_redis_connection():
+    """
+    Dedicated client without socket timeout, for blocking reads and subscriptions
+    """
+    return redis.Redis(host=REDIS_HOST, port=REDIS_PORT, password=os.getenv("REDIS_PASSWORD"))
+
+def get_redis_pool_stats() -> Dict[str, int]:
+    """
+    Connection pool usage of this worker process
+    """
+    created = len(getattr(redis_pool, "_connections", []))
+    idle = sum(1 for connection in getattr(redis_pool.pool, "queue", []) if connection is not None)
+    return {
+        "max_connections": redis_pool.max_connections,
+        "created_connections": created,
+        "idle_connections": idle,
+        "in_use_connections": created - idle
+    }
 
 def save_to_redis(key, value):
     r = get_redis_connection()
-    r.set(key, value, ex=60*60)
+    r.set(key, value, ex=PIXEL_DEDUPE_SECONDS)
+    if pixel_l1 is not None:
+        pixel_l1.set(key, value)
 
 def get_from_redis(key):
+    if pixel_l1 is not None:
+        value = pixel_l1.get(key)
+        if value is not None:
+            return value
     r = get_redis_connection()
     value = r.get(key)
-    return value
\ No newline at end of file
+    return value
+
+# SET NX EX, and if the key already exists the milliseconds it has left
+MARK_PIXEL_SCRIPT = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    return 0
+end
+return redis.call('PTTL', KEYS[1])
+"""
+mark_pixel_script = redis_client.register_script(MARK_PIXEL_SCRIPT)
+
+def mark_pixel_seen(key, value) -> bool:
+    """
+    Check and mark a pixel hit in the dedupe window, in process first then in Redis with one atomic script
+    :param key: string pixel uuid
+    :param value: string client ip
+    :return: True if this is the first hit of the window, False if already seen
+    """
+    if pixel_l1 is not None and pixel_l1.get(key) is not None:
+        redis_stats.incr("l1_hits")
+        return False
+
+    r = get_redis_connection()
+    try:
+        remaining_ms = mark_pixel_script(keys=[key], args=[value, PIXEL_DEDUPE_SECONDS], client=r)
+    except redis.RedisError:
+        redis_stats.incr("errors")
+        raise
+
+    if remaining_ms == 0:
+        redis_stats.incr("misses")
+        if pixel_l1 is not None:
+            pixel_l1.set(key, value)
+        return True
+
+    redis_stats.incr("l2_hits")
+    if pixel_l1 is not None and remaining_ms > 0:
+        pixel_l1.set(key, value, ttl=min(pixel_l1.ttl, remaining_ms / 1000))
+    return False
+
+# SETBIT returning the previous bit, the bitmap outlives its window by one window
+MARK_PIXEL_BIT_SCRIPT = """
+local seen = redis.call('SETBIT', KEYS[1], ARGV[1], 1)
+if seen == 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return seen
+"""
+mark_pixel_bit_script = redis_client.register_script(MARK_PIXEL_BIT_SCRIPT)
+
+def mark_pixel_bit_seen(campaign_id: int, ordinal: int) -> bool:
+    """
+    Check and mark a pixel hit in the bitmap of its campaign for the current dedupe window
+    :param campaign_id: int campaign id of the pixel
+    :param ordinal: int dense ordinal of the pixel in its campaign
+    :return: True if this is the first hit of the window, False if already seen
+    """
+    now = time.time()
+    bucket = int(now // PIXEL_DEDUPE_SECONDS)
+    key = f"{DEDUPE_BITMAP_PREFIX}{campaign_id}:{bucket}"
+    l1_key = f"{key}:{ordinal}"
+
+    if pixel_l1 is not None and pixel_l1.get(l1_key) is not None:
+        redis_stats.incr("l1_hits")
+        return False
+
+    r = get_redis_connection()
+    try:
+        seen = mark_pixel_bit_script(keys=[key], args=[ordinal, 2 * PIXEL_DEDUPE_SECONDS], client=r)
+    except redis.RedisError:
+        redis_stats.incr("errors")
+        raise
+
+    redis_stats.incr("l2_hits" if seen else "misses")
+    if pixel_l1 is not None:
+        # Never past the end of the window
+        pixel_l1.set(l1_key, True, ttl=min(pixel_l1.ttl, (bucket + 1) * PIXEL_DEDUPE_SECONDS - now))
+    return not seen
+
+def get_bitmap_dedupe_report(campaign_id: int, pixels: int) -> Dict:
+    """
+    Redis memory of the dedupe bitmaps of a campaign, compared with one key per pixel
+    :param campaign_id: int campaign id
+    :param pixels: int number of pixels of the campaign
+    """
+    r = get_redis_connection()
+
+    # Size of one key of the "key" mode, measured on this Redis
+    probe_key = f"dedupe:probe:{generate_uuid4()}"
+    r.set(probe_key, "255.255.255.255", ex=10)
+    key_bytes = r.memory_usage(probe_key)
+    r.delete(probe_key)
+
+    windows = []
+    for key in r.scan_iter(match=f"{DEDUPE_BITMAP_PREFIX}{campaign_id}:*", count=1000):
+        windows.append({
+            "window_start": int(key.decode().rsplit(":", 1)[1]) * PIXEL_DEDUPE_SECONDS,
+            "seen_pixels": r.bitcount(key),
+            "bitmap_bytes": r.memory_usage(key)
+        })
+    windows.sort(key=lambda window: window["window_start"])
+
+    bitmap_bytes = sum(window["bitmap_bytes"] or 0 for window in windows)
+    key_mode_bytes = sum(window["seen_pixels"] for window in windows) * key_bytes
+    return {
+        "campaign_id": campaign_id,
+        "pixels": pixels,
+        "windows": windows,
+        "bitmap_bytes": bitmap_bytes,
+        "key_mode_estimated_bytes": key_mode_bytes,
+        "key_bytes": key_bytes,
+        "saving_ratio": round(key_mode_bytes / bitmap_bytes, 2) if bitmap_bytes else None
+    }
+
+def allocate_pixel_ordinals(db: Session, campaign_id: int, count: int = 1) -> int:
+    """
+    Reserve consecutive pixel ordinals in a campaign by advancing its counter, serialized by a lock on the campaign row until commit
+    :param db: Session
+    :param campaign_id: int campaign id
+    :param count: int number of ordinals
+    :return: int first reserved ordinal
+    """
+    campaign = models.Campaigns
+    first = db.query(campaign.next_pixel_ordinal).filter(campaign.id == campaign_id).with_for_update().scalar()
+    db.query(campaign).filter(campaign.id == campaign_id).update({campaign.next_pixel_ordinal: first + count}, synchronize_session=False)
+    return first
+
+# Two token buckets, per client ip and per pixel, a token is taken from both or none
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local function refill(key, rate, burst)
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    return math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+end
+local function save(key, tokens, rate, burst)
+    redis.call('HSET', key, 'tokens', tokens, 'ts', now)
+    redis.call('PEXPIRE', key, math.ceil(burst / rate * 1000))
+end
+local ip_rate, ip_burst = tonumber(ARGV[2]), tonumber(ARGV[3])
+local pixel_rate, pixel_burst = tonumber(ARGV[4]), tonumber(ARGV[5])
+local ip_tokens = refill(KEYS[1], ip_rate, ip_burst)
+local pixel_tokens = refill(KEYS[2], pixel_rate, pixel_burst)
+local allowed = 0
+if ip_tokens >= 1 and pixel_tokens >= 1 then
+    ip_tokens = ip_tokens - 1
+    pixel_tokens = pixel_tokens - 1
+    allowed = 1
+end
+save(KEYS[1], ip_tokens, ip_rate, ip_burst)
+save(KEYS[2], pixel_tokens, pixel_rate, pixel_burst)
+return allowed
+"""
+token_bucket_script = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+
+rate_limit_stats = StatsCounter("allowed", "throttled")
+
+def allow_pixel_hit(client_host: str, pixel_uuid: str) -> bool:
+    """
+    Take a token from the buckets of the client ip and of the pixel
+    :param client_host: string client ip
+    :param pixel_uuid: string pixel uuid
+    :return: False if either bucket is empty and the hit must not be recorded
+    """
+    r = get_redis_connection()
+    allowed = token_bucket_script(
+        keys=[f"rl:ip:{client_host}", f"rl:px:{pixel_uuid}"],
+        args=[
+            int(time.time() * 1000),
+            RATE_LIMIT_IP_PER_SECOND,
+            RATE_LIMIT_IP_BURST,
+            RATE_LIMIT_PIXEL_PER_SECOND,
+            RATE_LIMIT_PIXEL_BURST
+        ],
+        client=r
+    )
+    rate_limit_stats.incr("allowed" if allowed else "throttled")
+    return bool(allowed)
+
+def get_dedupe_stats() -> Dict:
+    """
+    Per tier counters and hit ratios of the dedupe window of this worker
+    """
+    counts = redis_stats.snapshot()
+    lookups = counts["l1_hits"] + counts["l2_hits"] + counts["misses"]
+    return dict(
+        counts,
+        l1_size=len(pixel_l1) if pixel_l1 is not None else 0,
+        l1_hit_ratio=round(counts["l1_hits"] / lookups, 4) if lookups else None,
+        l2_hit_ratio=round(counts["l2_hits"] / (lookups - counts["l1_hits"]), 4) if lookups - counts["l1_hits"] else None
+    )
+
+def unmark_pixel_seen(key):
+    """
+    Forget a hit marked by mark_pixel_seen, e.g. of a pixel that does not exist
+    :param key: string pixel uuid
+    """
+    if pixel_l1 is not None:
+        pixel_l1.delete(key)
+    r = get_redis_connection()
+    r.delete(key)
@@ -0,0 +1,142 @@
+"""
+Streaming export of the views of a campaign with their pixel, contact, group and campaign.
+
+Without view shards the views are read by a single join, streamed from a
+server-side cursor in batches of VIEW_EXPORT_BATCH rows. With view shards the
+pixels of the campaign are walked by uuid in chunks of VIEW_EXPORT_BATCH, and
+the views of each chunk are streamed from the shards holding them. Every batch
+is serialized and yielded as one piece, so an export of any size runs in
+constant memory and its first bytes leave before the query is over.
+"""
+import csv
+import datetime
+import io
+import json
+import os
+import zlib
+from typing import Iterable, Iterator, List, Optional
+from sqlalchemy import select
+import database
+import models
+import view_shards
+
+VIEW_EXPORT_BATCH = int(os.getenv("VIEW_EXPORT_BATCH", 1000))
+
+COLUMNS = [
+    "view_id", "view_datetime", "machine_label", "pixel_uuid", "contact_pixel_number", "contact_uuid",
+    "scheduled_datetime", "group_id", "group_name", "campaign_id", "campaign_name"
+]
+
+# Columns of the pixel, contact, group and campaign of a view
+PIXEL_COLUMNS = [
+    models.Pixels.uuid, models.Pixels.contact_pixel_number, models.Pixels.contact_uuid, models.Contacts.scheduled_datetime,
+    models.Contacts.group_id, models.Groups.group_name, models.Contacts.campaign_id, models.Campaigns.campaign_name
+]
+
+
+def _pixels_select(columns: list, campaign_id: int, group_id: Optional[int]):
+    query = select(*columns).select_from(models.Pixels).join(
+        models.Contacts, models.Pixels.contact_uuid == models.Contacts.uuid
+    ).join(
+        models.Groups, models.Contacts.group_id == models.Groups.id
+    ).join(
+        models.Campaigns, models.Contacts.campaign_id == models.Campaigns.id
+    ).where(models.Contacts.campaign_id == campaign_id)
+    if group_id is not None:
+        query = query.where(models.Contacts.group_id == group_id)
+    return query
+
+
+def _view_filters(from_datetime: Optional[datetime.datetime], to_datetime: Optional[datetime.datetime]) -> list:
+    filters = []
+    if from_datetime:
+        filters.append(models.Views.view_datetime >= from_datetime)
+    if to_datetime:
+        filters.append(models.Views.view_datetime < to_datetime)
+    return filters
+
+
+def _joined_batches(campaign_id: int, group_id: Optional[int], from_datetime, to_datetime) -> Iterator[List[tuple]]:
+    db = database.SessionLocal()
+    try:
+        views = models.Views
+        query = _pixels_select([views.id, views.view_datetime, views.machine_label, *PIXEL_COLUMNS], campaign_id, group_id).join(
+            views, views.pixel_uuid == models.Pixels.uuid
+        ).where(*_view_filters(from_datetime, to_datetime))
+        # yield_per streams the rows from a server-side cursor
+        for batch in db.execute(query.execution_options(yield_per=VIEW_EXPORT_BATCH)).partitions():
+            yield batch
+    finally:
+        db.close()
+
+
+def _sharded_batches(campaign_id: int, group_id: Optional[int], from_datetime, to_datetime) -> Iterator[List[tuple]]:
+    shards = view_shards.view_shards
+    views = models.Views
+    last_uuid = None
+    db = database.SessionLocal()
+    try:
+        while True:
+            query = _pixels_select(PIXEL_COLUMNS, campaign_id, group_id)
+            if last_uuid is not None:
+                query = query.where(models.Pixels.uuid > last_uuid)
+            pixels = {row[0]: tuple(row) for row in db.execute(query.order_by(models.Pixels.uuid).limit(VIEW_EXPORT_BATCH))}
+            db.rollback()
+            if not pixels:
+                break
+            last_uuid = max(pixels)
+
+            for shard, pixel_uuids in shards.by_shard(sorted(pixels)).items():
+                with shards.session(db, shard) as hit_db:
+                    result = hit_db.execute(
+                        select(views.id, views.view_datetime, views.machine_label, views.pixel_uuid).where(
+                            views.pixel_uuid.in_(pixel_uuids), *_view_filters(from_datetime, to_datetime)
+                        ).execution_options(yield_per=VIEW_EXPORT_BATCH)
+                    )
+                    for batch in result.partitions():
+                        yield [(view_id, view_datetime, machine_label) + pixels[pixel_uuid] for view_id, view_datetime, machine_label, pixel_uuid in batch]
+    finally:
+        db.close()
+
+
+def _value(value):
+    return value.isoformat() if isinstance(value, datetime.datetime) else value
+
+
+def export_views(campaign_id: int, group_id: Optional[int] = None, output: str = "ndjson",
+                 from_datetime: Optional[datetime.datetime] = None, to_datetime: Optional[datetime.datetime] = None) -> Iterator[str]:
+    """
+    Serialize the views of a campaign or of one of its groups, batch by batch
+    :param output: string "ndjson" for one json object per view, "csv" for a header line then one line per view
+    :param from_datetime: datetime.datetime views from then, None for all
+    :param to_datetime: datetime.datetime views before then, None for all
+    :return: iterator of serialized batches
+    """
+    batches = _sharded_batches if view_shards.view_shards.enabled else _joined_batches
+    if output == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(COLUMNS)
+        for batch in batches(campaign_id, group_id, from_datetime, to_datetime):
+            writer.writerows([[_value(value) for value in row] for row in batch])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        # Header of an export without views
+        if buffer.getvalue():
+            yield buffer.getvalue()
+    else:
+        for batch in batches(campaign_id, group_id, from_datetime, to_datetime):
+            yield "".join(json.dumps(dict(zip(COLUMNS, map(_value, row)))) + "\n" for row in batch)
+
+
+def gzip_chunks(chunks: Iterable[str]) -> Iterator[bytes]:
+    """
+    Gzip a stream of text, each chunk flushed so the client receives it right away
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode()) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
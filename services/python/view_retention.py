@@ -0,0 +1,266 @@
+"""
+Retention of the raw Views: compaction of the months past VIEW_RETENTION_MONTHS into views_monthly.
+
+Run it daily, e.g. from cron:
+    python view_retention.py
+
+On MySQL views is partitioned by month (migration 0004). The job first makes
+sure the partitions of the next VIEW_PARTITIONS_AHEAD months exist, by
+splitting the empty catch-all partition. Then every partition entirely past the
+retention is compacted into one views_monthly row per month, pixel and machine
+label, and dropped, which only takes a short metadata lock. On an unpartitioned
+table the views past the retention are compacted the same way and deleted in
+chunks.
+
+Compaction walks the views of a range in chunks of VIEW_COMPACTION_CHUNK by
+pixel uuid, each chunk is added to views_monthly in the same transaction as
+the progress saved in view_compactions, so an interrupted job resumes without
+counting a view twice, and no lock is held for longer than a chunk. Views
+written in a range once its compaction started are left raw; the partition is
+then emptied by chunked deletes instead of being dropped.
+
+With VIEW_SHARD_URLS set, each view shard is compacted on its own.
+"""
+import argparse
+import datetime
+import time
+import os
+from typing import List, Optional, Tuple
+from sqlalchemy import func, select, text
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+import models
+import view_shards
+
+VIEW_RETENTION_MONTHS = int(os.getenv("VIEW_RETENTION_MONTHS", 13))
+VIEW_PARTITIONS_AHEAD = int(os.getenv("VIEW_PARTITIONS_AHEAD", 3))
+VIEW_COMPACTION_CHUNK = int(os.getenv("VIEW_COMPACTION_CHUNK", 5000))
+# Seconds slept between two chunks, to leave room to the hot path
+VIEW_COMPACTION_PAUSE = float(os.getenv("VIEW_COMPACTION_PAUSE", 0.05))
+
+
+def month_start(value: datetime.datetime) -> datetime.datetime:
+    return datetime.datetime(value.year, value.month, 1)
+
+
+def add_months(month: datetime.datetime, count: int) -> datetime.datetime:
+    index = month.year * 12 + month.month - 1 + count
+    return datetime.datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: datetime.datetime) -> str:
+    return f"p{month:%Y%m}"
+
+
+def view_partitions(db) -> List[Tuple[str, Optional[datetime.datetime]]]:
+    """
+    :return: list of (partition name, exclusive upper bound or None for the catch-all partition), empty if views is not partitioned
+    """
+    if db.get_bind().dialect.name != "mysql":
+        return []
+    rows = db.execute(text(
+        "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'views' AND PARTITION_NAME IS NOT NULL "
+        "ORDER BY PARTITION_ORDINAL_POSITION"
+    )).all()
+    return [
+        (name, None if description == "MAXVALUE" else datetime.datetime.fromisoformat(description.strip("'")))
+        for name, description in rows
+    ]
+
+
+def ensure_partitions(db, ahead: int = VIEW_PARTITIONS_AHEAD) -> List[str]:
+    """
+    Split the catch-all partition so each month up to ahead months from now has its own
+    :return: list of the created partition names
+    """
+    partitions = view_partitions(db)
+    if not partitions or partitions[-1][1] is not None:
+        return []
+    bounds = [bound for _, bound in partitions if bound]
+    month = bounds[-1] if bounds else month_start(datetime.datetime.utcnow())
+    last = add_months(month_start(datetime.datetime.utcnow()), ahead)
+
+    created = []
+    definitions = []
+    while month <= last:
+        created.append(partition_name(month))
+        definitions.append(f"PARTITION {partition_name(month)} VALUES LESS THAN ('{add_months(month, 1):%Y-%m-%d}')")
+        month = add_months(month, 1)
+    if definitions:
+        # Only the catch-all partition is rebuilt, it is empty unless the job did not run for months
+        db.execute(text(
+            f"ALTER TABLE views REORGANIZE PARTITION {partitions[-1][0]} INTO ({', '.join(definitions)}, PARTITION {partitions[-1][0]} VALUES LESS THAN (MAXVALUE))"
+        ))
+    return created
+
+
+def _month_of(db, column):
+    if db.get_bind().dialect.name == "mysql":
+        return func.date_format(column, "%Y-%m-01")
+    return func.strftime("%Y-%m-01", column)
+
+
+def _upsert_monthly(db, rows_select):
+    table = models.ViewsMonthly
+    columns = ["month", "pixel_uuid", "machine_label", "view_count", "first_view", "last_view"]
+    if db.get_bind().dialect.name == "mysql":
+        stmt = mysql_insert(table).from_select(columns, rows_select)
+        stmt = stmt.on_duplicate_key_update(
+            view_count=table.view_count + stmt.inserted.view_count,
+            first_view=func.least(table.first_view, stmt.inserted.first_view),
+            last_view=func.greatest(table.last_view, stmt.inserted.last_view)
+        )
+    else:
+        stmt = sqlite_insert(table).from_select(columns, rows_select)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.month, table.pixel_uuid, table.machine_label],
+            set_={
+                "view_count": table.view_count + stmt.excluded.view_count,
+                "first_view": func.min(table.first_view, stmt.excluded.first_view),
+                "last_view": func.max(table.last_view, stmt.excluded.last_view)
+            }
+        )
+    db.execute(stmt)
+
+
+def _in_range(compaction: models.ViewCompactions) -> list:
+    """
+    :return: list of the conditions selecting the views of a compaction range
+    """
+    views = models.Views
+    conditions = [views.view_datetime < compaction.range_end, views.id <= compaction.max_view_id]
+    if compaction.range_start is not None:
+        conditions.append(views.view_datetime >= compaction.range_start)
+    return conditions
+
+
+def compact_range(db, compaction: models.ViewCompactions, chunk: int = VIEW_COMPACTION_CHUNK, pause: float = VIEW_COMPACTION_PAUSE):
+    """
+    Add the views of a range to views_monthly, chunk by chunk of pixel uuids
+    :param compaction: models.ViewCompactions progress of the range, committed with each chunk
+    """
+    views = models.Views
+    in_range = _in_range(compaction)
+    while True:
+        after = [] if compaction.last_pixel_uuid is None else [views.pixel_uuid > compaction.last_pixel_uuid]
+        # Last pixel uuid of the chunk, the views of a pixel are never split between two chunks
+        boundary = db.execute(
+            select(views.pixel_uuid).where(*in_range, *after).order_by(views.pixel_uuid).offset(chunk - 1).limit(1)
+        ).scalar()
+        within = in_range + after + ([views.pixel_uuid <= boundary] if boundary is not None else [])
+
+        count, last_pixel_uuid = db.execute(select(func.count(), func.max(views.pixel_uuid)).where(*within)).one()
+        if count:
+            month = _month_of(db, views.view_datetime)
+            label = func.coalesce(views.machine_label, "")
+            _upsert_monthly(db, select(
+                month,
+                views.pixel_uuid,
+                label,
+                func.count(),
+                func.min(views.view_datetime),
+                func.max(views.view_datetime)
+            ).where(*within).group_by(month, views.pixel_uuid, label))
+            compaction.compacted_rows += count
+            compaction.last_pixel_uuid = last_pixel_uuid
+        if boundary is None:
+            compaction.aggregated_datetime = datetime.datetime.utcnow()
+        db.commit()
+        if boundary is None:
+            return
+        time.sleep(pause)
+
+
+def drop_range(db, compaction: models.ViewCompactions, partition: Optional[str], chunk: int = VIEW_COMPACTION_CHUNK, pause: float = VIEW_COMPACTION_PAUSE):
+    """
+    Remove the compacted views of a range, by dropping its partition or by chunked deletes
+    :param partition: string partition holding exactly the range, None if there is none
+    """
+    views = models.Views
+    in_range = _in_range(compaction)
+    if partition:
+        written_since = db.execute(select(func.count()).select_from(views).where(
+            views.view_datetime < compaction.range_end, views.id > compaction.max_view_id,
+            *([views.view_datetime >= compaction.range_start] if compaction.range_start is not None else [])
+        )).scalar()
+        if written_since:
+            partition = None
+
+    if partition:
+        db.execute(text(f"ALTER TABLE views DROP PARTITION {partition}"))
+    else:
+        last_id = 0
+        while True:
+            ids = db.execute(select(views.id).where(views.id > last_id, *in_range).order_by(views.id).limit(chunk)).scalars().all()
+            if not ids:
+                break
+            db.execute(views.__table__.delete().where(views.id.in_(ids)))
+            db.commit()
+            last_id = ids[-1]
+            time.sleep(pause)
+    compaction.completed_datetime = datetime.datetime.utcnow()
+    db.commit()
+
+
+def run_retention(months: int = VIEW_RETENTION_MONTHS, ahead: int = VIEW_PARTITIONS_AHEAD, chunk: int = VIEW_COMPACTION_CHUNK, pause: float = VIEW_COMPACTION_PAUSE) -> dict:
+    """
+    Create the upcoming partitions, then compact and drop the views past the retention
+    :return: dict of the created partitions and of the compacted ranges
+    """
+    result = {"partitions_created": [], "compacted": []}
+    # Each view shard keeps its own partitions and compactions
+    for shard, session_maker in view_shards.view_shards.session_makers().items():
+        shard_result = _run_shard_retention(session_maker, months, ahead, chunk, pause)
+        result["partitions_created"] += shard_result["partitions_created"]
+        result["compacted"] += [dict(compacted, shard=shard) if shard else compacted for compacted in shard_result["compacted"]]
+    return result
+
+
+def _run_shard_retention(session_maker, months: int, ahead: int, chunk: int, pause: float) -> dict:
+    cutoff = add_months(month_start(datetime.datetime.utcnow()), -months)
+    result = {"partitions_created": [], "compacted": []}
+
+    db = session_maker()
+    try:
+        result["partitions_created"] = ensure_partitions(db, ahead)
+        partitions = {bound: name for name, bound in view_partitions(db) if bound}
+
+        # Unfinished compactions first, then one range per partition past the retention, or a single one
+        range_ends = [row.range_end for row in db.query(models.ViewCompactions).filter(models.ViewCompactions.completed_datetime == None)]
+        range_ends += [bound for bound in partitions if bound <= cutoff] if partitions else [cutoff]
+        for range_end in sorted(set(range_ends)):
+            compaction = db.query(models.ViewCompactions).filter(models.ViewCompactions.range_end == range_end).first()
+            if compaction and compaction.completed_datetime:
+                continue
+            if not compaction:
+                compaction = models.ViewCompactions(
+                    range_end=range_end,
+                    range_start=db.query(func.max(models.ViewCompactions.range_end)).filter(models.ViewCompactions.range_end < range_end).scalar(),
+                    max_view_id=db.query(func.max(models.Views.id)).scalar() or 0,
+                    compacted_rows=0
+                )
+                db.add(compaction)
+                db.commit()
+            if not compaction.aggregated_datetime:
+                compact_range(db, compaction, chunk, pause)
+            drop_range(db, compaction, partitions.get(range_end), chunk, pause)
+            result["compacted"].append({"range_end": range_end.isoformat(), "views": compaction.compacted_rows})
+    finally:
+        db.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--months", type=int, default=VIEW_RETENTION_MONTHS, help="months of raw views kept, the current one included")
+    parser.add_argument("--ahead", type=int, default=VIEW_PARTITIONS_AHEAD, help="months of partitions created in advance")
+    parser.add_argument("--chunk", type=int, default=VIEW_COMPACTION_CHUNK, help="views compacted or deleted per transaction")
+    parser.add_argument("--pause", type=float, default=VIEW_COMPACTION_PAUSE, help="seconds slept between two chunks")
+    args = parser.parse_args()
+
+    print(run_retention(args.months, args.ahead, args.chunk, args.pause))
+
+
+if __name__ == "__main__":
+    main()
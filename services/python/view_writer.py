@@ -0,0 +1,121 @@
+"""
+Write-behind worker draining the pixel view stream into the Views table.
+
+Start one or more instances next to the API when VIEW_WRITE_MODE=stream:
+    python view_writer.py --consumer writer-1
+
+Entries are acknowledged only after their batch is committed, so delivery is
+at-least-once. Entries left pending by a crashed consumer are claimed after
+--claim-idle milliseconds and replayed, record_views skips the events it
+already wrote.
+"""
+import argparse
+import os
+import socket
+import time
+import redis
+import database
+import tracking
+import utils
+
+
+def ensure_group(r):
+    try:
+        r.xgroup_create(tracking.VIEW_STREAM_KEY, tracking.VIEW_STREAM_GROUP, id="0", mkstream=True)
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def claim_stale(r, consumer: str, min_idle_ms: int, count: int) -> int:
+    """
+    Take over the entries pending on other consumers for longer than min_idle_ms
+    """
+    pending = r.xpending_range(tracking.VIEW_STREAM_KEY, tracking.VIEW_STREAM_GROUP, "-", "+", count)
+    stale = [
+        entry["message_id"] for entry in pending
+        if entry["consumer"] != consumer.encode() and entry["time_since_delivered"] >= min_idle_ms
+    ]
+    if stale:
+        r.xclaim(tracking.VIEW_STREAM_KEY, tracking.VIEW_STREAM_GROUP, consumer, min_idle_ms, stale)
+    return len(stale)
+
+
+def read_entries(r, consumer: str, stream_id: str, count: int, block_ms=None):
+    response = r.xreadgroup(
+        tracking.VIEW_STREAM_GROUP,
+        consumer,
+        {tracking.VIEW_STREAM_KEY: stream_id},
+        count=count,
+        block=block_ms
+    )
+    return response[0][1] if response else []
+
+
+def drain_batch(r, consumer: str, batch_size: int, block_ms: int) -> int:
+    """
+    Write one batch of entries, own pending entries are replayed before new ones
+    :return: number of entries acknowledged
+    """
+    entries = read_entries(r, consumer, "0", batch_size)
+    if not entries:
+        entries = read_entries(r, consumer, ">", batch_size, block_ms)
+    if not entries:
+        return 0
+
+    events = []
+    for entry_id, fields in entries:
+        try:
+            events.append(tracking.parse_view_event(entry_id, fields))
+        except (KeyError, TypeError, ValueError):
+            # Deleted or malformed entry, acknowledged below and dropped
+            print(f"Dropping malformed view event {entry_id}: {fields}")
+
+    db = database.SessionLocal()
+    try:
+        result = tracking.record_views(db, events)
+    finally:
+        db.close()
+
+    entry_ids = [entry_id for entry_id, _ in entries]
+    pipe = r.pipeline(transaction=False)
+    pipe.xack(tracking.VIEW_STREAM_KEY, tracking.VIEW_STREAM_GROUP, *entry_ids)
+    pipe.xdel(tracking.VIEW_STREAM_KEY, *entry_ids)
+    pipe.execute()
+
+    print(f"Wrote {len(entries)} view events: {result}")
+    return len(entries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--consumer", default=f"{socket.gethostname()}-{os.getpid()}")
+    parser.add_argument("--batch", type=int, default=500, help="entries per bulk insert")
+    parser.add_argument("--block", type=int, default=1000, help="milliseconds to wait for new entries")
+    parser.add_argument("--claim-idle", type=int, default=60000, help="milliseconds before taking over a pending entry")
+    parser.add_argument("--retry", type=float, default=5, help="seconds to wait after a failed batch")
+    args = parser.parse_args()
+
+    # Reads block for --block ms, longer than the socket timeout of the API pool
+    r = utils.get_blocking_redis_connection()
+    last_claim = 0
+    group_ready = False
+
+    while True:
+        try:
+            if not group_ready:
+                ensure_group(r)
+                group_ready = True
+            if time.monotonic() - last_claim > args.claim_idle / 1000:
+                claim_stale(r, args.consumer, args.claim_idle, args.batch)
+                last_claim = time.monotonic()
+            drain_batch(r, args.consumer, args.batch, args.block)
+        except Exception as e:
+            # Unacknowledged entries stay pending and are replayed on the next loop
+            print(f"Error in view writer: {e}")
+            group_ready = False
+            time.sleep(args.retry)
+
+
+if __name__ == "__main__":
+    main()